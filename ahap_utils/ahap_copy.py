@@ -10,7 +10,6 @@ import argparse
 import copy
 import platform
 import os
-import shutil
 import sys
 
 import geopandas as gpd
@@ -18,6 +17,7 @@ import geopandas as gpd
 # import enlighten
 
 from selection_utils.query_danco import query_footprint
+from misc_utils.copy_engine import copy_files
 from misc_utils.id_parse_utils import read_ids
 from misc_utils.logging_utils import create_logger
 
@@ -31,7 +31,8 @@ from misc_utils.logging_utils import create_logger
 
 def main(selection, destination, source_loc, high_res, med_res, tm,
          list_drives, list_missing_paths, write_copied, 
-         write_footprint, exclude_list, dryrun, verbose):
+         write_footprint, exclude_list, dryrun, verbose,
+         threads=4, manifest=None):
     
     #### Logging setup
     if verbose == False:
@@ -317,40 +318,20 @@ def main(selection, destination, source_loc, high_res, med_res, tm,
         
     
     ###  Do copying
-    # Create file of already copied to be use for excluding in subsequent copying
-    if write_copied:
-        if os.path.exists(write_copied):
-            wc_open_mode = 'a'
-        else:
-            wc_open_mode = 'w'
-        wc = open(write_copied, wc_open_mode)
-    
-    ## Copy loop
-    # progress bar setup
-    # manager = enlighten.get_manager()
-    # pbar = manager.counter(total=len(aia_mounted[SRC_PATH]), desc='Copying:', unit='files')
     logger.info('Copying files from {} to {}...'.format(source_loc, destination))
-    for src, dst in zip(aia_mounted[SRC_PATH], aia_mounted[DST_PATH]):
-        # Make directory tree if necessary
-        dst_dir = os.path.dirname(dst)
-        if not os.path.exists(dst_dir):
-            logger.debug('Making directories: \n{}'.format(dst_dir))
-            os.makedirs(dst_dir)
-        if not os.path.exists(dst):
-            logger.debug('Copying \n{} -> \n{}\n'.format(src, dst))
-            if not dryrun:
-                if tm == tm_copy:
-                    shutil.copyfile(src, dst)
-                elif tm == tm_link:
-                    os.link(src, dst)
-                if write_copied:
-                    wc.write(os.path.basename(src).split('.')[0])
-                    wc.write('\n')
-        else:
-            logger.debug('Destination file already exists, skipping: \n{}\n{}'.format(src, dst))
-        # pbar.update()
-    if write_copied:
-        wc.close()
+    result = copy_files(list(zip(aia_mounted[SRC_PATH], aia_mounted[DST_PATH])),
+                        manifest_path=manifest, threads=threads,
+                        method='copy' if tm == tm_copy else 'link',
+                        # Files copied before the manifest have new mtimes
+                        # (copyfile), so only trust identical stamps with one
+                        compare='identical' if tm == tm_copy and manifest else 'exists',
+                        dryrun=dryrun)
+    # Create file of already copied to be use for excluding in subsequent copying
+    if write_copied and result.copied:
+        with open(write_copied, 'a' if os.path.exists(write_copied) else 'w') as wc:
+            for src, dst in result.copied:
+                wc.write(os.path.basename(src).split('.')[0])
+                wc.write('\n')
 
     if write_footprint:
         logger.info('Writing footprints...')
@@ -399,6 +380,10 @@ if __name__ == '__main__':
     parser.add_argument('--dryrun', action='store_true',
                         help='Print copy actions without copying.')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='Number of files to copy concurrently.')
+    parser.add_argument('-m', '--manifest', type=os.path.abspath,
+                        help='json manifest of copied files, to resume from.')
     
     args = parser.parse_args()
     
@@ -428,4 +413,6 @@ if __name__ == '__main__':
          write_footprint=write_footprint,
          exclude_list=exclude_list,
          dryrun=dryrun,
-         verbose=verbose)    
+         verbose=verbose,
+         threads=args.threads,
+         manifest=args.manifest)    
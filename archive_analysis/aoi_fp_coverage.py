@@ -16,6 +16,8 @@ from tqdm import tqdm
 
 from query_danco import query_footprint
 from id_parse_utils import write_ids
+from archive_analysis_utils import iter_grid_aoi
+from selection_utils.set_cover import cover_aois
 
 
 ## Logging
@@ -76,25 +78,21 @@ def grid_aoi(aoi_gdf, step):
         Dataframe containing grid points.
 
     """
-    # grid_points = []
-    for i, row in aoi_gdf.iterrows():
-        ## Get feature bounds and geometry
-        minx, miny, maxx, maxy = row.geometry.bounds
-        g = row.geometry
-        ## Create points using boundary locations and step
-        pts = []
-        for x in np.arange(minx, maxx+step, step):
-            for y in np.arange(miny, maxy+step, step):
-                pts.append((x,y))
-        points = [Point(pt) for pt in pts if (g.contains(Point(pt))) or (g.intersects(Point(pt)))]
-        # Add exterior coords to smallest polys (were being skipped??)
-        if g.area < step*step:
-            first_ext_pt = Point(g.exterior.coords[0])
-            midd_ext_pt = Point(g.exterior.coords[round(len(g.exterior.coords)/2)])
-            points.extend([first_ext_pt, midd_ext_pt])
-        # grid_points.extend(points)
-
-    pt_grid = gpd.GeoDataFrame(geometry=points, crs=aoi_gdf.crs)
+    g = aoi_gdf.geometry.iloc[-1]
+    ## Create points on boundary or in polygon, testing all points at once
+    bands = list(iter_grid_aoi(g, x_space=step, y_space=step,
+                               aoi_crs=aoi_gdf.crs, predicate='intersects'))
+    pt_grid = pd.concat(bands, ignore_index=True)
+    # Add exterior coords to smallest polys (were being skipped??)
+    if g.area < step*step:
+        first_ext_pt = Point(g.exterior.coords[0])
+        midd_ext_pt = Point(g.exterior.coords[round(len(g.exterior.coords)/2)])
+        pt_grid = pd.concat([pt_grid,
+                             gpd.GeoDataFrame(geometry=[first_ext_pt, midd_ext_pt],
+                                              crs=aoi_gdf.crs)],
+                            ignore_index=True)
+
+    pt_grid = gpd.GeoDataFrame(pt_grid, geometry='geometry', crs=aoi_gdf.crs)
     
     return pt_grid
 
@@ -118,58 +116,19 @@ if fps.crs != aoi.crs:
     fps = fps.to_crs(aoi.crs)
 
 
-# Iterate over polygons in AOI, returning grid for each and storing in column in original df
-for poly_id in aoi.index.unique():
-    # Select current polygon
-    poly = aoi[aoi.index==poly_id]
-    # Grid current aoi
-    poly_grid = grid_aoi(poly, step=step)
-    
-    # Create indentifying index for each point in the grid
-    pt_id = 'pt_id'
-    # Create index for points
-    poly_grid[pt_id] = [x for x in range(len(poly_grid))]
-    
-    # Get all point ids for checking to see if each is covered
-    all_pts = list(poly_grid[pt_id])
-    poly_grid.set_index(pt_id)
-    
-    #### Start with most recent and work backwards covering AOI
-    ## Find all footprints intersection with points in grid
-    print('Finding initial intersection with grid for AOI: {}...'.format(poly_id))
-    fps_sel = gpd.sjoin(fps, poly_grid, how='inner')
-    fps_sel.sort_values(by=date_field, inplace=True)
-    # Remove index columns for next join
-    for col in ['index_right', 'index_left']:
-        if col in list(fps_sel):
-            fps_sel.drop(columns=[col], inplace=True)
-    
-    # Count how many points are covered by each unique footprint
-    fps_count = fps_sel.groupby(fp_unique_id).agg({pt_id: ['nunique', 'unique']})
-    # Rename agg columns for clarity
-    pt_count = '{}_count'.format(pt_id)
-    pts_covered = '{}_covered'.format(pt_id)
-    fps_count.columns = fps_count.columns.droplevel(0)
-    fps_count = fps_count.rename(columns={'nunique': pt_count, 'unique':  pts_covered})
-    # Sort by most points (area) covered
-    fps_count.sort_values(by=pt_count, ascending=False, inplace=True)
-    ## Determine what points are covered, starting with most coverage, saving unique footprint IDs
-    keep_fp_ids = [] # list of footprint IDs to keep    
-    percent_covered = 0
-    pt_ids_covered = [] # list of all point IDs that are covered
-    # Iterate over rows, adding footprint IDs to keep and the pts covered by each until
-    # more than the desired coverage is reached
-    for row_number in range(len(fps_count)):
-        while percent_covered < desired_coverage:
-            # Add the points the current row covers (starting with most covered) 
-            # to list of all covered
-            row = fps_count.iloc[row_number]
-            for pt in list(row[pts_covered]):
-                if pt not in pt_ids_covered:
-                    pt_ids_covered.append(pt)
-            keep_fp_ids.append(row.name)
-            percent_covered = (len(pt_ids_covered) / len(all_pts))*100
-    aoi.at[poly_id, 'keep_ids'] = keep_fp_ids
+#### Select footprints covering each polygon in AOI
+# Footprints covering the most uncovered grid points are selected until
+# desired_coverage is reached, preferring the most recent on ties.
+print('Selecting footprints over AOIs...')
+covers = cover_aois(aoi, fps, fp_unique_id,
+                    grid_fn=lambda g: grid_aoi(gpd.GeoDataFrame(geometry=[g], crs=aoi.crs),
+                                               step=step),
+                    tie_breaks=[(date_field, False)],
+                    target=desired_coverage)
+for poly_id, row in covers.iterrows():
+    print('AOI {}: {} footprints, {:.2f}% covered'.format(poly_id, len(row['fp_ids']),
+                                                         row['coverage']))
+aoi['keep_ids'] = covers['fp_ids']
 
 # Get all footprint IDs to keep, from nested sublists for each AOI
 all_ids = [i for sl in list(aoi['keep_ids']) for i in sl]
@@ -14,6 +14,7 @@ from datetime import datetime as dt
 from tqdm import tqdm
 import fiona
 from shapely.geometry import Point, Polygon, box
+from shapely.geometry.base import BaseGeometry
 import geopandas as gpd
 import pandas as pd
 
@@ -22,35 +23,155 @@ from selection_utils.query_danco import query_footprint
 # from range_creation import range_tuples
 from misc_utils.logging_utils import create_logger
 
+try:
+    # Vectorized geometry creation and predicates, shapely >= 2.0
+    from shapely import points as shp_points, box as shp_boxes
+    from shapely import contains_xy, intersects_xy, intersects, prepare
+except ImportError:
+    shp_points = None
+    from shapely import vectorized
+    from shapely.prepared import prep
+
 ## Set up logger
 logger = create_logger(__name__, 'sh', 'INFO')
 
+# Approximate number of grid nodes to create at a time when gridding
+BAND_NODES = 1_000_000
+
 
 def run_subprocess(command):
     proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
     output, error = proc.communicate()
 
 
-def grid_aoi(aoi_path, n_pts_x=None, n_pts_y=None,
-             x_space=None, y_space=None, aoi_crs=None,
-             poly=False):
-    # Read in AOI - assumes only one feature
-    logger.debug('Creating grid in AOI...')
+def _load_aoi(aoi_path, aoi_crs=None):
+    """Return the geometry and crs of the first feature of an AOI."""
     if isinstance(aoi_path, gpd.GeoDataFrame):
         aoi_all = aoi_path
-    elif isinstance(aoi_path, Polygon):
+    elif isinstance(aoi_path, BaseGeometry):
         aoi_all = gpd.GeoDataFrame(geometry=[aoi_path], crs=aoi_crs)
     else:
         if os.path.exists(aoi_path):
             aoi_all = gpd.read_file(aoi_path)
         else:
             logger.error('Could not locate: {}'.format(aoi_path))
+            raise FileNotFoundError(aoi_path)
 
     # Get first feature - should be only feature
-    aoi = aoi_all.iloc[:1]
+    return aoi_all.geometry.iloc[0], aoi_all.crs
+
+
+def _xy_in_aoi(aoi, xs, ys, predicate='within'):
+    """
+    Test arrays of coordinates against aoi in bulk. With 'intersects'
+    points on the boundary of aoi are included.
+    """
+    if shp_points is not None:
+        prepare(aoi)
+        if predicate == 'intersects':
+            return intersects_xy(aoi, xs, ys)
+        return contains_xy(aoi, xs, ys)
+    inside = vectorized.contains(aoi, xs, ys)
+    if predicate == 'intersects':
+        inside |= vectorized.touches(aoi, xs, ys)
+    return inside
+
+
+def _cells_in_aoi(aoi, x0, y0, x_space, y_space):
+    """
+    Test cells with lower left corners x0, y0 for intersection with aoi
+    in bulk.
+    """
+    x1 = x0 + x_space
+    y1 = y0 + y_space
+    if shp_points is not None:
+        prepare(aoi)
+        return intersects(aoi, shp_boxes(x0, y0, x1, y1))
+    # Any cell with a corner in the AOI intersects it, only cells with no
+    # corners in the AOI need an exact (prepared) test
+    hit = np.zeros(x0.shape, dtype=bool)
+    for cx, cy in ((x0, y0), (x1, y0), (x0, y1), (x1, y1)):
+        hit |= _xy_in_aoi(aoi, cx, cy, predicate='intersects')
+    check = ~hit
+    if check.any():
+        aoi_prep = prep(aoi)
+        hit[check] = [aoi_prep.intersects(box(*c))
+                      for c in zip(x0[check], y0[check], x1[check], y1[check])]
+    return hit
+
+
+def _raster_mask(aoi, xs, ys, x_space, y_space, poly=False, srs_wkt=None):
+    """
+    Rasterize aoi onto a raster with one pixel per grid node. Point nodes
+    are at pixel centers, so the default rasterization rule (pixel center
+    in polygon) is a containment test. Cells are pixels, so burning with
+    ALL_TOUCHED selects cells touching the AOI.
+    """
+    from osgeo import gdal
+    from misc_utils.gdal_tools import gdf2ogr_mem
+
+    ncols, nrows = len(xs), len(ys)
+    ytop = ys[-1]
+    if poly:
+        gt = (xs[0], x_space, 0, ytop + y_space, 0, -y_space)
+    else:
+        gt = (xs[0] - x_space / 2, x_space, 0, ytop + y_space / 2, 0, -y_space)
+    ds = gdal.GetDriverByName('MEM').Create('', ncols, nrows, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform(gt)
+    if srs_wkt:
+        ds.SetProjection(srs_wkt)
+    ogr_ds, lyr = gdf2ogr_mem([aoi], srs=srs_wkt)
+    options = ['ALL_TOUCHED=TRUE'] if poly else []
+    gdal.RasterizeLayer(ds, [1], lyr, burn_values=[1], options=options)
+    mask = ds.GetRasterBand(1).ReadAsArray().astype(bool)
+    ds = None
+    ogr_ds = None
+
+    # Rows are top down, nodes are bottom up
+    return mask[::-1]
+
+
+def iter_grid_aoi(aoi_path, n_pts_x=None, n_pts_y=None,
+                  x_space=None, y_space=None, aoi_crs=None,
+                  poly=False, predicate='within', method='prepared',
+                  band_rows=None):
+    """
+    Create a grid of points (or cells) over an AOI, yielding the grid in
+    bands of rows so grids larger than memory can be written as they are
+    created.
+
+    Parameters
+    ----------
+    aoi_path : str, gpd.GeoDataFrame, shapely geometry
+        AOI to grid, only the first feature is used.
+    n_pts_x, n_pts_y : int
+        Number of points in x and y, used if spacing is not provided.
+    x_space, y_space : float
+        Spacing in units of the AOI projection.
+    aoi_crs : crs of the AOI, if a geometry is passed.
+    poly : bool
+        Create x_space by y_space cells with their lower left corner at
+        each grid node, keeping cells that intersect the AOI, rather than
+        points that are within it.
+    predicate : str
+        'within' or 'intersects' - for points, whether points on the AOI
+        boundary are kept.
+    method : str
+        'prepared' - test nodes against the AOI geometry in bulk
+        'raster' - rasterize the AOI with one pixel per node and keep
+                   nodes whose pixels are burned (requires GDAL).
+    band_rows : int
+        Number of rows of nodes to create at a time. Defaults to about
+        BAND_NODES nodes per band.
+
+    Yields
+    ------
+    gpd.GeoDataFrame : grid points / cells in each band, bottom up.
+    """
+    aoi, crs = _load_aoi(aoi_path, aoi_crs=aoi_crs)
 
     # Get aoi bounding box
-    minx, miny, maxx, maxy = aoi.geometry.bounds.values[0]
+    minx, miny, maxx, maxy = aoi.bounds
     x_range = maxx - minx
     y_range = maxy - miny
     # Determine spacing
@@ -62,40 +183,57 @@ def grid_aoi(aoi_path, n_pts_x=None, n_pts_y=None,
         y_space = y_range / n_pts_y
     logger.debug('Grid spacing\nx: {}\ny: {}'.format(round(x_space, 2), round(y_space, 2)))
 
-    # Create x,y Point geometries
     x_pts = np.arange(minx, maxx, step=x_space)
     y_pts = np.arange(miny, maxy, step=y_space)
-    mesh = np.array(np.meshgrid(x_pts, y_pts))
-    xys = mesh.T.reshape(-1, 2)
-    grid_points = [Point(x, y) for (x, y) in xys]
+    if not band_rows:
+        band_rows = max(BAND_NODES // max(len(x_pts), 1), 1)
+    srs_wkt = crs.to_wkt() if hasattr(crs, 'to_wkt') else None
+
+    for start in tqdm(range(0, max(len(y_pts), 1), band_rows),
+                      disable=len(y_pts) <= band_rows):
+        band_y = y_pts[start:start + band_rows]
+        xs, ys = np.meshgrid(x_pts, band_y)
+        if method == 'raster':
+            keep = _raster_mask(aoi, x_pts, band_y, x_space, y_space,
+                                poly=poly, srs_wkt=srs_wkt)
+        elif poly:
+            keep = _cells_in_aoi(aoi, xs, ys, x_space, y_space)
+        else:
+            keep = _xy_in_aoi(aoi, xs, ys, predicate=predicate)
+        xs = xs[keep]
+        ys = ys[keep]
+
+        if poly:
+            if shp_points is not None:
+                geoms = shp_boxes(xs, ys, xs + x_space, ys + y_space)
+            else:
+                geoms = [box(x, y, x + x_space, y + y_space)
+                         for x, y in zip(xs, ys)]
+        elif shp_points is not None:
+            geoms = shp_points(xs, ys)
+        else:
+            geoms = gpd.points_from_xy(xs, ys)
 
-    # Make geodataframe of Point geometries
-    grid = gpd.GeoDataFrame(geometry=grid_points, crs=aoi.crs)
+        yield gpd.GeoDataFrame(geometry=geoms, crs=crs)
 
-    # Remove any grid points that do not fall in actual feature aoi_all
-    grid['in'] = [pt.within(aoi.geometry.iloc[0]) for pt in grid.geometry]
 
-    grid = grid[grid['in'] == True].drop(columns=['in'])
+def grid_aoi(aoi_path, n_pts_x=None, n_pts_y=None,
+             x_space=None, y_space=None, aoi_crs=None,
+             poly=False, predicate='within', method='prepared',
+             band_rows=None):
+    """
+    Create a grid of points (or cells if poly) over an AOI. See
+    iter_grid_aoi for parameters.
+    """
+    logger.debug('Creating grid in AOI...')
+    bands = list(iter_grid_aoi(aoi_path, n_pts_x=n_pts_x, n_pts_y=n_pts_y,
+                               x_space=x_space, y_space=y_space,
+                               aoi_crs=aoi_crs, poly=poly,
+                               predicate=predicate, method=method,
+                               band_rows=band_rows))
+    grid = pd.concat(bands, ignore_index=True) if len(bands) > 1 else bands[0]
 
-    if poly:
-        logger.debug('Creating polygon grid...')
-        x_pts = sorted(set(grid.geometry.values.x))
-        y_pts = sorted(set(grid.geometry.values.y))
-
-        all_cells = []
-        for i, x in tqdm(enumerate(x_pts), total=len(x_pts)):
-            if i == len(x_pts) - 1:
-                break
-            next_x = x_pts[i + 1]
-            for j, y in enumerate(y_pts):
-                if j == len(y_pts) - 1:
-                    break
-                next_y = y_pts[j + 1]
-                cell = box(x, y, next_x, next_y)
-                all_cells.append(cell)
-        grid = gpd.GeoDataFrame(geometry=all_cells, crs=grid.crs)
-
-    return grid
+    return gpd.GeoDataFrame(grid, geometry='geometry', crs=bands[0].crs)
 
 
 # def grid_aoi(aoi_shp, step=None, x_space=None, y_space=None, write=False):
@@ -201,99 +339,122 @@ def get_count(geocells, fps, date_col=None):
     return out
 
 
-def get_time_range(pts, fps, fps_date_col, keep_datetime=False):
+def get_count_raster(geocells, fps, res, date_col=None, out_path=None,
+                     batch_size=10_000, stat='max'):
+    '''
+    Gets the count of features in fps over each feature in geocells by
+    burning fps into a count raster with resolution res (in units of the
+    geocells crs), then reducing the raster over each feature. Unlike
+    get_count, no spatial join is performed, so memory use does not grow
+    with the number of footprint / cell intersections.
+
+    geocells: geodataframe of features to count within
+    fps: geodataframe of polygons
+    res: pixel size of the count raster
+    date_col: column in fps with dates, to get min and max dates
+    out_path: path to write the count raster to, in memory if not provided
+    stat: reduction of counts over polygon features - 'max', 'mean', 'sum'
+    '''
+    from archive_analysis.density_raster import FootprintDensity
+
+    logger.info('Rasterizing footprint density...')
+    density = FootprintDensity(geocells.total_bounds, res, geocells.crs,
+                               out_path=out_path, date_col=date_col)
+    density.add(fps, batch_size=batch_size)
+
+    logger.info('Getting count...')
+    out = density.zonal(geocells, stat=stat)
+
+    return out
+
+
+def get_time_range(pts, fps, fps_date_col, keep_datetime=False, **kwargs):
     '''
     Gets the earliest, latest, and range of dates over
-    each point that are present in fps
+    each point that are present in fps, along with the count,
+    revisit interval statistics and monthly histogram of
+    acquisitions (see archive_analysis.temporal_coverage)
     pts: geodataframe of points of interest
     fps: geodataframe of footprints
     fps_date_col: name of date column in fps
+    kwargs: passed to temporal_coverage (tile_size, chunk_size, hist, n_jobs)
     '''
-    def col_strftime(date_col):
-        str_date = date_col.dt.strftime('%Y-%m-%d')
-        return str_date
-    
-    if type(fps[fps_date_col]) != pd._libs.tslibs.timestamps.Timestamp:
-        fps[fps_date_col] = pd.to_datetime(fps[fps_date_col])
-        
-    
+    from archive_analysis.temporal_coverage import temporal_coverage
+
     ## Confirm crs is the same
     if pts.crs != fps.crs:
         logger.info('Converting crs of grid to match footprint...')
-        fps = fps.to_crs(fps.crs)
-        
-    logger.info('Performing spatial join...')
-    ## Get a column from fps to use to test if sjoin found matches
-    fp_col = fps.columns[1]
-    sj = gpd.sjoin(pts, fps, how='left', op='intersects')
-    ## Create index to groupyby and join on later
-    sj.index.names = ['idx']
-    sj.reset_index(inplace=True)
-    
-    ## Remove no matches, group the rest, counting the index
-    gb = sj[~sj[fp_col].isna()].groupby('idx').agg({fps_date_col:['min', 'max']})
-    
-    ## Join geocells to dataframe with counts
-    out = pts.join(gb)
-    out.rename(columns={(fps_date_col, 'max'): 'date_max', (fps_date_col, 'min'): 'date_min'}, inplace=True)
-    out['months_range'] = ((out['date_max'] - out['date_min'] ) / np.timedelta64(1, 'M')).astype(int)
-    
+        pts = pts.to_crs(fps.crs)
+
+    logger.info('Computing temporal coverage...')
+    out = temporal_coverage(pts, fps, fps_date_col, **kwargs)
+    # Whole months between first and last acquisition
+    out['months_range'] = np.floor((out['date_max'] - out['date_min']) /
+                                   pd.Timedelta(days=365.2425 / 12)).astype('Int64')
+
     if keep_datetime == False:
         datetime_cols = out.select_dtypes(include=['datetime']).columns
         for dc in datetime_cols:
             out[dc] = out[dc].dt.strftime('%Y-%m-%d')
-    out = gpd.GeoDataFrame(out, geometry='geometry', crs=fps.crs) 
+    out = gpd.GeoDataFrame(out, geometry='geometry', crs=fps.crs)
 
     return out
 
 
-def get_count_loop(fxn, gcs, fps, 
-                   lat_start=None, lat_stop=None, lat_step=None, 
-                   lon_start=None, lon_stop=None, lon_step=None):
+def get_count_loop(fxn, gcs, fps,
+                   lat_start=None, lat_stop=None, lat_step=None,
+                   lon_start=None, lon_stop=None, lon_step=None,
+                   partitioner=None, n_jobs=None):
     '''
-    **NEEDS more abstraction**
-    Splits an AOI geodataframe (gcs) into a number of subsets and then loops over it,
-    calling fxn with optional *args
+    Splits an AOI geodataframe (gcs) into a number of subsets and calls
+    fxn(subset, fps) on each, in parallel.
     fxn: function to call in loop, must return dataframe or geodataframe
     gcs: geodataframe to split
-    *args: any additional parameters to pass to fxn (gcs must be first)
+    fps: geodataframe passed with each subset
+    lat_*, lon_*: split gcs into strips on Cent_Lat / Cent_Lon columns.
+                  If not provided gcs are split into antimeridian and pole
+                  aware tiles (see misc_utils.spatial_partition), with each
+                  subset receiving only the fps that overlap it.
+    partitioner: misc_utils.spatial_partition.TilePartitioner to use
+    n_jobs: number of processes
     '''
+    from misc_utils.spatial_partition import map_partitions
+
     crs = gcs.crs
-    
+
+    def strips(start, stop, step):
+        edges = np.arange(start, stop + step, step)
+        return list(zip(edges[:-1], edges[1:]))
+
     ## Limit to given latititude and longitude
     # If both latitude and longitude params are set split by lon, then by lat, then combine into one list
-    if lon_start and lat_start:
-        lon_ranges = range_tuples(lon_start, lon_stop, lon_step)
-        lat_ranges = range_tuples(lat_start, lat_stop, lat_step)
+    if lon_start is not None and lat_start is not None:
+        lon_ranges = strips(lon_start, lon_stop, lon_step)
+        lat_ranges = strips(lat_start, lat_stop, lat_step)
         split = [gcs[(gcs.Cent_Lon > x[0]) & (gcs.Cent_Lon <= x[1])] for x in lon_ranges]
-        subsplit = [[df[(df.Cent_Lat > y[0]) & (df.Cent_Lat <= y[1])] for y in lat_ranges] for df in split]        
+        subsplit = [[df[(df.Cent_Lat > y[0]) & (df.Cent_Lat <= y[1])] for y in lat_ranges] for df in split]
         split = [df for nestedlist in subsplit for df in nestedlist]
     # If latitude parameters are set - split based on those
-    elif lat_start:
-        lat_ranges = range_tuples(lat_start, lat_stop, lat_step)
+    elif lat_start is not None:
+        lat_ranges = strips(lat_start, lat_stop, lat_step)
         split = [gcs[(gcs.Cent_Lat > y[0]) & (gcs.Cent_Lat <= y[1])] for y in lat_ranges]
     # If longitude parameters are set - split based on those
-    elif lon_start:
-        lon_ranges = range_tuples(lon_start, lon_stop, lon_step)
+    elif lon_start is not None:
+        lon_ranges = strips(lon_start, lon_stop, lon_step)
         split = [gcs[(gcs.Cent_Lon > x[0]) & (gcs.Cent_Lon <= x[1])] for x in lon_ranges]
-    # Simply split into four dfs of geocells
+    # Split into tiles, passing each only the footprints over it
     else:
-        split = [x for x in len(gcs)/4]
-        
-    print(split)
-#    lon_ranges = [(-180, -90), (-90, 0), (0, 90), (90, 180)]
-#    lat_ranges = [(-90, -45), (-45, 0), (0, 45), (45, 90)]
-    
+        results = map_partitions(fxn, gcs, fps, partitioner=partitioner,
+                                 n_jobs=n_jobs, concat=False)
+        return [gpd.GeoDataFrame(out, geometry='geometry', crs=crs)
+                for out in results.values()]
+
     results = []
-#    for lst in tqdm(subsplit):
-    for i, df in enumerate(split):
-#        out_name = 'geocells_qtr_ct_{}.shp'.format(i+1)
-#        out_path = os.path.join(r'E:\disbr007\scratch', out_name)
+    for df in tqdm(split):
         out = fxn(df, fps)
         out = gpd.GeoDataFrame(out, geometry='geometry', crs=crs)
-#        out.to_file(out_path, driver="ESRI Shapefile")
         results.append(out)
-    
+
     return results
 
 
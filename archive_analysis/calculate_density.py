@@ -12,14 +12,15 @@ import sys
 import geopandas as gpd
 # from osgeo import gdal
 
-from archive_analysis.archive_analysis_utils import get_count
+from archive_analysis.archive_analysis_utils import get_count, get_count_raster
 from misc_utils.logging_utils import create_logger
 from selection_utils.query_danco import list_danco_db, query_footprint
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
-def calculate_density(grid_p, footprint_p, out_path=None, date_col=None, rasterize=False):
+def calculate_density(grid_p, footprint_p, out_path=None, date_col=None, rasterize=False,
+                      res=None, batch_size=10_000):
     if not isinstance(grid_p, gpd.GeoDataFrame):
         logger.info('Loading grid...')
         if 'gdb' in grid_p:
@@ -47,19 +48,19 @@ def calculate_density(grid_p, footprint_p, out_path=None, date_col=None, rasteri
             footprint = gpd.read_file(footprint_p)
 
     logger.info('Calculating density...')
-    density = get_count(grid, footprint, date_col=date_col)
-    # Convert any tuple columns to strings (occurs with agg-ing same column multiple ways)
-    density.columns = [str(x) if type(x) == tuple else x for x in density.columns]
     if rasterize:
-        logger.info('Rasterizing...')
-        vec_out = '/vsimem/density_temp.shp'
-        density.to_file(vec_out)
-        # TODO: Finish this
-        # rasterize_options = gdal.RasterizeOptions(xRes=, yRes=, )
-        if out_path:
-            1 == 1
-            # Rasterize to out_path
+        # Burn footprints into a count raster at out_path, then get counts
+        # for the grid from the raster
+        if not res:
+            logger.error('Resolution must be provided to rasterize.')
+            sys.exit()
+        density = get_count_raster(grid, footprint, res=res, date_col=date_col,
+                                   out_path=out_path, batch_size=batch_size)
     else:
+        density = get_count(grid, footprint, date_col=date_col)
+    # Convert any tuple columns to strings (occurs with agg-ing same column multiple ways)
+    density.columns = [str(x) if type(x) == tuple else x for x in density.columns]
+    if not rasterize:
         if out_path:
             logger.info('Writing density...')
             density.to_file(out_path)
@@ -78,6 +79,11 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--rasterize', action='store_true',
                         help="""Use this flag to rasterize the output. out_path must have a GDAL
                                 writable extension.""")
+    parser.add_argument('--res', type=float,
+                        help="""Resolution of the density raster, in units of the grid's
+                                projection. Required with --rasterize.""")
+    parser.add_argument('--batch_size', type=int, default=10_000,
+                        help='Number of footprints to rasterize at a time.')
 
     args = parser.parse_args()
 
@@ -86,9 +92,13 @@ if __name__ == '__main__':
     out_path = args.out_path
     date_col = args.date_col
     rasterize = args.rasterize
+    res = args.res
+    batch_size = args.batch_size
     
     calculate_density(grid_p=grid_p,
                       footprint_p=footprint_p,
                       out_path=out_path,
                       date_col=date_col,
-                      rasterize=rasterize)
+                      rasterize=rasterize,
+                      res=res,
+                      batch_size=batch_size)
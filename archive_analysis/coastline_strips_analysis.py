@@ -3,6 +3,7 @@ import geopandas as gpd
 import matplotlib.pyplot as plt
 
 from selection_utils.db import Postgres, generate_sql
+from selection_utils.async_query import AsyncQueryExecutor
 from misc_utils.logging_utils import create_logger
 from misc_utils.utm_area_calc import area_calc
 
@@ -20,38 +21,45 @@ index_dg = 'index_dg'
 years = [year for year in range(2007, 2021, 1)]
 base_where = """(platform IN ('WV02', 'WV03') AND cloudcover <= 20)"""
 
-scenes_coast = gpd.GeoDataFrame()
-with Postgres(db) as pg:
-    for year in years:
-        scenes_yr_cst = gpd.GeoDataFrame()
-        logger.info('Loading records for {}...'.format(year))
-        year_where = "{} AND (acqdate >= '{}-01-01') AND (acqdate <= '{}-12-31')".format(base_where, year, year)
-        ct_sql = generate_sql(layer=index_dg, where=year_where, columns=['*'],)
-
-        yr_ct = pg.get_sql_count(sql=ct_sql)
-        logger.info('Total count for year {}: {:,}'.format(year, yr_ct))
-        chunk_size = 5_000
-        for i in range(0, yr_ct, chunk_size):
-            logger.debug('Loading records: {:,} - {:,}'.format(i, i+chunk_size))
-            sql = generate_sql(layer=index_dg, where=year_where, columns=['*'],
-                               geom_col='shape', encode_geom_col='geom',
-                               limit=chunk_size, offset=i)
-    
-            scenes_year = pg.sql2gdf(sql=sql, geom_col='geom')
-            logger.debug('Records loaded: {:,}'.format(len(scenes_year)))
-
-            # Intersect with coastline
-            if len(scenes_year) == 0:
-                continue
-
-            logger.debug('Locating scenes along coast...')
-            scenes_yr_cst_chunk = gpd.sjoin(scenes_year, coast)
-            logger.debug('Coastal scenes for {} chunk {:,} - {:,}: {}'.format(year, i, i+chunk_size,
-                                                                              len(scenes_yr_cst_chunk)))
-            scenes_yr_cst = pd.concat([scenes_yr_cst, scenes_yr_cst_chunk])
-
-        scenes_coast = pd.concat([scenes_coast, scenes_yr_cst])
-        logger.info('Scenes along coast ({}): {:,}'.format(year, len(scenes_yr_cst)))
+chunk_size = 5_000
+executor = AsyncQueryExecutor(db, max_concurrent=6)
+
+# Count all years at once
+year_wheres = {year: "{} AND (acqdate >= '{}-01-01') AND (acqdate <= '{}-12-31')".format(base_where, year, year)
+               for year in years}
+count_specs = [{'key': year,
+                'sql': generate_sql(layer=index_dg, where=year_where,
+                                    columns=['COUNT(*)'])}
+               for year, year_where in year_wheres.items()]
+year_counts = {year: int(df.iloc[0, 0]) for year, df in executor.run(count_specs)}
+for year in years:
+    logger.info('Total count for year {}: {:,}'.format(year, year_counts[year]))
+
+# Load chunks for all years concurrently, locating coastal scenes in each
+# chunk as it arrives while the remaining chunks are loading. Chunks are
+# ordered on the unique objectid, as row order is otherwise not stable
+# between queries and chunks could overlap or skip rows
+chunk_specs = [{'key': (year, i), 'layer': index_dg, 'where': year_wheres[year],
+                'columns': ['*'], 'geom_col': 'shape', 'encode_geom_col': 'geom',
+                'orderby': 'objectid', 'orderby_asc': True,
+                'limit': chunk_size, 'offset': i}
+               for year in years for i in range(0, year_counts[year], chunk_size)]
+scenes_yr_cst = {year: [] for year in years}
+for (year, i), scenes_year in executor.run(chunk_specs):
+    logger.debug('Records loaded for {} chunk {:,} - {:,}: {:,}'.format(year, i, i+chunk_size,
+                                                                        len(scenes_year)))
+    # Intersect with coastline
+    if len(scenes_year) == 0:
+        continue
+
+    scenes_yr_cst_chunk = gpd.sjoin(scenes_year, coast)
+    logger.debug('Coastal scenes for {} chunk {:,} - {:,}: {}'.format(year, i, i+chunk_size,
+                                                                      len(scenes_yr_cst_chunk)))
+    scenes_yr_cst[year].append(scenes_yr_cst_chunk)
+
+for year in years:
+    logger.info('Scenes along coast ({}): {:,}'.format(year, sum(len(c) for c in scenes_yr_cst[year])))
+scenes_coast = pd.concat([c for year in years for c in scenes_yr_cst[year]])
 
 logger.info('Done.')
 
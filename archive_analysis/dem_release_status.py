@@ -16,7 +16,7 @@ from matplotlib.ticker import FuncFormatter, MultipleLocator
 
 import os, calendar, datetime, sys, logging, collections
 
-from query_danco import query_footprint
+from query_danco import query_footprint, query_footprints, iter_footprints
 from utm_area_calc import area_calc
 
 
@@ -112,9 +112,10 @@ def determine_arctic_season(date_col):
 
 
 ### Load and prep data
-def load_src_fp(region, stereo_type, max_date_diff=None):
+def src_fp_specs(region, stereo_type):
     '''
-    Load the given region and type as a geodataframe.
+    Query parameters for the source footprint and region polygon of the given
+    region and type, as {'src': kwargs, 'pole': kwargs} for query_footprint.
     region: 'rema' or 'arcticdem'
     stereo_type: 'intrack' or 'xtrack'
     '''
@@ -130,8 +131,18 @@ def load_src_fp(region, stereo_type, max_date_diff=None):
     stereo_types = {'intrack': {'src': 'dg_imagery_index_stereo_cc20', 'where':regions[region]['where']},
                     'xtrack': {'src': 'dg_imagery_index_xtrack_cc20', 'where':"project = '{}'".format(regions[region]['project'])},
                     }
-    
-    src = query_footprint(stereo_types[stereo_type]['src'], where=stereo_types[stereo_type]['where'])
+
+    return {'src': {'layer': stereo_types[stereo_type]['src'],
+                    'where': stereo_types[stereo_type]['where']},
+            'pole': {'layer': 'pgc_earthdem_regions',
+                     'where': "project = '{}'".format(regions[region]['project'])}}
+
+
+def prep_src_fp(src, pole, region, stereo_type, max_date_diff=None):
+    '''
+    Prepare loaded source footprint: calculate area, select within region
+    polygon (pole) and add season info.
+    '''
     src['type'] = stereo_type
     
     if stereo_type == 'intrack':
@@ -141,8 +152,6 @@ def load_src_fp(region, stereo_type, max_date_diff=None):
         src = area_calc(src, area_col='area_sqkm')
         src = src[src['area_sqkm'] > 500]
         src.rename(columns={'acqdate1': 'acqdate'}, inplace=True)
-        
-    pole = query_footprint('pgc_earthdem_regions', where="project = '{}'".format(regions[region]['project']))
     
     cols = list(src)
     
@@ -162,16 +171,31 @@ def load_src_fp(region, stereo_type, max_date_diff=None):
     return src
 
 
-def determine_status(src, region):
+def load_src_fp(region, stereo_type, max_date_diff=None):
     '''
-    Determine release status by using danco strip index for relevent product.
+    Load the given region and type as a geodataframe.
     region: 'rema' or 'arcticdem'
+    stereo_type: 'intrack' or 'xtrack'
     '''
-    
-    strip_index = {'rema': 'esrifs_rema_strip_index',
+    specs = src_fp_specs(region, stereo_type)
+    src = query_footprint(**specs['src'])
+    pole = query_footprint(**specs['pole'])
+
+    return prep_src_fp(src, pole, region, stereo_type, max_date_diff=max_date_diff)
+
+
+strip_index = {'rema': 'esrifs_rema_strip_index',
                'arcticdem': 'esrifs_arcticdem_strip_index'}
-    
-    released_ids = list(query_footprint(strip_index[region], db='products', columns=['pairname'])['pairname'])
+
+
+def determine_status(src, region, released_ids=None):
+    '''
+    Determine release status by using danco strip index for relevent product.
+    region: 'rema' or 'arcticdem'
+    released_ids: released pairnames, loaded from strip index if not provided
+    '''
+    if released_ids is None:
+        released_ids = list(query_footprint(strip_index[region], db='products', columns=['pairname'])['pairname'])
     
     src['released'] = np.where(src['pairname'].isin(released_ids), 'released', 'unreleased')
 
@@ -395,13 +419,33 @@ projects = ['arcticdem'] #['rema', 'arcticdem']
 stereo_types = ['intrack', 'xtrack']
 #stereo_types = ['xtrack']
 
-results = []
+# Released pairnames for each project
+released_specs = {prj: {'layer': strip_index[prj], 'columns': ['pairname'], 'table': True}
+                  for prj in projects}
+released = {prj: set(df['pairname'])
+            for prj, df in query_footprints(released_specs, db='products').items()}
+
+# Load all source footprints and region polygons concurrently, preparing
+# each source as soon as it and its region have arrived
+fp_specs = {}
 for prj in projects:
     for st in stereo_types:
-        src = load_src_fp(prj, st, max_date_diff=10)
-        determine_status(src, prj)
+        specs = src_fp_specs(prj, st)
+        fp_specs[(prj, st)] = specs['src']
+    fp_specs[(prj, 'pole')] = specs['pole']
+
+loaded = {}
+results = {}
+for key, df in iter_footprints(fp_specs):
+    loaded[key] = df
+    ready = [k for k in loaded if k[1] != 'pole' and (k[0], 'pole') in loaded]
+    for prj, st in ready:
+        src = prep_src_fp(loaded.pop((prj, st)), loaded[(prj, 'pole')], prj, st,
+                          max_date_diff=10)
+        determine_status(src, prj, released_ids=released[prj])
         src.to_pickle(os.path.join(prj_path, 'pkl', '{}_{}_status.pkl'.format(prj, st)))
-        results.append(src)
+        results[(prj, st)] = src
+results = [results[(prj, st)] for prj in projects for st in stereo_types]
         
 stereo = pd.concat(results, ignore_index=True)
 
@@ -0,0 +1,330 @@
+"""
+Raster based footprint density.
+
+Footprints are burned into an accumulating count raster with
+gdal.RasterizeLayer (MERGE_ALG=ADD), one batch of footprints at a time, so
+memory use depends on the raster size and batch size rather than on the
+number of footprint / grid cell intersections. Optionally the earliest and
+latest acquisition date over each pixel are tracked in two more rasters.
+Counts (and dates) for grid cells or points are then pulled from the rasters
+with a zonal reduction.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal, osr
+from pyproj import CRS
+
+from misc_utils.gdal_tools import gdf2ogr_mem
+from misc_utils.logging_utils import create_logger
+
+gdal.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Dates are stored as YYYYMMDD integers, 0 is nodata
+DATE_NODATA = 0
+# Number of raster rows to read at a time during zonal reductions
+BLOCK_ROWS = 1024
+
+
+def date2int(dates):
+    """Convert a Series of dates / date strings to YYYYMMDD integers."""
+    dates = pd.to_datetime(dates)
+    return (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype(np.int32)
+
+
+def int2date(values):
+    """Convert YYYYMMDD integers back to datetimes, 0 to NaT."""
+    values = pd.Series(values)
+    values = values.where(values != DATE_NODATA)
+    return pd.to_datetime(values.astype('Int64').astype(str), format='%Y%m%d',
+                          errors='coerce')
+
+
+def _date_raster_paths(out_path):
+    if not out_path:
+        return None, None
+    base, ext = os.path.splitext(out_path)
+    return '{}_date_min{}'.format(base, ext), '{}_date_max{}'.format(base, ext)
+
+
+class FootprintDensity:
+    """
+    Accumulating footprint count raster, with optional min/max date rasters.
+
+    Parameters
+    ----------
+    bounds : tuple
+        (minx, miny, maxx, maxy) of the area to compute density over, in the
+        units of crs. Snapped outward to multiples of res.
+    res : float
+        Pixel size, in units of crs.
+    crs : pyproj.CRS, str
+        CRS of the raster. Footprints are reprojected to this if needed.
+    out_path : str
+        Path to write the count raster to (GeoTIFF). Date rasters are
+        written beside it with _date_min / _date_max suffixes. If None, the
+        rasters are kept in memory.
+    date_col : str
+        Footprint column with acquisition dates. If provided, min and max
+        date rasters are tracked.
+    all_touched : bool
+        Count every pixel a footprint touches, rather than only pixels
+        whose centers fall within it.
+    """
+
+    def __init__(self, bounds, res, crs, out_path=None, date_col=None,
+                 all_touched=True):
+        minx, miny, maxx, maxy = bounds
+        self.res = res
+        self.crs = CRS.from_user_input(crs)
+        self.date_col = date_col
+        self.all_touched = all_touched
+        self.x0 = np.floor(minx / res) * res
+        self.y0 = np.ceil(maxy / res) * res
+        self.xsize = max(int(np.ceil((maxx - self.x0) / res)), 1)
+        self.ysize = max(int(np.ceil((self.y0 - miny) / res)), 1)
+        self.geotransform = (self.x0, res, 0, self.y0, 0, -res)
+        self.srs = osr.SpatialReference()
+        self.srs.ImportFromWkt(self.crs.to_wkt())
+        self.srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        logger.debug('Density raster size: {:,} x {:,}'.format(self.xsize, self.ysize))
+
+        self.count_ds = self._create(out_path, gdal.GDT_UInt32, nodata=None)
+        self.min_ds = None
+        self.max_ds = None
+        if date_col:
+            min_path, max_path = _date_raster_paths(out_path)
+            self.min_ds = self._create(min_path, gdal.GDT_Int32, nodata=DATE_NODATA)
+            self.max_ds = self._create(max_path, gdal.GDT_Int32, nodata=DATE_NODATA)
+
+    def _create(self, path, dtype, nodata=None, xsize=None, ysize=None,
+                geotransform=None):
+        if path:
+            driver = gdal.GetDriverByName('GTiff')
+            options = ['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+        else:
+            driver = gdal.GetDriverByName('MEM')
+            path = ''
+            options = []
+        ds = driver.Create(path, xsize if xsize else self.xsize,
+                           ysize if ysize else self.ysize, 1, dtype,
+                           options=options)
+        ds.SetGeoTransform(geotransform if geotransform else self.geotransform)
+        ds.SetProjection(self.srs.ExportToWkt())
+        band = ds.GetRasterBand(1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.Fill(nodata if nodata is not None else 0)
+
+        return ds
+
+    def _window(self, bounds):
+        """Pixel window (xoff, yoff, xsize, ysize) covering bounds."""
+        minx, miny, maxx, maxy = bounds
+        xoff = int(np.clip(np.floor((minx - self.x0) / self.res), 0, self.xsize))
+        yoff = int(np.clip(np.floor((self.y0 - maxy) / self.res), 0, self.ysize))
+        xend = int(np.clip(np.ceil((maxx - self.x0) / self.res), 0, self.xsize))
+        yend = int(np.clip(np.ceil((self.y0 - miny) / self.res), 0, self.ysize))
+
+        return xoff, yoff, xend - xoff, yend - yoff
+
+    def _burn_dates(self, geoms, dates, bounds):
+        """
+        Burn dates into the min and max date rasters over the window
+        covering bounds. Footprints are burned in date order so the last
+        value written to each pixel is the latest (or earliest) date, then
+        combined with the existing window.
+        """
+        xoff, yoff, xsize, ysize = self._window(bounds)
+        if xsize == 0 or ysize == 0:
+            return
+        win_gt = (self.x0 + xoff * self.res, self.res, 0,
+                  self.y0 - yoff * self.res, 0, -self.res)
+        options = ['ALL_TOUCHED=TRUE'] if self.all_touched else []
+        order = np.argsort(dates, kind='stable')
+        for ds, idx, combine in [(self.max_ds, order, np.maximum),
+                                 (self.min_ds, order[::-1], np.minimum)]:
+            win = self._create(None, gdal.GDT_Int32, nodata=DATE_NODATA,
+                               xsize=xsize, ysize=ysize, geotransform=win_gt)
+            _ogr_ds, lyr = gdf2ogr_mem(geoms[idx], srs=self.srs,
+                                       fields={'date': dates[idx]})
+            gdal.RasterizeLayer(win, [1], lyr,
+                                options=options + ['ATTRIBUTE=date'])
+            new = win.GetRasterBand(1).ReadAsArray()
+            band = ds.GetRasterBand(1)
+            existing = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            combined = np.where(existing == DATE_NODATA, new,
+                                np.where(new == DATE_NODATA, existing,
+                                         combine(existing, new)))
+            band.WriteArray(combined, xoff, yoff)
+
+    def add(self, fps, batch_size=10_000):
+        """
+        Burn footprints into the count (and date) rasters, batch_size
+        footprints at a time. Can be called repeatedly, e.g. with chunks
+        of footprints loaded from the database.
+        """
+        if len(fps) == 0:
+            return
+        if fps.crs != self.crs:
+            fps = fps.to_crs(self.crs)
+        options = ['MERGE_ALG=ADD']
+        if self.all_touched:
+            options.append('ALL_TOUCHED=TRUE')
+        for start in range(0, len(fps), batch_size):
+            batch = fps.iloc[start:start + batch_size]
+            logger.debug('Rasterizing footprints {:,} - {:,}'.format(start, start + len(batch)))
+            geoms = batch.geometry.values
+            _ogr_ds, lyr = gdf2ogr_mem(geoms, srs=self.srs)
+            gdal.RasterizeLayer(self.count_ds, [1], lyr, burn_values=[1],
+                                options=options)
+            if self.date_col:
+                dates = date2int(batch[self.date_col]).values
+                self._burn_dates(np.asarray(geoms), dates, batch.total_bounds)
+
+    def rasters(self):
+        """Returns {name: gdal.Dataset} of the tracked rasters."""
+        rasters = {'count': self.count_ds}
+        if self.date_col:
+            rasters['date_min'] = self.min_ds
+            rasters['date_max'] = self.max_ds
+        return rasters
+
+    def flush(self):
+        for ds in self.rasters().values():
+            ds.FlushCache()
+
+    def _sample_points(self, geoms):
+        """Values of each raster at points."""
+        xs = np.array([g.x for g in geoms])
+        ys = np.array([g.y for g in geoms])
+        cols = np.floor((xs - self.x0) / self.res).astype(np.int64)
+        rows = np.floor((self.y0 - ys) / self.res).astype(np.int64)
+        inside = (cols >= 0) & (cols < self.xsize) & (rows >= 0) & (rows < self.ysize)
+
+        out = {}
+        for name, ds in self.rasters().items():
+            fill = 0 if name == 'count' else DATE_NODATA
+            values = np.full(len(xs), fill, dtype=np.int64)
+            band = ds.GetRasterBand(1)
+            for r0 in range(0, self.ysize, BLOCK_ROWS):
+                nrows = min(BLOCK_ROWS, self.ysize - r0)
+                sel = inside & (rows >= r0) & (rows < r0 + nrows)
+                if not sel.any():
+                    continue
+                arr = band.ReadAsArray(0, r0, self.xsize, nrows)
+                values[sel] = arr[rows[sel] - r0, cols[sel]]
+            out[name] = values
+
+        return out
+
+    def _reduce_polygons(self, geoms, stat='max'):
+        """
+        Reduce each raster over polygons by rasterizing polygon labels on
+        the same grid and grouping pixel values by label, a block of rows at
+        a time.
+        """
+        labels_ds = self._create(None, gdal.GDT_Int32, nodata=0)
+        _ogr_ds, lyr = gdf2ogr_mem(geoms, srs=self.srs,
+                                   fields={'label': np.arange(1, len(geoms) + 1)})
+        gdal.RasterizeLayer(labels_ds, [1], lyr, options=['ATTRIBUTE=label'])
+        labels_band = labels_ds.GetRasterBand(1)
+
+        reducers = {'count': stat, 'date_min': 'min', 'date_max': 'max'}
+        partials = {name: [] for name in self.rasters()}
+        for r0 in range(0, self.ysize, BLOCK_ROWS):
+            nrows = min(BLOCK_ROWS, self.ysize - r0)
+            labels = labels_band.ReadAsArray(0, r0, self.xsize, nrows).ravel()
+            has_label = labels > 0
+            if not has_label.any():
+                continue
+            labels = labels[has_label]
+            for name, ds in self.rasters().items():
+                values = ds.GetRasterBand(1).ReadAsArray(0, r0, self.xsize, nrows).ravel()[has_label]
+                s = pd.Series(values)
+                if name != 'count':
+                    s = s.where(s != DATE_NODATA)
+                if reducers[name] == 'mean':
+                    # Keep sum and count so partial means combine exactly
+                    gb = s.groupby(labels).agg(['sum', 'count'])
+                else:
+                    gb = s.groupby(labels).agg(reducers[name])
+                partials[name].append(gb)
+
+        out = {}
+        for name, parts in partials.items():
+            if not parts:
+                out[name] = pd.Series(np.nan, index=np.arange(1, len(geoms) + 1))
+                continue
+            combined = pd.concat(parts)
+            if reducers[name] == 'mean':
+                combined = combined.groupby(level=0).sum()
+                combined = combined['sum'] / combined['count']
+            else:
+                combined = combined.groupby(level=0).agg(reducers[name])
+            out[name] = combined.reindex(np.arange(1, len(geoms) + 1))
+
+        return out
+
+    def zonal(self, grid, stat='max'):
+        """
+        Attach counts (and dates) from the rasters to each feature of grid.
+        Points take the value of the pixel they fall in. Polygons take the
+        stat ('max', 'mean' or 'sum') of counts over the pixels they cover,
+        and the min / max of the date rasters.
+
+        Returns
+        -------
+        gpd.GeoDataFrame : grid with 'count' (and (date_col, 'min'),
+                           (date_col, 'max')) columns, matching get_count.
+        """
+        self.flush()
+        if grid.crs != self.crs:
+            grid_r = grid.to_crs(self.crs)
+        else:
+            grid_r = grid
+        geoms = grid_r.geometry.values
+        if len(grid_r) > 0 and all(g.geom_type == 'Point' for g in geoms):
+            values = self._sample_points(geoms)
+            values = {k: pd.Series(v, index=grid.index) for k, v in values.items()}
+        else:
+            values = self._reduce_polygons(geoms, stat=stat)
+            values = {k: pd.Series(v.values, index=grid.index) for k, v in values.items()}
+
+        out = grid.copy()
+        out['count'] = values['count']
+        if self.date_col:
+            out[(self.date_col, 'min')] = int2date(values['date_min']).values
+            out[(self.date_col, 'max')] = int2date(values['date_max']).values
+
+        return out
+
+
+def footprint_density(fps, res, bounds=None, crs=None, out_path=None,
+                      date_col=None, batch_size=10_000, all_touched=True):
+    """
+    Build a FootprintDensity from a GeoDataFrame of footprints.
+
+    Parameters
+    ----------
+    fps : gpd.GeoDataFrame
+        Footprints to count.
+    res : float
+        Pixel size, in units of crs.
+    bounds : tuple
+        Extent of the density raster, defaults to the extent of fps.
+    crs : pyproj.CRS, str
+        CRS of the density raster, defaults to fps.crs.
+    """
+    crs = crs if crs else fps.crs
+    if bounds is None:
+        bounds = fps.to_crs(crs).total_bounds if fps.crs != crs else fps.total_bounds
+    density = FootprintDensity(bounds, res, crs, out_path=out_path,
+                               date_col=date_col, all_touched=all_touched)
+    density.add(fps, batch_size=batch_size)
+    density.flush()
+
+    return density
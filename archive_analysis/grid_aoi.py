@@ -9,7 +9,7 @@ Created on Tue Jan 21 15:35:32 2020
 import argparse
 import os
 
-from archive_analysis_utils import grid_aoi
+from archive_analysis_utils import iter_grid_aoi
 from misc_utils.logging_utils import create_logger
 
 
@@ -36,6 +36,11 @@ if __name__ == '__main__':
     parser.add_argument('--poly', action='store_true',
                         help='Output the resulting grid as a polygon, rather '
                              'than the default points.')
+    parser.add_argument('--method', choices=['prepared', 'raster'], default='prepared',
+                        help='Test grid nodes against the AOI geometry, or against '
+                             'a rasterized mask of the AOI.')
+    parser.add_argument('--band_rows', type=int,
+                        help='Number of rows of the grid to create and write at a time.')
 
     args = parser.parse_args()
     
@@ -46,13 +51,20 @@ if __name__ == '__main__':
     x_space = args.x_space
     y_space = args.y_space
     poly = args.poly
+    method = args.method
+    band_rows = args.band_rows
 
     logger.info('Creating grid...')
-    grid = grid_aoi(aoi, n_pts_x=n_pts_x, n_pts_y=n_pts_y,
-                    x_space=x_space, y_space=y_space,
-                    poly=poly)
-    
-    logger.info('Grid size: {:,}'.format(len(grid)))
     logger.info('Writing grid to file: {}'.format(out_path))
+    # Write each band of rows as it is created, so the full grid is never
+    # held in memory
+    grid_size = 0
+    for band in iter_grid_aoi(aoi, n_pts_x=n_pts_x, n_pts_y=n_pts_y,
+                              x_space=x_space, y_space=y_space,
+                              poly=poly, method=method, band_rows=band_rows):
+        if len(band) == 0:
+            continue
+        band.to_file(out_path, mode='a' if grid_size else 'w')
+        grid_size += len(band)
 
-    grid.to_file(out_path)
+    logger.info('Grid size: {:,}'.format(grid_size))
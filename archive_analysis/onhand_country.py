@@ -15,6 +15,7 @@ from query_danco import query_footprint
 from logging_utils import create_logger
 from danco_table_summary import summarize_danco_fp
 from id_parse_utils import write_ids
+from misc_utils.spatial_partition import lonlat_where
 
 # INPUTS
 country_name = 'United States'
@@ -41,51 +42,11 @@ country = all_countries[all_countries[NAME]==country_name]
 logger.info('Loaded country: {}'.format(country_name))
 
 
-# Load IDs in the rough area of country
-min_x, min_y, max_x, max_y = country.total_bounds
+# Load IDs in the rough area of country. Country parts are split at the
+# 180 longitude line, and parts on either side queried separately, as the
+# total bounds of countries that wrap it would load most footprints.
 pad = 1
-min_x = min_x - pad
-min_y = min_y - pad
-max_x = max_x + pad
-max_y = max_y + pad
-# Check that min_x and max_x don't wrap the 180 longitude line,
-# which would result in massive loading of footprints
-if abs(max_x - min_x) > 200:
-    # Eastern hemisphere
-    max_xs = list(country.bounds.maxx)
-    max_x_gtr = [x for x in max_xs if x < 180 and x > 0]
-    max_x_gtr.sort()
-    max_x_gtr = max_x_gtr[-1]
-    
-    min_xs = list(country.bounds.minx)
-    min_x_gtr = [x for x in min_xs if x < 180 and x > 0]
-    min_x_gtr.sort()
-    min_x_gtr = min_x_gtr[0]
-    
-    # Western hemisphere
-    max_x_ls = [x for x in max_xs if x > -180 and x < 0]
-    max_x_ls.sort()
-    max_x_ls = max_x_ls[-1]
-    
-    min_x_ls = [x for x in min_xs if x > -180 and x < 0]
-    min_x_ls.sort()
-    min_x_ls = min_x_ls[0]
-    
-    # Eastern longitude where    
-    where = """({0} > {1} AND {0} < {2})""".format(LON_FLD, min_x_gtr-pad, max_x_gtr+pad)
-    # Western longitude where
-    where += """ OR ({0} > {1} AND {0} < {2})""".format(LON_FLD, min_x_ls-pad, max_x_ls+pad)
-    where = '({})'.format(where)
-    # Latitude
-    where += """ AND ({0} > {1} AND {0} < {2})""".format(LAT_FLD, min_y-pad, max_y+pad)
-    
-else:
-    where = """{0} > {2} and 
-           {1} > {3} and 
-           {0} < {4} and 
-           {1} < {5}""".format(LON_FLD, LAT_FLD,
-                               min_x, min_y, 
-                               max_x, max_y)
+where = lonlat_where(country.geometry, lon_fld=LON_FLD, lat_fld=LAT_FLD, pad=pad)
 
 
 logger.debug('Using country bounds to load initial footprints...\n{}'.format(where))
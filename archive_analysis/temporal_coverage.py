@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Temporal coverage statistics of footprints over grid points.
+
+Footprints are streamed in date order, in chunks, into per-point
+accumulators of first / last acquisition, count, revisit intervals and a
+histogram of acquisitions by month or season. Only the (point, footprint)
+pairs of the current chunk are held in memory, rather than the full
+point x footprint join. Points are split into square tiles that are
+processed in parallel.
+"""
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from misc_utils.logging_utils import create_logger
+
+try:
+    # Bulk spatial index queries returning integer indices, shapely >= 2.0
+    from shapely import STRtree
+except ImportError:
+    STRtree = None
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Sentinels for points with no acquisitions, dates are days since epoch
+NO_FIRST = np.iinfo(np.int64).max
+NO_LAST = np.iinfo(np.int64).min
+
+SEASONS = ['DJF', 'MAM', 'JJA', 'SON']
+MONTHS = ['m{:02d}'.format(m) for m in range(1, 13)]
+# Month index (0-11) to season index
+MONTH_SEASON = np.array([0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0])
+
+
+class TemporalAccumulator:
+    """
+    Per-point running statistics of acquisition dates. Dates must be added
+    in ascending order across calls to update.
+
+    Revisit intervals are the days between consecutive distinct
+    acquisition dates at a point, so footprints acquired on the same day
+    count as one visit.
+
+    Parameters
+    ----------
+    n_pts : int
+        Number of points.
+    hist : str
+        'month' or 'season', the bins of the acquisition histogram.
+    """
+
+    def __init__(self, n_pts, hist='month'):
+        self.n_pts = n_pts
+        self.hist_bins = MONTHS if hist == 'month' else SEASONS
+        self.count = np.zeros(n_pts, dtype=np.int64)
+        self.first = np.full(n_pts, NO_FIRST, dtype=np.int64)
+        self.last = np.full(n_pts, NO_LAST, dtype=np.int64)
+        self.n_revisits = np.zeros(n_pts, dtype=np.int64)
+        self.revisit_sum = np.zeros(n_pts, dtype=np.float64)
+        self.revisit_sumsq = np.zeros(n_pts, dtype=np.float64)
+        self.revisit_min = np.full(n_pts, NO_FIRST, dtype=np.int64)
+        self.revisit_max = np.zeros(n_pts, dtype=np.int64)
+        self.hist = np.zeros((n_pts, len(self.hist_bins)), dtype=np.int64)
+
+    def update(self, pt_idx, days, bins):
+        """
+        Add acquisitions.
+
+        Parameters
+        ----------
+        pt_idx : np.ndarray
+            Point of each acquisition.
+        days : np.ndarray
+            Date of each acquisition, as days since epoch. Must not be
+            earlier than any date already added.
+        bins : np.ndarray
+            Histogram bin of each acquisition.
+        """
+        if len(pt_idx) == 0:
+            return
+        order = np.lexsort((days, pt_idx))
+        p = pt_idx[order]
+        d = days[order]
+
+        # Previous acquisition of each point - from this chunk, or the
+        # last acquisition of earlier chunks for the first in each group
+        prev = np.empty_like(d)
+        prev[1:] = d[:-1]
+        group_start = np.ones(len(p), dtype=bool)
+        group_start[1:] = p[1:] != p[:-1]
+        prev[group_start] = self.last[p[group_start]]
+        has_prev = ~group_start | (self.count[p] > 0)
+        gaps = d - prev
+        revisit = has_prev & (gaps > 0)
+        rp = p[revisit]
+        rg = gaps[revisit]
+
+        self.count += np.bincount(p, minlength=self.n_pts)
+        np.minimum.at(self.first, p, d)
+        np.maximum.at(self.last, p, d)
+        self.n_revisits += np.bincount(rp, minlength=self.n_pts)
+        self.revisit_sum += np.bincount(rp, weights=rg, minlength=self.n_pts)
+        self.revisit_sumsq += np.bincount(rp, weights=rg.astype(np.float64)**2,
+                                          minlength=self.n_pts)
+        np.minimum.at(self.revisit_min, rp, rg)
+        np.maximum.at(self.revisit_max, rp, rg)
+        np.add.at(self.hist, (p, bins[order]), 1)
+
+    def to_frame(self, index=None):
+        """
+        Return statistics as a DataFrame, one row per point. Dates are
+        datetime64 and revisit statistics are in days, both null for points
+        without acquisitions / revisits.
+        """
+        has = self.count > 0
+        has_rev = self.n_revisits > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(has_rev, self.revisit_sum / self.n_revisits, np.nan)
+            var = np.where(has_rev, self.revisit_sumsq / self.n_revisits - mean**2, np.nan)
+        stats = pd.DataFrame({
+            'date_min': pd.to_datetime(np.where(has, self.first, 0), unit='D'),
+            'date_max': pd.to_datetime(np.where(has, self.last, 0), unit='D'),
+            'count': self.count,
+            'revisit_mean': mean,
+            'revisit_std': np.sqrt(np.clip(var, 0, None)),
+            'revisit_min': np.where(has_rev, self.revisit_min, np.nan),
+            'revisit_max': np.where(has_rev, self.revisit_max, np.nan),
+        }, index=index)
+        stats.loc[~has, ['date_min', 'date_max']] = pd.NaT
+        hist = pd.DataFrame(self.hist, columns=self.hist_bins, index=index)
+
+        return pd.concat([stats, hist], axis=1)
+
+
+def _to_days(dates):
+    return pd.to_datetime(dates).values.astype('datetime64[D]').astype(np.int64)
+
+
+def _hist_bins(dates, hist='month'):
+    months = pd.to_datetime(dates).dt.month.values - 1
+    if hist == 'month':
+        return months
+    return MONTH_SEASON[months]
+
+
+def _point_pairs(pts_geoms, fps_geoms, tree=None):
+    """Return (footprint, point) positional index pairs that intersect."""
+    if tree is not None:
+        fp_idx, pt_idx = tree.query(np.asarray(fps_geoms), predicate='intersects')
+        return fp_idx, pt_idx
+    # geopandas spatial join is backed by an rtree index
+    sj = gpd.sjoin(gpd.GeoDataFrame(geometry=list(fps_geoms)),
+                   gpd.GeoDataFrame(geometry=list(pts_geoms)),
+                   how='inner')
+    return sj.index.values, sj['index_right'].values
+
+
+def _tile_coverage(pts_geoms, fps, date_col, chunk_size=50_000, hist='month'):
+    """Temporal statistics for one tile of points, footprints sorted by date."""
+    acc = TemporalAccumulator(len(pts_geoms), hist=hist)
+    tree = STRtree(np.asarray(pts_geoms)) if STRtree is not None else None
+    for start in range(0, len(fps), chunk_size):
+        chunk = fps.iloc[start:start + chunk_size]
+        fp_idx, pt_idx = _point_pairs(pts_geoms, chunk.geometry.values, tree=tree)
+        days = _to_days(chunk[date_col]).astype(np.int64)
+        bins = _hist_bins(chunk[date_col], hist=hist)
+        acc.update(pt_idx, days[fp_idx], bins[fp_idx])
+
+    return acc.to_frame()
+
+
+def _tile_ids(pts, tile_size):
+    """Assign each point to a square tile of side tile_size."""
+    xs = pts.geometry.x.values
+    ys = pts.geometry.y.values
+    minx, miny = xs.min(), ys.min()
+    tx = np.floor((xs - minx) / tile_size).astype(np.int64)
+    ty = np.floor((ys - miny) / tile_size).astype(np.int64)
+
+    return tx * (ty.max() + 1) + ty
+
+
+def temporal_coverage(pts, fps, date_col, tile_size=None, chunk_size=50_000,
+                      hist='month', n_jobs=None):
+    """
+    Compute first / last acquisition, count, revisit interval statistics
+    and a histogram of acquisitions by month or season of fps over each
+    point in pts.
+
+    Parameters
+    ----------
+    pts : gpd.GeoDataFrame
+        Points of interest.
+    fps : gpd.GeoDataFrame
+        Footprints.
+    date_col : str
+        Date column in fps.
+    tile_size : float
+        Side of the square tiles points are split into for parallel
+        processing, in units of the pts crs. By default points are split
+        into about 4 tiles per job.
+    chunk_size : int
+        Number of footprints to join to points at a time.
+    hist : str
+        'month' or 'season' (DJF, MAM, JJA, SON) histogram bins.
+    n_jobs : int
+        Number of processes, defaults to all but two cores.
+
+    Returns
+    -------
+    gpd.GeoDataFrame : pts with statistics columns:
+        date_min, date_max, count, revisit_mean, revisit_std,
+        revisit_min, revisit_max (days) and histogram bin counts.
+    """
+    if pts.crs != fps.crs:
+        logger.info('Converting crs of footprints to match points...')
+        fps = fps.to_crs(pts.crs)
+    fps = fps.loc[fps[date_col].notna(), [date_col, 'geometry']]
+    fps = fps.assign(**{date_col: pd.to_datetime(fps[date_col])}).sort_values(by=date_col)
+
+    n_jobs = n_jobs if n_jobs else max(multiprocessing.cpu_count() - 2, 1)
+    if len(pts) == 0:
+        tiles = np.array([], dtype=np.int64)
+    elif tile_size:
+        tiles = _tile_ids(pts, tile_size)
+    else:
+        minx, miny, maxx, maxy = pts.total_bounds
+        n_side = int(np.ceil(np.sqrt(n_jobs * 4)))
+        tile_size = max(maxx - minx, maxy - miny) / n_side
+        tiles = _tile_ids(pts, tile_size) if tile_size > 0 else np.zeros(len(pts), dtype=np.int64)
+    tile_pos = pd.Series(np.arange(len(pts))).groupby(tiles).apply(np.asarray)
+    logger.info('Computing temporal coverage over {:,} tiles...'.format(len(tile_pos)))
+
+    def tile_fps(pos):
+        # Footprints over the bounding box of the tile's points
+        minx, miny, maxx, maxy = pts.geometry.iloc[pos].total_bounds
+        return fps.cx[minx:maxx, miny:maxy]
+
+    results = Parallel(n_jobs=min(n_jobs, max(len(tile_pos), 1)))(
+        delayed(_tile_coverage)(pts.geometry.values[pos], tile_fps(pos), date_col,
+                                chunk_size=chunk_size, hist=hist)
+        for pos in tqdm(tile_pos.values, desc='Tiles'))
+
+    if results:
+        stats = pd.concat(results, ignore_index=True)
+        stats.index = np.concatenate(tile_pos.values)
+        stats = stats.sort_index()
+    else:
+        stats = TemporalAccumulator(0, hist=hist).to_frame()
+    stats.index = pts.index
+    out = pd.concat([pts, stats], axis=1)
+
+    return gpd.GeoDataFrame(out, geometry='geometry', crs=pts.crs)
@@ -8,12 +8,12 @@ import argparse
 import os
 import ntpath
 import platform
-import shutil
 
 import pandas as pd
 import geopandas as gpd
 from tqdm import tqdm
 
+from misc_utils.copy_engine import copy_files
 from misc_utils.logging_utils import create_logger
 # from dem_utils import get_filepath_field, get_dem_path
 from dem_utils import get_filepath_field, get_dem_path
@@ -90,18 +90,22 @@ def create_copy_list(dem_paths, dest_parent_dir, meta_file_sfx, flat=False):
                 meta_files.append(mf)
             else:
                 logger.debug('Missing metadata file: {}'.format(mf))
-        if not os.path.exists(os.path.join(dst_dir, os.path.basename(dem))):
-            copy_list.append((dem, dst_dir))
-        copy_list.extend([(mf, dst_dir) for mf in meta_files
-                          if not os.path.exists(os.path.join(dst_dir, os.path.basename(mf)))])
+        # Files already at the destination are skipped when copying
+        copy_list.append((dem, dst_dir))
+        copy_list.extend([(mf, dst_dir) for mf in meta_files])
 
     return copy_list
 
 
 def copy_dems(footprint_path, output_directory, location=None,
               dems_only=False, skip_ortho=False,
-              flat=False, use_symlinks=True, dryrun=False):
-    """Copy DEMs and metadata files given a footprint with paths and output directory."""
+              flat=False, use_symlinks=True, dryrun=False,
+              threads=4, manifest_path=None):
+    """
+    Copy DEMs and metadata files given a footprint with paths and output directory.
+    Files are copied concurrently by threads, resuming from manifest_path
+    (json) if given, see misc_utils.copy_engine.copy_files.
+    """
     if dems_only:
         logger.debug('Copying DEMs only.')
         meta_file_sfx = []
@@ -134,32 +138,13 @@ def copy_dems(footprint_path, output_directory, location=None,
     logger.info('Located DEMs to copy: {:,}'.format(len(dem_src_list)))
 
     total_src_dems = len(dem_src_list)
-    remaining_dems = total_src_dems
-    pbar = tqdm(copy_list, desc='Remaining DEMs: {:,}'.format(remaining_dems))
-    for src, dst in pbar:
-        try:
-            if not dryrun:
-                pbar.write('Copying: {}'.format(os.path.basename(src)))
-                if not os.path.exists(dst):
-                    os.makedirs(dst)
-                dst_file = os.path.join(dst, os.path.basename(src))
-                if not os.path.exists(dst_file):
-                    if platform.system() == 'Windows' or not use_symlinks:
-                        shutil.copy2(src, dst)
-                    elif platform.system() == 'Linux' and use_symlinks:
-                        os.symlink(src, dst)
-                else:
-                    pbar.write('Skipping (exists): {}'.format(dst_file))
-                pbar.set_description('Remaining DEMs: {:,}'.format(remaining_dems))
-            # else:
-            #     pbar.write('[DRYRUN] Copying: {}'.format(src))
-        except Exception as e:
-            logger.warning('Failed to copy: {}'.format(src))
-            logger.error(e)
-        finally:
-            if src.endswith('dem.tif'):
-                remaining_dems -= 1
-                pbar.set_description('Remaining DEMs: {:,}'.format(remaining_dems))
+    if platform.system() == 'Linux' and use_symlinks:
+        method = 'symlink'
+    else:
+        method = 'copy'
+    pairs = [(src, os.path.join(dst, os.path.basename(src))) for src, dst in copy_list]
+    copy_files(pairs, manifest_path=manifest_path, threads=threads,
+               method=method, dryrun=dryrun)
 
     copied_dems = [d for d in dem_dst_list if os.path.exists(d)]
     num_copied_dems = len(copied_dems)
@@ -191,6 +176,10 @@ if __name__ == '__main__':
                         help='Use to check for DEMs existence but do not copy.')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Set logger to DEBUG.')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='Number of files to copy concurrently.')
+    parser.add_argument('-m', '--manifest', type=os.path.abspath,
+                        help='json manifest of copied files, to resume from.')
 
     import sys
     sys.argv = [r'C:\code\pgc-code-all\dem_utils\copy_dems.py',
@@ -214,4 +203,5 @@ if __name__ == '__main__':
 
     copy_dems(footprint_path, output_directory, location=location_field,
               dems_only=dems_only, skip_ortho=skip_ortho,
-              flat=flat, use_symlinks=use_symlinks, dryrun=dryrun)
+              flat=flat, use_symlinks=use_symlinks, dryrun=dryrun,
+              threads=args.threads, manifest_path=args.manifest)
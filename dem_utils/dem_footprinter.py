@@ -6,15 +6,24 @@ Created on Wed Feb 26 11:39:46 2020
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging.config
 import os
 import glob
+import threading
 
+import numpy as np
+import pandas as pd
 import geopandas as gpd
+from osgeo import gdal, ogr, osr
+from shapely import wkb, wkt
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
 from tqdm import tqdm
 
+from misc_utils.gdal_tools import valid_pixels
 from misc_utils.logging_utils import LOGGING_CONFIG
-from misc_utils.RasterWrapper import Raster
 
 
 #### Set up logging
@@ -22,11 +31,148 @@ handler_level = 'DEBUG'
 logging.config.dictConfig(LOGGING_CONFIG(handler_level))
 logger = logging.getLogger(__name__)
 
+# Footprints already computed, keyed on (path, outline), with the mtime
+# and size of the raster they were computed from
+_FOOTPRINTS = {}
+_FOOTPRINTS_LOCK = threading.Lock()
+
 
 # cmd = """gdaltindex {} {}""".format(index_name, matches_str)
 # run_subprocess(cmd)
- 
-def raster_footprints(rasters):
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+
+def bbox_footprint(gt, x_sz, y_sz):
+    """Polygon of the corners of a raster, from its geotransform."""
+    corners = [(0, 0), (x_sz, 0), (x_sz, y_sz), (0, y_sz)]
+    return Polygon([(gt[0] + c * gt[1] + r * gt[2], gt[3] + c * gt[4] + r * gt[5])
+                    for c, r in corners])
+
+
+def outline_footprint(ds, gt, band=1, max_size=1024):
+    """
+    Outline of the valid data of a raster, polygonized from a mask read
+    at reduced resolution (using overviews where present).
+
+    Parameters
+    ----------
+    ds : gdal.Dataset
+    gt : tuple
+        Geotransform of ds.
+    band : int
+    max_size : int
+        Longest side of the decimated mask, in pixels.
+
+    Returns
+    -------
+    shapely geometry, or None if there is no valid data.
+    """
+    x_sz, y_sz = ds.RasterXSize, ds.RasterYSize
+    factor = max(x_sz / max_size, y_sz / max_size, 1)
+    cols, rows = max(int(x_sz / factor), 1), max(int(y_sz / factor), 1)
+    rb = ds.GetRasterBand(band)
+    arr = rb.ReadAsArray(buf_xsize=cols, buf_ysize=rows)
+    mask = valid_pixels(arr, rb.GetNoDataValue()).astype(np.uint8)
+    if not mask.any():
+        return None
+
+    mask_gt = (gt[0], gt[1] * x_sz / cols, gt[2] * y_sz / rows,
+               gt[3], gt[4] * x_sz / cols, gt[5] * y_sz / rows)
+    mask_ds = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform(mask_gt)
+    mask_ds.GetRasterBand(1).WriteArray(mask)
+    vec_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    lyr = vec_ds.CreateLayer('outline')
+    lyr.CreateField(ogr.FieldDefn('valid', ogr.OFTInteger))
+    mask_band = mask_ds.GetRasterBand(1)
+    gdal.Polygonize(mask_band, mask_band, lyr, 0, [])
+    geoms = [wkb.loads(bytes(feat.GetGeometryRef().ExportToWkb())) for feat in lyr]
+    mask_ds = None
+    vec_ds = None
+
+    return unary_union(geoms)
+
+
+def _cache_key(path, outline, band, max_size):
+    # band and max_size only change outline footprints
+    if not outline:
+        band, max_size = None, None
+    return os.path.abspath(path), outline, band, max_size
+
+
+def raster_footprint(path, outline=False, band=1, max_size=1024):
+    """
+    Footprint of a single raster, reading only its metadata, or with
+    outline a decimated mask of its valid data. Results are cached on
+    path (and band and max_size, with outline), until the raster's
+    modification time or size changes.
+
+    Returns
+    -------
+    dict : location, crs (wkt), x_sz, y_sz, res_x, res_y, geometry
+    """
+    key = _cache_key(path, outline, band, max_size)
+    stamp = _stamp(path)
+    with _FOOTPRINTS_LOCK:
+        cached = _FOOTPRINTS.get(key)
+    if cached is not None and cached[0] == stamp:
+        # Cached under the absolute path, return path as given
+        return dict(cached[1], location=path)
+
+    ds = gdal.Open(path)
+    gt = ds.GetGeoTransform()
+    x_sz, y_sz = ds.RasterXSize, ds.RasterYSize
+    geom = bbox_footprint(gt, x_sz, y_sz)
+    if outline:
+        geom = outline_footprint(ds, gt, band=band, max_size=max_size)
+    record = {'location': path,
+              'crs': ds.GetProjection(),
+              'x_sz': x_sz,
+              'y_sz': y_sz,
+              'res_x': gt[1],
+              'res_y': abs(gt[5]),
+              'geometry': geom}
+    ds = None
+
+    with _FOOTPRINTS_LOCK:
+        _FOOTPRINTS[key] = (stamp, record)
+
+    return record
+
+
+def load_cache(cache_path):
+    """Load footprints saved by save_cache into the footprint cache."""
+    if not cache_path or not os.path.exists(cache_path):
+        return
+    with open(cache_path, 'r') as src:
+        entries = json.load(src)
+    with _FOOTPRINTS_LOCK:
+        for e in entries:
+            record = dict(e['record'])
+            record['geometry'] = wkt.loads(record['geometry']) if record['geometry'] else None
+            key = _cache_key(e['path'], e['outline'], e['band'], e['max_size'])
+            _FOOTPRINTS[key] = (tuple(e['stamp']), record)
+    logger.debug('Loaded cached footprints: {:,}'.format(len(entries)))
+
+
+def save_cache(cache_path):
+    """Save the footprint cache to a json file."""
+    with _FOOTPRINTS_LOCK:
+        entries = [{'path': path, 'outline': outline, 'band': band,
+                    'max_size': max_size, 'stamp': list(stamp),
+                    'record': dict(record, geometry=record['geometry'].wkt
+                                   if record['geometry'] is not None else None)}
+                   for (path, outline, band, max_size), (stamp, record)
+                   in _FOOTPRINTS.items()]
+    with open(cache_path, 'w') as dst:
+        json.dump(entries, dst)
+
+
+def raster_footprints(rasters, outline=False, band=1, max_size=1024,
+                      threads=8, cache_path=None):
     """
     Takes a list of rasters and create a gpd.GeoDataFrame of their footprints and file locations.
 
@@ -34,26 +180,63 @@ def raster_footprints(rasters):
     ----------
     rasters : LIST
         List of raster file paths.
+    outline : bool
+        Footprint the valid data of each raster, rather than its bounds.
+    band : int
+        Band used for the valid data outline.
+    max_size : int
+        Longest side of the decimated valid data mask, in pixels.
+    threads : int
+        Number of rasters read concurrently.
+    cache_path : str
+        json file of footprints from previous runs. Rasters that have not
+        been modified since are not read again. Updated with the results.
 
     Returns
     -------
     gpd.GeoDataFrame.
 
     """
+    load_cache(cache_path)
     logger.info('Iterating over rasters...')
-    df = gpd.GeoDataFrame(columns=['location','geometry'])
-    for fname in tqdm(rasters):
-        r = Raster(fname)
-        bbox = r.raster_bbox()
-        df = df.append({'location':fname, 'geometry': bbox}, ignore_index=True)
-    
-    # Set crs of dataframe to the last raster -- this assumes they are all the same
-    df.crs = r.prj.wkt
-    
-    return df
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        records = list(tqdm(executor.map(lambda r: raster_footprint(r, outline=outline,
+                                                                    band=band,
+                                                                    max_size=max_size),
+                                         rasters),
+                            total=len(rasters)))
+    if cache_path:
+        save_cache(cache_path)
+
+    cols = ['location', 'x_sz', 'y_sz', 'res_x', 'res_y', 'geometry']
+    if not records:
+        return gpd.GeoDataFrame(columns=cols, geometry='geometry')
 
+    # Build the footprints of each crs at once, in the crs of the first raster
+    crs = records[0]['crs']
+    frames = []
+    for rec_crs in dict.fromkeys(r['crs'] for r in records):
+        group = [r for r in records if r['crs'] == rec_crs]
+        gdf = gpd.GeoDataFrame({c: [r[c] for r in group] for c in cols},
+                               geometry='geometry', crs=rec_crs)
+        if rec_crs != crs:
+            same = osr.SpatialReference(wkt=rec_crs).IsSame(osr.SpatialReference(wkt=crs))
+            if same:
+                gdf.crs = crs
+            else:
+                gdf = gdf.to_crs(crs)
+        frames.append(gdf)
+    if len(frames) == 1:
+        return frames[0]
+    df = gpd.GeoDataFrame(pd.concat(frames), geometry='geometry', crs=crs)
+    # Original order of rasters
+    df = df.set_index('location', drop=False).loc[[r['location'] for r in records]]
 
-def main(directory, out_footprint, pattern='\*.tif', dryrun=False):
+    return df.reset_index(drop=True)
+
+
+def main(directory, out_footprint, pattern='\*.tif', dryrun=False,
+         outline=False, threads=8, cache_path=None):
     # Find files that match the given pattern    
     full_pattern = directory + pattern
     matches = glob.glob(full_pattern)
@@ -61,7 +244,8 @@ def main(directory, out_footprint, pattern='\*.tif', dryrun=False):
     
     # Create dataframe of footprints
     if not dryrun:
-        df = raster_footprints(matches)
+        df = raster_footprints(matches, outline=outline, threads=threads,
+                               cache_path=cache_path)
     
         logger.info('Writing index to file...')
         df.to_file(out_footprint)
@@ -88,7 +272,17 @@ if __name__ == '__main__':
     
     parser.add_argument('--dryrun', action='store_true',
                         help='Find matches only.')
+
+    parser.add_argument('--outline', action='store_true',
+                        help='Footprint the valid data of rasters rather than their bounds.')
+
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Number of rasters to read concurrently.')
+
+    parser.add_argument('--cache', type=os.path.abspath,
+                        help='json file of footprints to reuse for unmodified rasters.')
     
     args = parser.parse_args()
     
-    main(args.input_directory, args.out_footprint, args.pattern, args.dryrun)
\ No newline at end of file
+    main(args.input_directory, args.out_footprint, args.pattern, args.dryrun,
+         outline=args.outline, threads=args.threads, cache_path=args.cache)
\ No newline at end of file
@@ -17,9 +17,8 @@ import geopandas as gpd
 from shapely.geometry import Point
 
 
-from misc_utils.RasterWrapper import Raster
 from misc_utils.logging_utils import create_logger, LOGGING_CONFIG
-from misc_utils.gdal_tools import clip_minbb
+from misc_utils.gdal_tools import align_rasters, iter_blocks, unlink_rasters
 
 
 logger = create_logger(__name__, 'sh', 'DEBUG')
@@ -30,64 +29,79 @@ logger = create_logger(__name__, 'sh', 'DEBUG')
 
 # TODO: Add support for saving image/tif of raw differences
 
-def dem_rmse(dem1_path, dem2_path, max_diff=None, outfile=None, out_diff=None, plot=False,
-             show_plot=False, save_plot=None, bins=10, log_scale=True):
-    # Load DEMs as arrays
-    logger.info('Loading DEMs...')
-    dem1 = Raster(dem1_path)
-    dem2 = Raster(dem2_path)
-
-    if dem1.geotransform != dem2.geotransform:
-        logger.warning('''DEM geotransforms do not match. 
-                          Clipping to minimum bounding box in memory....''')
-        dem1 = None
-        dem2 = None
-        clipped = clip_minbb(rasters=[dem1_path, dem2_path],
-                             in_mem=True,
-                             out_format='vrt')
-        logger.debug('Clipping complete. Reloading DEMs...')
-        dem1 = Raster(clipped[0])
-        arr1 = dem1.MaskedArray
-        dem1 = None
-        logger.debug('DEM1 loaded and array extracted...')
-        dem2 = Raster(clipped[1])
-        arr2 = dem2.MaskedArray
-        dem2 = None
-        logger.debug('DEM2 loaded and array extracted...')
-    else:
-        arr1 = dem1.MaskedArray
-        dem1 = None
-        arr2 = dem2.MaskedArray
-        dem2 = None
+def _block_diffs(rasters, max_diff=None, block_rows=1024):
+    """Yield valid differences of two aligned rasters, one block at a time,
+    and the number of valid differences before removing those over
+    max_diff."""
+    for _yoff, (arr1, arr2) in iter_blocks(rasters, block_rows=block_rows):
+        diffs = (arr1.astype(np.float64) - arr2).compressed()
+        n_uncleaned = diffs.size
+        if max_diff:
+            diffs = diffs[abs(diffs) < max_diff]
+        yield diffs, n_uncleaned
+
 
+def dem_rmse(dem1_path, dem2_path, max_diff=None, outfile=None, out_diff=None, plot=False,
+             show_plot=False, save_plot=None, bins=10, log_scale=True,
+             block_rows=1024):
+    """
+    RMSE of the differences of two DEMs over their overlap.
+
+    DEMs with different resolutions or origins are resampled onto the
+    coarsest grid with cubic resampling (see gdal_tools.align_rasters).
+    Previously each DEM was clipped with a projWin on its own grid
+    (nearest pixel).
+    """
+    # Align DEMs on a common grid as VRTs (no pixels are copied), which are
+    # then read block by block
+    logger.info('Aligning DEMs...')
+    aligned, plan = align_rasters([dem1_path, dem2_path], out_suffix='_rmse')
+    logger.debug('Common grid: {}'.format(plan))
+    try:
+        return _aligned_rmse(aligned, dem1_path, dem2_path, max_diff=max_diff,
+                             outfile=outfile, out_diff=out_diff, plot=plot,
+                             show_plot=show_plot, save_plot=save_plot,
+                             bins=bins, log_scale=log_scale,
+                             block_rows=block_rows)
+    finally:
+        unlink_rasters(aligned)
+
+
+def _aligned_rmse(aligned, dem1_path, dem2_path, max_diff=None, outfile=None,
+                  out_diff=None, plot=False, show_plot=False, save_plot=None,
+                  bins=10, log_scale=True, block_rows=1024):
 
     # Compute RMSE
     logger.info('Computing RMSE...')
-    diffs = arr1 - arr2
-    
+    sum_sq = 0.0
+    diffs_valid_count = 0
+    size_uncleaned = 0
+    min_diff = np.inf
+    max_found = -np.inf
+    for diffs, n_uncleaned in _block_diffs(aligned, max_diff=max_diff,
+                                           block_rows=block_rows):
+        size_uncleaned += n_uncleaned
+        if diffs.size == 0:
+            continue
+        sum_sq += (diffs**2).sum()
+        diffs_valid_count += diffs.size
+        min_diff = min(min_diff, diffs.min())
+        max_found = max(max_found, diffs.max())
+
     # Remove any differences bigger than max_diff
-    if max_diff:
-        logger.debug('Checking for large differences, max_diff: {}'.format(max_diff))
-        size_uncleaned = diffs.size
-        diffs = diffs[abs(diffs) < max_diff]
-        size_cleaned = diffs.size
-        if size_uncleaned != size_cleaned:
-            logger.debug('Removed differences over max_diff ({}) from RMSE calculation...'.format(max_diff))
-            logger.debug('Size before: {:,}'.format(size_uncleaned))
-            logger.debug('Size after:  {:,}'.format(size_cleaned))
-            logger.debug('Pixels removed: {:.2f}% of overlap area'.format(((size_uncleaned-size_cleaned)/size_uncleaned)*100))
-    
-    sq_diff = diffs**2
-    mean_sq = sq_diff.sum() / sq_diff.count()
+    if max_diff and size_uncleaned != diffs_valid_count:
+        logger.debug('Removed differences over max_diff ({}) from RMSE calculation...'.format(max_diff))
+        logger.debug('Size before: {:,}'.format(size_uncleaned))
+        logger.debug('Size after:  {:,}'.format(diffs_valid_count))
+        logger.debug('Pixels removed: {:.2f}% of overlap area'.format(((size_uncleaned-diffs_valid_count)/size_uncleaned)*100))
+
+    mean_sq = sum_sq / diffs_valid_count
     logger.debug('Mean square error: {}'.format(mean_sq))
     rmse = np.sqrt(mean_sq)
 
     # Report differences
-    diffs_valid_count = diffs.count()
-    min_diff = diffs.min()
-    max_diff = diffs.max()
     logger.debug('Minimum difference: {:.2f}'.format(min_diff))
-    logger.debug('Maximum difference: {:.2f}'.format(max_diff))
+    logger.debug('Maximum difference: {:.2f}'.format(max_found))
     logger.debug('Pixels considered: {:,}'.format(diffs_valid_count))
     logger.info('RMSE: {:.2f}'.format(rmse))
 
@@ -99,7 +113,7 @@ def dem_rmse(dem1_path, dem2_path, max_diff=None, outfile=None, out_diff=None, p
             of.write('RMSE: {:.2f}\n'.format(rmse))
             of.write('Pixels considered: {:,}\n'.format(diffs_valid_count))
             of.write('Minimum difference: {:.2f}\n'.format(min_diff))
-            of.write('Maximum difference: {:.2f}\n'.format(max_diff))
+            of.write('Maximum difference: {:.2f}\n'.format(max_found))
     
     # Write raster file of results
     if out_diff:
@@ -110,10 +124,16 @@ def dem_rmse(dem1_path, dem2_path, max_diff=None, outfile=None, out_diff=None, p
     # TODO: Add legend
     # TODO: Incorporate min/max differences based on max_diff argument
     if plot:
+        # Histogram accumulated over blocks in a second pass
+        edges = np.linspace(min_diff, max_found, bins + 1)
+        counts = np.zeros(bins)
+        for diffs, _n in _block_diffs(aligned, max_diff=max_diff,
+                                      block_rows=block_rows):
+            counts += np.histogram(diffs, bins=edges)[0]
         plt.style.use('ggplot')
         fig, ax = plt.subplots(1, 1)
-        ax.hist(diffs.compressed().flatten(), log=log_scale, bins=bins, edgecolor='white', 
-                alpha=0.875)
+        ax.hist(edges[:-1], bins=edges, weights=counts, log=log_scale,
+                edgecolor='white', alpha=0.875)
         ax.annotate('RMSE: {:.3f}'.format(rmse),
                     xy=(76, 0.75),
                     xycoords='axes fraction')
@@ -21,6 +21,7 @@ from valid_data import valid_percent
 from selection_utils.db import Postgres, generate_sql, intersect_aoi_where
 # from selection_utils.query_danco import query_footprint
 from misc_utils.id_parse_utils import read_ids, write_ids
+from misc_utils.gpd_utils import read_vector
 from misc_utils.logging_utils import create_logger
 
 logger = create_logger(__name__, 'sh', 'DEBUG')
@@ -99,7 +100,6 @@ def dem_selector(AOI_PATH=None,
     # TODO: Move this to a config file with MFP location
     DEM_STRIP_GDB = r'E:\disbr007\dem\setsm\footprints\dem_strips_v4_20201120.gdb'
     DEM_STRIP_LYR = Path(DEM_STRIP_GDB).stem #'dem_strips_v4_20201120'
-    DEM_STRIP_GDB_CRS = 'epsg:4326'
 
     # These are only used when verifying that DEMs exist - not necessary for sandwich or Eriks gdb)
     WINDOWS_OS = 'Windows' # value returned by platform.system() for windows
@@ -148,7 +148,7 @@ def dem_selector(AOI_PATH=None,
     # Load AOI
     if AOI_PATH:
         logger.info('Reading AOI: {}'.format(AOI_PATH))
-        aoi = gpd.read_file(AOI_PATH)
+        aoi = read_vector(AOI_PATH)
     elif COORDS:
         logger.info('Reading coordinates...')
         lon = float(COORDS[0])
@@ -164,17 +164,13 @@ def dem_selector(AOI_PATH=None,
         # Load DEM index or footprint
         if not DEM_FP:
             logger.info('Loading DEMs footprint from: {}'.format(DEM_STRIP_GDB))
-            if aoi.crs != DEM_STRIP_GDB_CRS:
-                aoi_bbox = aoi.to_crs(DEM_STRIP_GDB_CRS)
-            else:
-                aoi_bbox = aoi
-            dems = gpd.read_file(DEM_STRIP_GDB, layer=DEM_STRIP_LYR,
-                                 driver='OpenFileGDB',
-                                 bbox=aoi_bbox)
+            # AOI is reprojected to the crs of the strips layer
+            dems = read_vector(DEM_STRIP_GDB, layer=DEM_STRIP_LYR,
+                               bbox=aoi)
             logger.debug('DEMs footprint loaded: {:,}'.format(len(dems)))
         else:
             logger.info('Reading provided DEM footprint...')
-            dems = gpd.read_file(DEM_FP)
+            dems = read_vector(DEM_FP, bbox=aoi)
             logger.debug('DEMs loaded: {;,}'.format(len(dems)))
 
         # Subset by parameters provided
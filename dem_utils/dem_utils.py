@@ -9,6 +9,7 @@ from pathlib import Path
 import os
 import platform
 import re
+import uuid
 
 from osgeo import gdal
 import pandas as pd
@@ -16,7 +17,7 @@ import geopandas as gpd
 import shapely
 
 # from dem_utils.dem_selector import dem_selector
-from misc_utils.gdal_tools import clip_minbb
+from misc_utils.gdal_tools import align_rasters, iter_blocks, unlink_rasters
 from misc_utils.logging_utils import create_logger
 from misc_utils.raster_clip import clip_rasters
 from misc_utils.RasterWrapper import Raster
@@ -283,17 +284,49 @@ def get_dem_image1_id(meta_path):
         return image1_id
 
 
-def difference_dems(dem1, dem2, out_dem=None, in_mem=False):
-    clipped = clip_minbb([dem1, dem2], in_mem=True)
-    dem1_clipped = Raster(clipped[0])
-    dem2_clipped = Raster(clipped[1])
+def difference_dems(dem1, dem2, out_dem=None, in_mem=False, block_rows=1024):
+    """
+    Write dem1 - dem2 over the overlap of the DEMs. The DEMs are aligned
+    to a common grid as VRTs and differenced one block of rows at a time.
+    If out_dem is not provided the difference is written in memory, to a
+    uniquely named /vsimem path the caller should gdal.Unlink when done.
+
+    DEMs with different resolutions or origins are resampled onto the
+    coarsest grid with cubic resampling. Previously each DEM was clipped
+    with a projWin on its own grid (nearest pixel).
+    """
+    if not out_dem:
+        out_dem = r'/vsimem/dem_diff_{}.tif'.format(uuid.uuid4().hex)
+    aligned, plan = align_rasters([dem1, dem2], out_suffix='_diff')
+    try:
+        _write_difference(aligned, plan, out_dem, dem1, block_rows=block_rows)
+    finally:
+        unlink_rasters(aligned)
 
-    diff = dem1_clipped.MaskedArray - dem2_clipped.MaskedArray
+    return out_dem
 
-    if out_dem:
-        dem1_clipped.WriteArray(diff, out_path=out_dem)
 
-    return out_dem
+def _write_difference(aligned, plan, out_dem, dem1, block_rows=1024):
+    src = gdal.Open(aligned[0])
+    src_band = src.GetRasterBand(1)
+    nodata_val = src_band.GetNoDataValue()
+    if nodata_val is None:
+        logger.warning('Unable to determine NoData value of {}, '
+                       'using -9999'.format(dem1))
+        nodata_val = -9999
+    dst = gdal.GetDriverByName('GTiff').Create(str(out_dem), plan.width,
+                                               plan.height, 1,
+                                               src_band.DataType)
+    dst.SetGeoTransform(plan.geotransform)
+    dst.SetProjection(plan.srs)
+    dst_band = dst.GetRasterBand(1)
+    dst_band.SetNoDataValue(nodata_val)
+    src = None
+
+    for yoff, (arr1, arr2) in iter_blocks(aligned, block_rows=block_rows):
+        diff = arr1 - arr2
+        dst_band.WriteArray(diff.filled(nodata_val), 0, yoff)
+    dst = None
 
 # dem1 = r'E:\disbr007\umn\2020sep27_eureka\dems\sel' \
 #        r'\WV02_20140703_1030010033A84300_1030010032B54F00' \
@@ -4,6 +4,7 @@ import os
 from pathlib import Path
 import subprocess
 
+from misc_utils.fs_index import find_files
 from misc_utils.logging_utils import create_logger
 
 qsubscript = Path(__file__).parent / 'tif2jp2_qsub.sh'
@@ -24,11 +25,13 @@ def submit_jobs(args):
     logger.info('Dryrun: {}'.format(dryrun))
 
     logger.info('Locating tifs...')
-    tifs = [f for f in Path(srcdir).rglob('*.tif')]
+    tifs = [Path(f) for f in find_files(srcdir, pattern='*.tif')]
     logger.info('Tifs found: {}'.format(len(tifs)))
+    # Existing outputs, listed once rather than checked per tif
+    existing = set(find_files(dstdir, recursive=False)) if Path(dstdir).exists() else set()
     for t in tifs:
         dst = Path(dstdir) / '{}.{}'.format(t.stem, out_suffix)
-        if not dst.exists():
+        if str(dst) not in existing:
             cmd = 'qsub -l walltime=4:00:00 -l nodes=1:ppn=4 ' \
                   '-v p1="{}",p2="{}",p3="{}" {}'.format(t, dst, out_format,
                                                          qsubscript)
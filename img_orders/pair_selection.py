@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized greedy selection of stereo / cross-track pairs.
+
+Given pairs sorted by area, keep pairs in order until num_ids distinct,
+not-on-hand catalog IDs have been collected. Catalog IDs are factorized to
+integer codes and the first occurrence of each code in sort order is found
+with np.unique, so no per-row Python loop is needed.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+
+PairSelection = namedtuple('PairSelection',
+                           ['pairs', 'ids', 'cutoff_area', 'coverage'])
+
+
+def greedy_pair_selection(df, num_ids=None,
+                          id_cols=('catalogid1', 'catalogid2'),
+                          area_col='area_sqkm', skip_cols=None,
+                          sort=True, ascending=True):
+    """
+    Select pairs in area order until num_ids new IDs have been found. A pair
+    is kept if either of its IDs is being seen for the first time (and is
+    not flagged in skip_cols). The pair that reaches num_ids is the last
+    one kept, so the number of IDs returned may exceed num_ids by one.
+
+    Parameters
+    ----------
+    df : pd.DataFrame / gpd.GeoDataFrame
+        Pairs, one per row.
+    num_ids : int
+        Number of IDs to select. If None, all IDs are selected.
+    id_cols : tuple
+        The two catalog ID columns of each pair.
+    area_col : str
+        Column to order pairs by.
+    skip_cols : tuple
+        Boolean columns, one per id_col, flagging IDs that should not be
+        selected (e.g. on hand).
+    sort : bool
+        Sort df by area_col. Pass False if df is already in selection order.
+    ascending : bool
+        Sort order for area_col.
+
+    Returns
+    -------
+    PairSelection : namedtuple of
+        pairs : rows of df that were kept, in selection order
+        ids : list of selected IDs
+        cutoff_area : area_col of the last pair considered
+        coverage : sum of area_col over kept pairs
+    """
+    if sort:
+        df = df.sort_values(by=area_col, ascending=ascending)
+    if len(df) == 0:
+        return PairSelection(df, [], None, 0)
+
+    # Interleave IDs of each pair so position // 2 is the row number and
+    # position order matches checking id1 then id2 for each row.
+    stacked = np.column_stack([df[c].values for c in id_cols]).ravel()
+    codes, uniques = pd.factorize(stacked)
+    if skip_cols:
+        skip = np.column_stack([df[c].values.astype(bool)
+                                for c in skip_cols]).ravel()
+        codes[skip] = -1
+    codes[pd.isnull(stacked)] = -1
+
+    valid_pos = np.flatnonzero(codes >= 0)
+    _, first = np.unique(codes[valid_pos], return_index=True)
+    first_pos = np.sort(valid_pos[first])
+
+    if num_ids is not None and len(first_pos) >= num_ids > 0:
+        stop_row = first_pos[num_ids - 1] // 2
+        first_pos = first_pos[first_pos <= 2 * stop_row + 1]
+    else:
+        stop_row = len(df) - 1
+
+    kept_rows = np.unique(first_pos // 2)
+    pairs = df.iloc[kept_rows]
+    ids = list(uniques[codes[first_pos]])
+    cutoff_area = df[area_col].iat[stop_row]
+    coverage = pairs[area_col].sum()
+
+    return PairSelection(pairs, ids, cutoff_area, coverage)
@@ -21,10 +21,13 @@ import geopandas as gpd
 
 from misc_utils.utm_area_calc import area_calc
 from misc_utils.logging_utils import create_logger
-from misc_utils.id_parse_utils import write_ids, get_platform_code, onhand_ids
+from misc_utils.id_parse_utils import write_ids, get_platform_code, \
+    mfp_index, ordered_index
+from misc_utils.id_index import IDIndex
 from misc_utils.gpd_utils import select_in_aoi
 from selection_utils.query_danco import query_footprint, count_table
 from selection_utils.danco_utils import create_cid_noh_where
+from img_orders.pair_selection import greedy_pair_selection
 
 
 # Turn off pandas warning
@@ -155,10 +158,10 @@ def main(args):
     if remove_oh:
         # Get all onhand and ordered ids
         logger.info('Loading all onhand and ordered IDs...')
-        oh_ids = set(onhand_ids(update=update_ordered))
+        oh_ids = mfp_index().union(ordered_index(update=update_ordered))
         logger.info('Onhand and ordered IDs loaded: {:,}'.format(len(oh_ids)))
     else:
-        oh_ids = set()
+        oh_ids = IDIndex()
 
     # Load land shapefile if necessary
     if use_land:
@@ -183,7 +186,7 @@ def main(args):
         # Remove records where both IDs are onhand
         if remove_oh:
             logger.info('Dropping records where both IDs are on onhand...')
-            chunk = chunk[~((chunk['catalogid1'].isin(oh_ids)) & (chunk['catalogid2'].isin(oh_ids)))]
+            chunk = chunk[~(oh_ids.isin(chunk['catalogid1']) & oh_ids.isin(chunk['catalogid2']))]
             remaining_records = len(chunk)
             logger.info('Remaining records: {:,}'.format(remaining_records))
             if remaining_records == 0:
@@ -219,8 +222,8 @@ def main(args):
 
     # Select n records with highest area
     master = master.sort_values(by=area_col)
-    master[cid1_oh_fld] = master[catid1_fld].isin(oh_ids)
-    master[cid2_oh_fld] = master[catid2_fld].isin(oh_ids)
+    master[cid1_oh_fld] = oh_ids.isin(master[catid1_fld])
+    master[cid2_oh_fld] = oh_ids.isin(master[catid2_fld])
 
     if remove_oh:
         noh_str = ' not_on_hand'
@@ -229,28 +232,21 @@ def main(args):
     logger.info('Finding {:,} out of {:,} IDs{}, starting with largest '
                 'area...'.format(num_ids, len(master), noh_str))
 
-    out_ids = set()
-    kept_rows = set()
+    selection = greedy_pair_selection(master, num_ids=num_ids,
+                                      id_cols=(catid1_fld, catid2_fld),
+                                      area_col=area_col,
+                                      skip_cols=(cid1_oh_fld, cid2_oh_fld),
+                                      sort=False)
+    out_ids = selection.ids
     num_kept_ids = len(out_ids)
-    for i, row in master.iterrows():
-        cid1 = row[catid1_fld]
-        cid2 = row[catid2_fld]
-        if not row[cid1_oh_fld] and cid1 not in out_ids:
-            out_ids.add(cid1)
-            kept_rows.add(row.name)
-        if not row[cid2_oh_fld] and cid2 not in out_ids:
-            out_ids.add(cid2)
-            kept_rows.add(row.name)
-        num_kept_ids = len(out_ids)
-        if num_kept_ids >= num_ids:
-            logger.info('{:,} IDs not on hand located. {:,} sqkm minimum kept.'.format(num_kept_ids, row[area_col]))
-            break
-
-    if num_kept_ids < num_ids:
-        logger.warning('Only {:,} IDs found. Minimum area kept: {:,.2f}'.format(num_kept_ids, row[area_col]))
+    if num_ids is None or num_kept_ids >= num_ids:
+        logger.info('{:,} IDs not on hand located. {:,} sqkm minimum kept.'.format(num_kept_ids, selection.cutoff_area))
+    else:
+        logger.warning('Only {:,} IDs found. Minimum area kept: {:,.2f}'.format(num_kept_ids, selection.cutoff_area))
+    logger.info('Area of kept pairs: {:,.2f} sqkm'.format(selection.coverage))
 
     # Select kept pairs (rows)
-    kept_pairs = master[master.index.isin(kept_rows)]
+    kept_pairs = selection.pairs
     if out_footprint:
         logger.info('Writing footprint of pairs to: {}'.format(out_footprint))
         kept_pairs.to_file(out_footprint)
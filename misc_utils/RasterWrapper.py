@@ -9,13 +9,15 @@ Created on Fri Jul 19 10:20:36 2019
 import numpy as np
 import numpy.ma as ma
 
-from osgeo import gdal, osr  # ogr
+from osgeo import gdal, gdal_array, osr  # ogr
 # from shapely.geometry import Polygon
 from shapely.geometry import box
 import geopandas as gpd
 
 from misc_utils.logging_utils import create_logger
-from misc_utils.gdal_tools import clip_minbb, gdal_polygonize
+from misc_utils.gdal_tools import clip_minbb, gdal_polygonize, get_raster_sr, \
+    band_sources, iter_blocks, streaming_min_max, _rescale, \
+    stack_rasters as gdal_stack_rasters
 
 logger = create_logger(__name__, 'sh', 'DEBUG')
 
@@ -452,13 +454,9 @@ def same_srs(raster1, raster2):
     BOOL : True is match.
 
     """
-    r1 = Raster(raster1)
-    r1_srs = r1.prj
-    # r1 = None
-
-    r2 = Raster(raster2)
-    r2_srs = r2.prj
-    # r2 = None
+    # Only the headers are read
+    r1_srs = get_raster_sr(raster1)
+    r2_srs = get_raster_sr(raster2)
 
     result = r1_srs.IsSame(r2_srs)
     if result == 1:
@@ -470,67 +468,68 @@ def same_srs(raster1, raster2):
     return same
 
 
-def stack_rasters(rasters, minbb=True, rescale=False):
+def stack_rasters(rasters, minbb=True, rescale=False, out_path=None,
+                  block_rows=1024):
     """
-    Stack single band rasters into a multiband raster.
+    Stack the bands of rasters into a multiband array (rows, cols, bands).
+
+    The output array is allocated once and filled one block of rows at a
+    time. Rescaling uses each band's min / max of valid pixels, computed
+    in one streaming pass.
 
     Parameters
     ----------
     rasters : list
         List of rasters to stack. Reference raster for NoData value, projection, etc.
         is the first raster provided.
+    minbb : bool
+        Align rasters to the grid of their overlap first.
     rescale : bool
         True to rescale rasters to 0 to 1.
+    out_path : os.path.abspath
+        Write the stack to this multiband raster instead, block by block,
+        without holding it in memory.
 
     Returns
     -------
-    np.array : path.abspath : path to write multiband raster to.
+    np.ma.MaskedArray, or out_path if provided.
 
     """
-    # TODO: Add default clipping to reference window
-    if minbb:
-        logger.info('Clipping to overlap area...')
-        rasters = clip_minbb(rasters, in_mem=True, out_format='vrt')
-
-    # Determine a raster to use for reference
-    ref = Raster(rasters[0])
-
     # Check for SRS match between reference and other rasters
     srs_matches = [same_srs(rasters[0], r) for r in rasters[1:]]
     if not all(srs_matches):
         logger.warning("""Spatial references do not match, match status between
-                          reference and rest:\n{}""".format('\n'.join(srs_matches)))
+                          reference and rest:\n{}""".format('\n'.join(str(m) for m in srs_matches)))
 
-    # Initialize the stacked array with just the reference array
-    if ref.depth > 1:
-        stacked = ref.GetBandAsArray(1, mask=True)
-        if rescale:
-            stacked = (stacked - stacked.min()) / (stacked.max() - stacked.min())
-
-        for i in range(ref.depth-1):
-            band = ref.GetBandAsArray(i+2, mask=True)
-            if rescale:
-                band = (band - band.min()) / (band.max() - band.min())
-            stacked = np.ma.dstack([stacked, band])
+    if out_path:
+        # Aligned there, so a .vrt out_path does not reference /vsimem
+        return gdal_stack_rasters(rasters, out=out_path, rescale=rescale,
+                                  minbb=minbb, block_rows=block_rows)
 
-    for i, rast in enumerate(rasters[1:]):
-        ma = Raster(rast).MaskedArray
-        if np.ma.isMaskedArray(ma):
-            if rescale:
-                # Rescale to between 0 and 1
-                ma = (ma - ma.min())/ (ma.max() - ma.min())
-            # Replace mask/nodata value in array with reference values
-            # ma_mask = ma.mask
-            # ma = np.ma.masked_where(ma_mask, ma)
-            # ma.set_fill_value(ref.nodata_val)
-            # ma = ma.filled(ma.fill_value)
-
-        stacked = np.ma.dstack([stacked, ma])
+    if minbb:
+        logger.info('Clipping to overlap area...')
+        rasters = clip_minbb(rasters, in_mem=True, out_format='vrt')
 
-        ma = None
+    sources = band_sources(rasters)
+    if rescale:
+        mins, maxs = streaming_min_max(sources, block_rows=block_rows)
+        dtype = np.float64
+    else:
+        dtype = np.result_type(*[gdal_array.GDALTypeCodeToNumericTypeCode(
+            gdal.Open(r).GetRasterBand(b).DataType) for r, b in sources])
 
-    # Revert to original NoData value (stacking changes)
-    # stacked.set_fill_value(ref.nodata_val)
+    ref = gdal.Open(rasters[0])
+    rows, cols = ref.RasterYSize, ref.RasterXSize
+    nodata_val = ref.GetRasterBand(1).GetNoDataValue()
     ref = None
 
+    stacked = np.ma.masked_all((rows, cols, len(sources)), dtype=dtype)
+    for yoff, arrs in iter_blocks(sources, block_rows=block_rows):
+        for i, arr in enumerate(arrs):
+            if rescale:
+                arr = _rescale(arr, mins[i], maxs[i])
+            stacked[yoff:yoff + arr.shape[0], :, i] = arr
+    if nodata_val is not None:
+        stacked.set_fill_value(nodata_val)
+
     return stacked
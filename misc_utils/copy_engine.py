@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel, resumable file copying.
+
+Files are copied by a bounded pool of threads, largest first, so the
+longest copies start early and small files fill in around them - on
+network mounts most of the time of a copy is latency, which threads
+overlap. Copies are written to a temporary file next to the destination
+and renamed once complete, so an interrupted run never leaves a partial
+file that looks finished. Completed copies are recorded in a json
+manifest (size, mtime and optionally checksum of source and destination),
+which lets a rerun skip files already copied without re-reading them.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from tqdm import tqdm
+
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Rate assumed for dry run estimates when no previous run is recorded
+DEFAULT_RATE = 50 * 1024 ** 2
+# Tolerance of modification times, some filesystems store them to 2 s
+MTIME_TOL = 2
+PART_SFX = '.part'
+
+CopyResult = namedtuple('CopyResult', ['copied', 'skipped', 'failed',
+                                       'bytes_copied', 'seconds'])
+
+
+def file_stamp(path):
+    """(size, mtime) of path."""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+
+def file_checksum(path, block_size=8 * 1024 ** 2):
+    """md5 hex digest of a file."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as src:
+        for block in iter(lambda: src.read(block_size), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(n) < 1024 or unit == 'TB':
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024
+
+
+class CopyManifest:
+    """
+    Record of completed copies, persisted to json.
+
+    Entries are keyed on destination path, with the size, mtime and
+    checksum (if computed) of the source and of the destination at the
+    time of copying. The throughput of the last run is kept to estimate
+    dry runs.
+
+    Parameters
+    ----------
+    path : str
+        json file, loaded if it exists. If None, nothing is persisted.
+    save_every : int
+        Save after this many recorded copies, so an interrupted run can
+        resume from close to where it stopped.
+    """
+
+    def __init__(self, path=None, save_every=50):
+        self.path = path
+        self.save_every = save_every
+        self.entries = {}
+        self.rate = None
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r') as src:
+                content = json.load(src)
+            self.entries = content.get('files', {})
+            self.rate = content.get('rate')
+            logger.info('Loaded copy manifest: {} ({:,} files)'.format(path, len(self.entries)))
+
+    def get(self, dst):
+        with self._lock:
+            return self.entries.get(str(dst))
+
+    def record(self, src, dst, checksum=None):
+        src_size, src_mtime = file_stamp(src)
+        dst_size, dst_mtime = file_stamp(dst)
+        entry = {'src': str(src), 'size': src_size, 'src_mtime': src_mtime,
+                 'dst_mtime': dst_mtime, 'dst_size': dst_size,
+                 'checksum': checksum}
+        with self._lock:
+            self.entries[str(dst)] = entry
+            self._unsaved += 1
+            save = self._unsaved >= self.save_every
+        if save:
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            content = {'rate': self.rate, 'files': self.entries}
+            # Write then rename, so the manifest is never left half written
+            tmp = '{}{}'.format(self.path, PART_SFX)
+            with open(tmp, 'w') as dst:
+                json.dump(content, dst)
+            os.replace(tmp, self.path)
+            self._unsaved = 0
+
+
+def is_identical(src, dst, manifest=None, compare='identical', checksum=False):
+    """
+    Whether copying src to dst can be skipped.
+
+    Parameters
+    ----------
+    compare : str
+        'exists' - skip if dst exists
+        'newer' - skip unless src was modified after dst, so a newer dst
+        is never overwritten
+        'identical' - skip if dst has the size and mtime of src (within
+        MTIME_TOL), or was recorded in the manifest as a copy of src as it
+        is now. With checksum, sizes that match but mtimes that do not are
+        settled by comparing checksums.
+    """
+    if not os.path.lexists(dst):
+        return False
+    if compare == 'exists':
+        return True
+    src_size, src_mtime = file_stamp(src)
+    dst_size, dst_mtime = file_stamp(dst)
+    if compare == 'newer':
+        return src_mtime <= dst_mtime
+    if src_size != dst_size:
+        return False
+    if abs(src_mtime - dst_mtime) <= MTIME_TOL:
+        return True
+    entry = manifest.get(dst) if manifest is not None else None
+    if (entry is not None and entry['size'] == src_size
+            and abs(entry['src_mtime'] - src_mtime) <= MTIME_TOL
+            and abs(entry['dst_mtime'] - dst_mtime) <= MTIME_TOL):
+        return True
+    if checksum:
+        return file_checksum(src) == file_checksum(dst)
+
+    return False
+
+
+def _copy_stream(src, dst, block_size=8 * 1024 ** 2):
+    """Copy src to dst in blocks, returning the md5 of the bytes copied."""
+    md5 = hashlib.md5()
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        for block in iter(lambda: s.read(block_size), b''):
+            md5.update(block)
+            d.write(block)
+    shutil.copystat(src, dst)
+
+    return md5.hexdigest()
+
+
+def copy_file(src, dst, method='copy', checksum=False):
+    """
+    Copy (or link) a single file, via a temporary file renamed on
+    completion.
+
+    Parameters
+    ----------
+    method : str
+        'copy', 'link' (hard link) or 'symlink'.
+    checksum : bool
+        Compute the md5 of the file while copying.
+
+    Returns
+    -------
+    str : md5 of src if checksum and method is 'copy', else None
+    """
+    dst_dir = os.path.dirname(dst)
+    if dst_dir:
+        os.makedirs(dst_dir, exist_ok=True)
+    if os.path.lexists(dst) and method != 'copy':
+        os.remove(dst)
+    if method == 'link':
+        os.link(src, dst)
+        return None
+    if method == 'symlink':
+        os.symlink(src, dst)
+        return None
+
+    tmp = '{}{}'.format(dst, PART_SFX)
+    try:
+        if checksum:
+            digest = _copy_stream(src, tmp)
+        else:
+            shutil.copy2(src, tmp)
+            digest = None
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return digest
+
+
+def plan_copies(pairs, manifest=None, compare='identical', checksum=False,
+                threads=8):
+    """
+    Stat sources and destinations (concurrently) and return the pairs
+    still to copy, largest first, with their sizes.
+
+    Returns
+    -------
+    tuple : (list of (src, dst, size) to copy, number of pairs skipped,
+             list of missing sources)
+    """
+    def check(pair):
+        src, dst = pair
+        if not os.path.exists(src):
+            return src, dst, None, False
+        return src, dst, os.path.getsize(src), is_identical(src, dst, manifest=manifest,
+                                                             compare=compare,
+                                                             checksum=checksum)
+
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        checked = list(executor.map(check, pairs))
+    missing = [src for src, _, size, _ in checked if size is None]
+    todo = [(src, dst, size) for src, dst, size, same in checked
+            if size is not None and not same]
+    n_skipped = len(checked) - len(todo) - len(missing)
+    todo = sorted(todo, key=lambda t: t[2], reverse=True)
+
+    return todo, n_skipped, missing
+
+
+def copy_files(pairs, manifest_path=None, threads=4, method='copy',
+               compare='identical', checksum=False, dryrun=False):
+    """
+    Copy files concurrently, largest first, skipping those already at
+    their destination.
+
+    Parameters
+    ----------
+    pairs : list
+        (source, destination) file path pairs.
+    manifest_path : str
+        json manifest of completed copies, to resume from and update.
+    threads : int
+        Number of concurrent copies.
+    method : str
+        'copy', 'link' or 'symlink', see copy_file.
+    compare : str
+        How to decide a destination is already up to date, see
+        is_identical.
+    checksum : bool
+        Record md5 checksums of copies, and compare checksums of files of
+        equal size but differing mtime.
+    dryrun : bool
+        Only report the number of files and bytes to copy and an estimate
+        of the time it would take, from the throughput of the last run
+        recorded in the manifest, or DEFAULT_RATE.
+
+    Returns
+    -------
+    CopyResult : namedtuple of
+        copied : list of (src, dst) copied
+        skipped : number of pairs already up to date
+        failed : list of (src, dst) that could not be copied, including
+                 missing sources
+        bytes_copied : int
+        seconds : float
+    """
+    manifest = CopyManifest(manifest_path)
+    pairs = [(str(s), str(d)) for s, d in pairs]
+    todo, n_skipped, missing = plan_copies(pairs, manifest=manifest, compare=compare,
+                                           checksum=checksum, threads=max(threads, 8))
+    for src in missing:
+        logger.warning('Source not found: {}'.format(src))
+    missing = set(missing)
+    failed = [(s, d) for s, d in pairs if s in missing]
+    total_bytes = sum(size for _, _, size in todo)
+    logger.info('Files to copy: {:,} ({}), up to date: {:,}'.format(
+        len(todo), format_bytes(total_bytes), n_skipped))
+
+    if dryrun:
+        rate = manifest.rate if manifest.rate else DEFAULT_RATE
+        est = total_bytes / rate if method == 'copy' else 0
+        logger.info('[DRYRUN] Estimated time at {}/s: {:.0f} s ({:.1f} h)'.format(
+            format_bytes(rate), est, est / 3600))
+        return CopyResult([], n_skipped, failed, 0, 0.0)
+
+    copied = []
+    bytes_copied = 0
+    start = time.time()
+    pbar = tqdm(total=total_bytes, unit='B', unit_scale=True, unit_divisor=1024)
+    try:
+        with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+            futures = {executor.submit(copy_file, src, dst, method=method,
+                                       checksum=checksum): (src, dst, size)
+                       for src, dst, size in todo}
+            for future in as_completed(futures):
+                src, dst, size = futures[future]
+                try:
+                    digest = future.result()
+                    manifest.record(src, dst, checksum=digest)
+                    copied.append((src, dst))
+                    bytes_copied += size
+                except Exception as e:
+                    logger.error('Failed to copy: {}'.format(src))
+                    logger.error(e)
+                    failed.append((src, dst))
+                pbar.update(size)
+    finally:
+        pbar.close()
+        seconds = time.time() - start
+        if bytes_copied and seconds > 0 and method == 'copy':
+            manifest.rate = bytes_copied / seconds
+        manifest.save()
+
+    logger.info('Copied {:,} files ({}) in {:.1f} s, {}/s'.format(
+        len(copied), format_bytes(bytes_copied), seconds,
+        format_bytes(bytes_copied / seconds if seconds > 0 else 0)))
+    if failed:
+        logger.warning('Failed to copy: {:,}'.format(len(failed)))
+
+    return CopyResult(copied, n_skipped, failed, bytes_copied, seconds)
@@ -5,15 +5,14 @@ Created on Sun Jan  5 18:38:32 2020
 @author: disbr007
 """
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
-import shutil
-import numpy as np
-from copy import deepcopy
 
-from osgeo import gdal
 from tqdm import tqdm
 
-from logging_utils import create_logger
+from misc_utils.fs_index import FileIndex
+from misc_utils.gdal_tools import raster_is_empty
+from misc_utils.logging_utils import create_logger
 
 
 # Inputs
@@ -25,38 +24,34 @@ band = 1 # band to check if all no data TODO: add option to check all bands
 logger = create_logger('delete_nodata', 'sh', 'INFO')
 
 
-def delete_NoData(input_dir, ext='tif', band=1, dryrun=False):
+def delete_NoData(input_dir, ext='tif', band=1, dryrun=False, approx=False,
+                  threads=8, catalog_path=None):
     logger.info('Parsing {} for NoData only rasters...'.format(input_dir))
     # Loop over input directory and delete and rasters that are entirely* no data
-    for root, dirs, files in os.walk(input_dir):
-        file_paths_master = [os.path.join(root, f) for f in files]
-        file_paths = deepcopy(file_paths_master)    
-        
-        for fp in file_paths:
-            if fp.endswith(ext):
-                logger.info('Checking {}'.format(os.path.basename(fp)))
-                # Get filename w/o extension to delete metadata files
-                filename = os.path.basename(fp).split('.')[0]
-                # Check if any non-NoData values exist
-                ds = gdal.Open(fp)
-                no_data_val = ds.GetRasterBand(band).GetNoDataValue()
-                array = ds.ReadAsArray()
-                ds = None
-                valid_data = np.any(array != no_data_val)
-                
-                if valid_data == False:
-                    logger.info('{} contains all NoData values, deleting...'.format(fp))            
-                    matching_files = [fp for fp in file_paths_master
-                                      if os.path.basename(fp).split('.')[0]==filename]
-                    for mf in matching_files:
-                        if not dryrun:
-                            os.remove(mf)
-                elif valid_data == True:
-                    logger.info('Keeping {}'.format(fp))
-                else:
-                    logger.info('Unk')
-                
-                
+    idx = FileIndex(input_dir, catalog_path=catalog_path, threads=threads).scan()
+    rasters = idx.files(match=lambda f: f.endswith(ext))
+    logger.info('Checking rasters: {:,}'.format(len(rasters)))
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        empty = list(tqdm(executor.map(lambda fp: raster_is_empty(fp, band=band,
+                                                                  approx=approx),
+                                       rasters),
+                          total=len(rasters)))
+
+    for fp, is_empty in zip(rasters, empty):
+        if is_empty:
+            logger.info('{} contains all NoData values, deleting...'.format(fp))
+            # Get filename w/o extension to delete metadata files
+            filename = os.path.basename(fp).split('.')[0]
+            matching_files = [os.path.join(os.path.dirname(fp), f)
+                              for f in idx.siblings(fp)
+                              if f.split('.')[0] == filename]
+            for mf in matching_files:
+                if not dryrun:
+                    os.remove(mf)
+        else:
+            logger.debug('Keeping {}'.format(fp))
+
+
 if __name__ == '__main__':
     script_desc = """Parses the input directory RECURSIVELY and deletes any 
                      rasters with the matching extension that contain only
@@ -72,8 +67,15 @@ if __name__ == '__main__':
                         help='Band to check for NoData only values.')
     parser.add_argument('--dryrun', action='store_true',
                         help='Print messages but do not run.')
+    parser.add_argument('--approx', action='store_true',
+                        help='Trust overviews with no valid data, without '
+                             'reading the full resolution band.')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Number of directories listed and rasters checked '
+                             'concurrently.')
     args = parser.parse_args()
     
     logger.info('Starting...')
     
-    delete_NoData(args.input_directory, ext=args.ext, band=args.band)
\ No newline at end of file
+    delete_NoData(args.input_directory, ext=args.ext, band=args.band,
+                  dryrun=args.dryrun, approx=args.approx, threads=args.threads)
\ No newline at end of file
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Shared, persisted index of the files under a directory.
+
+Directories are listed with os.scandir by a pool of threads, so the
+latency of listing many directories on network mounts overlaps, and the
+size and mtime of files come from the directory listing rather than a
+separate stat of each file. The index is kept per directory, with the
+mtime of the directory when it was listed, and can be saved to a json
+catalog. A rescan lists again only directories whose mtime has changed -
+files being added, removed or renamed in a directory changes its mtime -
+and reuses the catalog for the rest.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import fnmatch
+import json
+import os
+import re
+
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+
+def _as_tuple(values):
+    if isinstance(values, str):
+        values = (values, )
+    return tuple(values) if values else ()
+
+
+def _excluded(name, exclude_dirs=(), exclude_names=()):
+    return name in exclude_names or any(ex in name for ex in exclude_dirs)
+
+
+class FileIndex:
+    """
+    Index of files under root.
+
+    Parameters
+    ----------
+    root : str
+        Directory to index.
+    catalog_path : str
+        json file the index is loaded from, if it exists, and saved to.
+    threads : int
+        Number of directories listed concurrently.
+    exclude_dirs : list
+        Directories whose name contains any of these are not indexed.
+    exclude_names : list
+        Directories whose name is any of these are not indexed.
+
+    Notes
+    -----
+    A rescan reuses the catalog for directories whose mtime is unchanged.
+    Files edited in place (rewritten without being added, removed or
+    renamed) do not change the mtime of their directory, so their size
+    and mtime are stale until a scan with full=True.
+    """
+
+    def __init__(self, root, catalog_path=None, threads=8, exclude_dirs=None,
+                 exclude_names=None):
+        self.root = os.path.abspath(root)
+        self.catalog_path = catalog_path
+        self.threads = threads
+        self.exclude_dirs = _as_tuple(exclude_dirs)
+        self.exclude_names = _as_tuple(exclude_names)
+        # {dir path: {'mtime', 'subdirs': [names], 'files': {name: [size, mtime]}}}
+        self.dirs = {}
+        if catalog_path and os.path.exists(catalog_path):
+            with open(catalog_path, 'r') as src:
+                catalog = json.load(src)
+            if catalog.get('root') == self.root:
+                self.dirs = catalog['dirs']
+                logger.debug('Loaded file catalog: {} ({:,} directories)'.format(
+                    catalog_path, len(self.dirs)))
+
+    def _excluded(self, name):
+        return _excluded(name, self.exclude_dirs, self.exclude_names)
+
+    def _list_dir(self, path, full=False):
+        try:
+            mtime = os.stat(path).st_mtime
+            cached = self.dirs.get(path)
+            if not full and cached is not None and cached['mtime'] == mtime:
+                return path, cached, False
+            subdirs = []
+            files = {}
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not self._excluded(entry.name):
+                            subdirs.append(entry.name)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        files[entry.name] = [st.st_size, st.st_mtime]
+        except OSError as e:
+            logger.warning('Unable to list directory: {}'.format(path))
+            logger.debug(e)
+            return path, None, True
+
+        return path, {'mtime': mtime, 'subdirs': subdirs, 'files': files}, True
+
+    def scan(self, full=False):
+        """
+        Update the index, listing only directories that changed since the
+        last scan, or every directory with full. Saves the catalog if a
+        catalog_path was given.
+
+        Returns
+        -------
+        FileIndex : self
+        """
+        dirs = {}
+        n_listed = 0
+        with ThreadPoolExecutor(max_workers=max(self.threads, 1)) as executor:
+            pending = {executor.submit(self._list_dir, self.root, full)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, entry, listed = future.result()
+                    if entry is None:
+                        continue
+                    dirs[path] = entry
+                    n_listed += listed
+                    for d in entry['subdirs']:
+                        if self._excluded(d):
+                            continue
+                        pending.add(executor.submit(self._list_dir,
+                                                    os.path.join(path, d), full))
+        self.dirs = dirs
+        logger.info('Indexed {:,} files in {:,} directories ({:,} listed) under '
+                    '{}'.format(sum(len(e['files']) for e in dirs.values()),
+                                len(dirs), n_listed, self.root))
+        if self.catalog_path:
+            self.save()
+
+        return self
+
+    def save(self, catalog_path=None):
+        catalog_path = catalog_path if catalog_path else self.catalog_path
+        tmp = '{}.tmp'.format(catalog_path)
+        with open(tmp, 'w') as dst:
+            json.dump({'root': self.root, 'dirs': self.dirs}, dst)
+        os.replace(tmp, catalog_path)
+
+    def entries(self, pattern=None, regex=None, match=None, recursive=True,
+                exclude_dirs=None, exclude_names=None):
+        """
+        Yield (path, size, mtime) of indexed files, filtered on file name.
+
+        Parameters
+        ----------
+        pattern : str
+            Glob pattern (fnmatch) file names must match, e.g. '*dem.tif'.
+        regex : str
+            Regular expression searched for in file names.
+        match : function
+            Called with each file name, files are kept if it returns True.
+        recursive : bool
+            Include files in subdirectories of root.
+        exclude_dirs : list
+            Skip directories (and their subdirectories) whose name contains
+            any of these, in addition to those excluded from the index.
+        exclude_names : list
+            Skip directories (and their subdirectories) whose name is any
+            of these.
+        """
+        regex = re.compile(regex) if regex else None
+        exclude_dirs = _as_tuple(exclude_dirs)
+        exclude_names = _as_tuple(exclude_names)
+        stack = [self.root] if self.root in self.dirs else []
+        while stack:
+            path = stack.pop()
+            entry = self.dirs[path]
+            for name, (size, mtime) in sorted(entry['files'].items()):
+                if pattern and not fnmatch.fnmatch(name, pattern):
+                    continue
+                if regex is not None and not regex.search(name):
+                    continue
+                if match is not None and not match(name):
+                    continue
+                yield os.path.join(path, name), size, mtime
+            if not recursive:
+                break
+            for d in sorted(entry['subdirs'], reverse=True):
+                if _excluded(d, exclude_dirs, exclude_names):
+                    continue
+                sub = os.path.join(path, d)
+                if sub in self.dirs:
+                    stack.append(sub)
+
+    def files(self, **kwargs):
+        """Paths of indexed files, see entries for filters."""
+        return [path for path, _, _ in self.entries(**kwargs)]
+
+    def siblings(self, path):
+        """Names of files in the same directory as path."""
+        entry = self.dirs.get(os.path.dirname(os.path.abspath(path)))
+        return list(entry['files']) if entry else []
+
+
+def find_files(root, pattern=None, regex=None, match=None, recursive=True,
+               exclude_dirs=None, exclude_names=None, catalog_path=None,
+               threads=8):
+    """
+    Scan root and return paths of files matching the filters. See
+    FileIndex.
+
+    Returns
+    -------
+    list : paths of matching files
+    """
+    if not recursive:
+        # Only root needs listing
+        idx = FileIndex(root, threads=1, exclude_dirs=exclude_dirs,
+                        exclude_names=exclude_names)
+        path, entry, _ = idx._list_dir(idx.root)
+        idx.dirs = {path: entry} if entry is not None else {}
+    else:
+        idx = FileIndex(root, catalog_path=catalog_path, threads=threads,
+                        exclude_dirs=exclude_dirs,
+                        exclude_names=exclude_names).scan()
+
+    return idx.files(pattern=pattern, regex=regex, match=match,
+                     recursive=recursive)
@@ -3,6 +3,7 @@ Reproject a shapfile -- copied directly from ogr-cookbook, coverted to function
 with in memory writing ability.
 """
 
+from collections import namedtuple
 import copy
 import os
 import glob
@@ -11,7 +12,10 @@ import posixpath
 from pathlib import Path
 import subprocess
 from subprocess import PIPE
+import uuid
+from xml.sax.saxutils import escape
 
+import numpy as np
 from osgeo import gdal, ogr, osr
 
 from misc_utils.get_creds import get_creds
@@ -345,21 +349,239 @@ def minimum_bounding_box(rasters):
     return projWin
 
 
+GridPlan = namedtuple('GridPlan', ['geotransform', 'width', 'height', 'srs'])
+
+
+def plan_common_grid(rasters, res='coarsest', extent='intersection'):
+    """
+    Compute a common grid for rasters: their intersection (or union)
+    at a target resolution, snapped to the pixel edges of the first raster
+    with the target resolution. Only raster metadata is read.
+
+    Parameters
+    ----------
+    rasters : list
+        Paths to rasters, in the same SRS.
+    res : str / tuple
+        'coarsest', 'finest', or (x_res, y_res).
+    extent : str
+        'intersection' or 'union' of the rasters' extents.
+
+    Returns
+    -------
+    GridPlan : namedtuple of (geotransform, width, height, srs wkt)
+    """
+    infos = []
+    for r in rasters:
+        ds = gdal.Open(str(r))
+        infos.append((ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize,
+                      ds.GetProjection()))
+        ds = None
+
+    x_ress = [abs(gt[1]) for gt, _, _, _ in infos]
+    y_ress = [abs(gt[5]) for gt, _, _, _ in infos]
+    if res == 'coarsest':
+        x_res, y_res = max(x_ress), max(y_ress)
+    elif res == 'finest':
+        x_res, y_res = min(x_ress), min(y_ress)
+    else:
+        x_res, y_res = abs(res[0]), abs(res[1])
+    # Snap to the grid of a raster at the target resolution, so it is not
+    # resampled
+    ref = next((i for i, (xr, yr) in enumerate(zip(x_ress, y_ress))
+                if xr == x_res and yr == y_res), 0)
+    ref_gt, _, _, srs = infos[ref]
+    srs_ref = osr.SpatialReference(wkt=srs)
+    if not all(srs_ref.IsSame(osr.SpatialReference(wkt=i[3])) for i in infos[1:]):
+        logger.warning('Spatial references of rasters do not match, using: '
+                       '{}'.format(rasters[ref]))
+
+    bounds = np.array([raster_bounds(str(r)) for r in rasters])
+    # Snap outward for a union, inward for an intersection, tolerating
+    # floating point error
+    eps = 1e-6
+    if extent == 'union':
+        ulx, lry, lrx, uly = (bounds[:, 0].min(), bounds[:, 1].min(),
+                              bounds[:, 2].max(), bounds[:, 3].max())
+        lo = lambda v: np.floor(v + eps)
+        hi = lambda v: np.ceil(v - eps)
+    else:
+        ulx, lry, lrx, uly = (bounds[:, 0].max(), bounds[:, 1].max(),
+                              bounds[:, 2].min(), bounds[:, 3].min())
+        lo = lambda v: np.ceil(v - eps)
+        hi = lambda v: np.floor(v + eps)
+    ox, oy = ref_gt[0], ref_gt[3]
+    ulx = ox + lo((ulx - ox) / x_res) * x_res
+    lrx = ox + hi((lrx - ox) / x_res) * x_res
+    uly = oy - lo((oy - uly) / y_res) * y_res
+    lry = oy - hi((oy - lry) / y_res) * y_res
+    width = int(round((lrx - ulx) / x_res))
+    height = int(round((uly - lry) / y_res))
+    if width <= 0 or height <= 0:
+        logger.error('Rasters do not overlap.')
+        raise ValueError('Rasters do not overlap.')
+
+    return GridPlan((float(ulx), float(x_res), 0, float(uly), 0, -float(y_res)),
+                    width, height, srs)
+
+
+def aligned_vrt(raster, plan, out_path, resampleAlg='cubic'):
+    """
+    Write a VRT of raster on the grid of plan. Only a source window
+    (srcWin) and, if the resolution or grid differs, a resampling method
+    are written - no pixels are copied.
+    """
+    ds = gdal.Open(str(raster))
+    gt = ds.GetGeoTransform()
+    pgt = plan.geotransform
+    xoff = (pgt[0] - gt[0]) / gt[1]
+    yoff = (pgt[3] - gt[3]) / gt[5]
+    xsize = plan.width * pgt[1] / gt[1]
+    ysize = plan.height * pgt[5] / gt[5]
+    window = [xoff, yoff, xsize, ysize]
+    same_grid = (np.allclose(window, np.round(window), atol=1e-6) and
+                 round(xsize) == plan.width and round(ysize) == plan.height)
+    if same_grid:
+        window = [int(round(w)) for w in window]
+    bounds = [pgt[0], pgt[3],
+              pgt[0] + plan.width * pgt[1], pgt[3] + plan.height * pgt[5]]
+    trans_opts = gdal.TranslateOptions(format='VRT', srcWin=window,
+                                       width=plan.width, height=plan.height,
+                                       outputBounds=bounds,
+                                       resampleAlg=None if same_grid else resampleAlg)
+    gdal.Translate(str(out_path), ds, options=trans_opts)
+    ds = None
+
+    return str(out_path)
+
+
+def align_rasters(rasters, plan=None, out_dir=r'/vsimem', out_suffix='_aligned',
+                  resampleAlg='cubic', **plan_kwargs):
+    """
+    Align rasters to a common grid as VRTs. See plan_common_grid for
+    plan_kwargs, used if plan is not provided. Rasters not already on the
+    grid are resampled with resampleAlg. VRTs in /vsimem get unique names
+    and should be removed with unlink_rasters when no longer needed.
+
+    Returns
+    -------
+    tuple : (list of paths to VRTs, GridPlan)
+    """
+    if plan is None:
+        plan = plan_common_grid(rasters, **plan_kwargs)
+    if str(out_dir).startswith('/vsimem'):
+        # Unique per call, so concurrent calls do not overwrite each other
+        out_suffix = '{}_{}'.format(out_suffix, uuid.uuid4().hex[:8])
+    aligned = []
+    for i, r in enumerate(rasters):
+        # Index avoids collisions between rasters with the same name
+        out_path = posixpath.join(str(out_dir), '{}{}_{}.vrt'.format(
+            Path(r).name.split('.')[0], out_suffix, i))
+        aligned.append(aligned_vrt(r, plan, out_path, resampleAlg=resampleAlg))
+
+    return aligned, plan
+
+
+def unlink_rasters(rasters):
+    """Remove rasters from /vsimem, ignoring those not in memory."""
+    for r in rasters:
+        if str(r).startswith('/vsimem'):
+            gdal.Unlink(str(r))
+
+
+def band_sources(rasters):
+    """Return (raster, band) pairs for every band of each raster, in order."""
+    sources = []
+    for r in rasters:
+        ds = gdal.Open(str(r))
+        sources.extend((str(r), b) for b in range(1, ds.RasterCount + 1))
+        ds = None
+
+    return sources
+
+
+def iter_blocks(rasters, band=1, block_rows=1024):
+    """
+    Read rasters on the same grid (e.g. from align_rasters) together, one
+    block of rows at a time.
+
+    Parameters
+    ----------
+    rasters : list
+        Paths to rasters, or (path, band) pairs, see band_sources.
+    band : int
+        Band to read of rasters given as paths.
+
+    Yields
+    ------
+    tuple : (row offset, list of masked arrays, one per raster, with
+             NoData and NaN masked)
+    """
+    sources = [r if isinstance(r, tuple) else (r, band) for r in rasters]
+    dss = {}
+    for path, _b in sources:
+        if path not in dss:
+            dss[path] = gdal.Open(str(path))
+    bands = [dss[path].GetRasterBand(b) for path, b in sources]
+    nodatas = [b.GetNoDataValue() for b in bands]
+    x_sz, y_sz = bands[0].XSize, bands[0].YSize
+    for yoff in range(0, y_sz, block_rows):
+        rows = min(block_rows, y_sz - yoff)
+        arrs = []
+        for b, nodata in zip(bands, nodatas):
+            arr = b.ReadAsArray(0, yoff, x_sz, rows)
+            arrs.append(np.ma.masked_array(arr, mask=~valid_pixels(arr, nodata)))
+        yield yoff, arrs
+    dss = None
+
+
+def streaming_min_max(rasters, block_rows=1024):
+    """
+    Minimum and maximum of the valid pixels of each of rasters (paths or
+    (path, band) pairs), in one pass over blocks.
+
+    Returns
+    -------
+    tuple : (np.ndarray of minimums, np.ndarray of maximums)
+    """
+    mins = np.full(len(rasters), np.inf)
+    maxs = np.full(len(rasters), -np.inf)
+    for _yoff, arrs in iter_blocks(rasters, block_rows=block_rows):
+        for i, arr in enumerate(arrs):
+            if arr.count() > 0:
+                mins[i] = min(mins[i], arr.min())
+                maxs[i] = max(maxs[i], arr.max())
+
+    return mins, maxs
+
+
+def _rescale(arr, vmin, vmax, out_min=0, out_max=1):
+    scale = (out_max - out_min) / (vmax - vmin) if vmax > vmin else 0
+    return (arr.astype(np.float64) - vmin) * scale + out_min
+
+
 def clip_minbb(rasters, in_mem=False, out_dir=None, out_suffix='_clip',
-               out_format='tif'):
+               out_format='tif', resampleAlg='cubic'):
     '''
-    Takes a list of rasters and translates (clips) them to the minimum bounding box.
+    Takes a list of rasters and clips them to the minimum bounding box, on
+    a common grid at the coarsest resolution. With out_format='vrt' only
+    VRTs pointing to the source windows are written.
+
+    Rasters not on the common grid (differing resolution or origin) are
+    resampled with resampleAlg, cubic by default. Previously each raster
+    was clipped with a projWin on its own grid (nearest pixel), so outputs
+    could differ in shape.
 
     Returns
     --------
     LIST : list of paths to the clipped rasters.
     '''
-    projWin = minimum_bounding_box(rasters)
-    logger.debug('Minimum bounding box: {}'.format(projWin))
+    plan = plan_common_grid(rasters)
+    logger.debug('Minimum bounding box: {}'.format(plan))
 
     #  Clip to minimum bounding box
     translated = []
-    for raster_p in rasters:
+    for i, raster_p in enumerate(rasters):
         if not out_dir and in_mem == False:
             out_dir = os.path.dirname(raster_p)
         elif not out_dir and in_mem==True:
@@ -377,8 +599,14 @@ def clip_minbb(rasters, in_mem=False, out_dir=None, out_suffix='_clip',
 
         raster_op = os.path.join(out_dir, raster_out_name)
 
-        raster_ds = gdal.Open(raster_p)
-        output = gdal.Translate(raster_op, raster_ds, projWin=projWin)
+        if out_format == 'vrt':
+            output = aligned_vrt(raster_p, plan, raster_op, resampleAlg=resampleAlg)
+        else:
+            vrt = aligned_vrt(raster_p, plan,
+                              '/vsimem/clip_minbb_{}_{}.vrt'.format(uuid.uuid4().hex[:8], i),
+                              resampleAlg=resampleAlg)
+            output = gdal.Translate(raster_op, vrt)
+            gdal.Unlink(vrt)
         if output is not None:
             translated.append(raster_op)
         else:
@@ -448,15 +676,20 @@ def gdal_polygonize(img, out_vec, band=1, fieldname='label', overwrite=True):
     return status
 
 
-def match_pixel_size(rasters, dst_dir=None, sfx=None, resampleAlg='cubic', in_mem=False):
-
+def match_pixel_size(rasters, dst_dir=None, sfx=None, resampleAlg='cubic',
+                     in_mem=False, out_format='vrt'):
+    """
+    Resample rasters to the coarsest pixel size among them, keeping each
+    raster's extent. The coarsest raster is returned as is. With
+    out_format='vrt' only VRTs with the resampling set are written.
+    """
     rasters = [Path(r) for r in rasters]
     rasters_res = {}
     for r in rasters:
         src = gdal.Open(str(r))
         gt = src.GetGeoTransform()
         rasters_res[r] = (gt[1], gt[5])
-        src1 = None
+        src = None
 
     max_x_raster = max(rasters_res.keys(), key=lambda k: abs(rasters_res[k][0]))
     max_y_raster = max(rasters_res.keys(), key=lambda k: abs(rasters_res[k][1]))
@@ -477,13 +710,19 @@ def match_pixel_size(rasters, dst_dir=None, sfx=None, resampleAlg='cubic', in_me
                 dst_dir = r.parent
             if not sfx:
                 sfx = 'match_px_sz'
-            dst = dst_dir / '{}_{}{}'.format(r.stem, sfx, r.suffix)
+            suffix = '.vrt' if out_format == 'vrt' else r.suffix
+            dst = Path(dst_dir) / '{}_{}{}'.format(r.stem, sfx, suffix)
             if in_mem:
                 dst = dst.as_posix()
             logger.info('Translating: {}'.format(r))
             logger.info('Destination: {}'.format(dst))
-            trans_opts = gdal.TranslateOptions(xRes=max_x, yRes=max_y, resampleAlg=resampleAlg)
-            output = gdal.Translate(destName=str(dst), srcDS=str(r), options=trans_opts)
+            # Raster's own extent, on its own grid origin, at the coarser size
+            plan = plan_common_grid([r], res=(max_x, max_y), extent='union')
+            if out_format == 'vrt':
+                aligned_vrt(r, plan, dst, resampleAlg=resampleAlg)
+            else:
+                trans_opts = gdal.TranslateOptions(xRes=max_x, yRes=max_y, resampleAlg=resampleAlg)
+                gdal.Translate(destName=str(dst), srcDS=str(r), options=trans_opts)
             outputs.append(dst)
 
     return outputs
@@ -535,24 +774,206 @@ def rescale_raster(raster, out_raster, out_min=0, out_max=1):
     return ds
 
 
-def stack_rasters(rasters, out, rescale=False, rescale_min=0, rescale_max=1):
-    if rescale:
-        rescaled = []
-        for r in rasters:
-            logger.info("Rescaling {}".format(r))
-            rescaled_name = r'/vsimem/{}_rescale.vrt'.format(Path(r).stem)
-            rescale_raster(str(r), rescaled_name, out_min=rescale_min, out_max=rescale_max)
-            rescaled.append(rescaled_name)
-        rasters = rescaled
+def stack_rasters(rasters, out, rescale=False, rescale_min=0, rescale_max=1,
+                  minbb=False, block_rows=1024):
+    """
+    Stack the bands of rasters into a multiband raster.
 
-    logger.info('Building stacked VRT...')
-    temp = r'/vsimem/stack.vrt'
-    gdal.BuildVRT(temp, rasters, separate=True)
+    Bands are read and written one block of rows at a time, so only one
+    block per band is in memory. Rescaling uses each band's min / max of
+    valid pixels, computed in one streaming pass over all bands. If out
+    is a .vrt only a VRT referencing the inputs (with scaling, if
+    rescaling) is written, see stacked_vrt. With minbb, the aligned VRTs
+    it references are written next to out.
 
+    Parameters
+    ----------
+    rasters : list
+        Paths to rasters on the same grid, unless minbb.
+    out : str
+        Path to write the stacked raster to.
+    rescale : bool
+        Rescale each band to rescale_min - rescale_max.
+    minbb : bool
+        Align rasters to the grid of their overlap first, see
+        align_rasters. Rasters not on that grid are resampled (cubic).
+
+    Returns
+    -------
+    str : out
+    """
+    rescale_min = 0 if rescale_min is None else rescale_min
+    rescale_max = 1 if rescale_max is None else rescale_max
+    out_vrt = str(out).lower().endswith('.vrt')
+    aligned = []
+    if minbb:
+        # A VRT output references the aligned VRTs, so they must outlive
+        # this process
+        out_dir = os.path.dirname(os.path.abspath(str(out))) if out_vrt else r'/vsimem'
+        rasters, _plan = align_rasters(rasters, out_dir=out_dir, out_suffix='_stack')
+        aligned = [] if out_vrt else rasters
+    sources = band_sources(rasters)
+
+    scales = None
+    if rescale:
+        logger.info('Computing band statistics...')
+        mins, maxs = streaming_min_max(sources, block_rows=block_rows)
+        scales = [(vmin, vmax, rescale_min, rescale_max)
+                  for vmin, vmax in zip(mins, maxs)]
+
+    if out_vrt:
+        logger.info('Building stacked VRT...')
+        return stacked_vrt(sources, out, scales=scales)
+
+    ref = gdal.Open(sources[0][0])
+    ref_band = ref.GetRasterBand(sources[0][1])
+    nodata_val = ref_band.GetNoDataValue()
+    if nodata_val is None:
+        nodata_val = -9999
+    dtype = gdal.GDT_Float32 if rescale else ref_band.DataType
     logger.info('Writing to: {}'.format(out))
-    out_ds = gdal.Translate(out, temp)
+    out_ds = gdal.GetDriverByName('GTiff').Create(str(out), ref.RasterXSize,
+                                                  ref.RasterYSize, len(sources),
+                                                  dtype, options=['TILED=YES',
+                                                                  'BIGTIFF=IF_SAFER'])
+    out_ds.SetGeoTransform(ref.GetGeoTransform())
+    out_ds.SetProjection(ref.GetProjection())
+    ref = None
+    out_bands = [out_ds.GetRasterBand(i + 1) for i in range(len(sources))]
+    for b in out_bands:
+        b.SetNoDataValue(nodata_val)
+    for yoff, arrs in iter_blocks(sources, block_rows=block_rows):
+        for i, arr in enumerate(arrs):
+            if rescale:
+                arr = _rescale(arr, mins[i], maxs[i], rescale_min, rescale_max)
+            out_bands[i].WriteArray(arr.filled(nodata_val), 0, yoff)
+    out_ds = None
+    unlink_rasters(aligned)
+
+    return out
+
+
+def stacked_vrt(sources, out, scales=None):
+    """
+    Write a VRT with one band per (raster, band) of sources, on the grid
+    of the first raster, referencing the sources directly.
+
+    Parameters
+    ----------
+    sources : list
+        (path, band) pairs of rasters on the same grid, see band_sources.
+    out : str
+        Path to write the VRT to.
+    scales : list
+        (vmin, vmax, out_min, out_max) per source, to linearly rescale
+        source values (as gdal_translate -scale), written as Float32 bands.
+
+    Returns
+    -------
+    str : out
+    """
+    ref = gdal.Open(str(sources[0][0]))
+    x_sz, y_sz = ref.RasterXSize, ref.RasterYSize
+    vrt = gdal.GetDriverByName('VRT').Create(str(out), x_sz, y_sz, 0)
+    vrt.SetGeoTransform(ref.GetGeoTransform())
+    vrt.SetProjection(ref.GetProjection())
+    ref = None
+    for i, (r, b) in enumerate(sources):
+        ds = gdal.Open(str(r))
+        src_band = ds.GetRasterBand(b)
+        nodata_val = src_band.GetNoDataValue()
+        dtype = gdal.GDT_Float32 if scales else src_band.DataType
+        ds = None
+        # Absolute paths, so the VRT can be moved
+        path = str(r) if str(r).startswith('/vsi') else os.path.abspath(str(r))
+        rect = 'xOff="0" yOff="0" xSize="{}" ySize="{}"'.format(x_sz, y_sz)
+        source = ['<ComplexSource>',
+                  '<SourceFilename relativeToVRT="0">{}</SourceFilename>'.format(escape(path)),
+                  '<SourceBand>{}</SourceBand>'.format(b),
+                  '<SrcRect {} />'.format(rect),
+                  '<DstRect {} />'.format(rect)]
+        if nodata_val is not None:
+            source.append('<NODATA>{}</NODATA>'.format(nodata_val))
+        if scales:
+            vmin, vmax, out_min, out_max = scales[i]
+            ratio = (out_max - out_min) / (vmax - vmin) if vmax > vmin else 0
+            source.extend(['<ScaleOffset>{!r}</ScaleOffset>'.format(float(out_min - vmin * ratio)),
+                           '<ScaleRatio>{!r}</ScaleRatio>'.format(float(ratio))])
+        source.append('</ComplexSource>')
+        vrt.AddBand(dtype)
+        vrt_band = vrt.GetRasterBand(i + 1)
+        if nodata_val is not None:
+            vrt_band.SetNoDataValue(nodata_val)
+        vrt_band.SetMetadataItem('source_0', ''.join(source), 'new_vrt_sources')
+    vrt = None
+
+    return out
+
+
+def gdf2ogr_mem(geoms, srs=None, fields=None, geom_type=ogr.wkbUnknown,
+                lyr_name='mem'):
+    """
+    Create an in memory OGR layer from shapely geometries, without writing
+    to disk.
 
-    return out_ds
+    Parameters
+    ----------
+    geoms : iterable
+        Shapely geometries (e.g. GeoDataFrame.geometry).
+    srs : osr.SpatialReference, str
+        Spatial reference of the geometries, or WKT.
+    fields : dict
+        {field name: sequence of values} to add as attributes. Integer and
+        float values are written as OFTInteger64 / OFTReal fields,
+        anything else as OFTString.
+    geom_type : int
+        OGR geometry type of the layer.
+
+    Returns
+    -------
+    tuple : (ogr.DataSource, ogr.Layer) - the datasource must be kept in
+            scope while the layer is used.
+    """
+    if isinstance(srs, str):
+        srs_wkt = srs
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(srs_wkt)
+    fields = fields if fields else {}
+    ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    lyr = ds.CreateLayer(lyr_name, srs=srs, geom_type=geom_type)
+    field_types = {}
+    for name, values in fields.items():
+        kind = getattr(getattr(values, 'dtype', None), 'kind', None)
+        if kind in ('i', 'u', 'b'):
+            field_types[name] = ogr.OFTInteger64
+        elif kind == 'f':
+            field_types[name] = ogr.OFTReal
+        else:
+            field_types[name] = ogr.OFTString
+        lyr.CreateField(ogr.FieldDefn(name, field_types[name]))
+    field_values = {name: list(values) for name, values in fields.items()}
+
+    defn = lyr.GetLayerDefn()
+    lyr.StartTransaction()
+    for i, geom in enumerate(geoms):
+        if geom is None or geom.is_empty:
+            continue
+        feat = ogr.Feature(defn)
+        feat.SetGeometry(ogr.CreateGeometryFromWkb(geom.wkb))
+        for name, values in field_values.items():
+            value = values[i]
+            if field_types[name] == ogr.OFTInteger64:
+                value = int(value)
+            elif field_types[name] == ogr.OFTReal:
+                value = float(value)
+            else:
+                value = str(value)
+            feat.SetField(name, value)
+        lyr.CreateFeature(feat)
+        feat = None
+    lyr.CommitTransaction()
+
+    return ds, lyr
 
 
 def rasterize_shp2raster_extent(ogr_ds, gdal_ds,
@@ -640,6 +1061,222 @@ def rasterize_shp2raster_extent(ogr_ds, gdal_ds,
     return out_path
 
 
+def pixel_window(gt, x_sz, y_sz, bounds):
+    """
+    Return the pixel window (xoff, yoff, cols, rows) of a north-up raster
+    covering bounds (minx, miny, maxx, maxy), clipped to the raster, or
+    None if bounds are outside the raster.
+    """
+    minx, miny, maxx, maxy = bounds
+    x0 = max(int(np.floor((minx - gt[0]) / gt[1])), 0)
+    x1 = min(int(np.ceil((maxx - gt[0]) / gt[1])), x_sz)
+    y0 = max(int(np.floor((maxy - gt[3]) / gt[5])), 0)
+    y1 = min(int(np.ceil((miny - gt[3]) / gt[5])), y_sz)
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def valid_pixels(arr, nodata_val=None):
+    """Boolean array of pixels of arr that are not NoData (or NaN)."""
+    valid = ~np.isnan(arr) if arr.dtype.kind == 'f' else np.ones(arr.shape, dtype=bool)
+    if nodata_val is not None and not np.isnan(nodata_val):
+        valid &= arr != nodata_val
+
+    return valid
+
+
+def raster_is_empty(raster, band=1, approx=False, block_rows=1024):
+    """
+    Whether a raster band holds only NoData, checked as cheaply as
+    possible: stored statistics, then unwritten (sparse) blocks, then the
+    smallest overview, and only then the band itself, read in row blocks
+    and stopping at the first valid pixel.
+
+    Parameters
+    ----------
+    raster : str
+    band : int
+    approx : bool
+        Trust an overview with no valid pixels, rather than reading the
+        full resolution band to confirm (sparse data can be lost when
+        overviews are built).
+    block_rows : int
+        Rows read at a time from the full resolution band.
+
+    Returns
+    -------
+    bool
+    """
+    ds = gdal.Open(raster)
+    rb = ds.GetRasterBand(band)
+    nodata_val = rb.GetNoDataValue()
+    x_sz, y_sz = ds.RasterXSize, ds.RasterYSize
+
+    # Statistics stored with the raster (e.g. in .aux.xml) are computed over
+    # valid pixels only
+    valid_percent = rb.GetMetadataItem('STATISTICS_VALID_PERCENT')
+    if valid_percent is not None:
+        return float(valid_percent) == 0
+    if rb.GetMetadataItem('STATISTICS_MINIMUM') is not None:
+        return False
+
+    if nodata_val is not None and hasattr(rb, 'GetDataCoverageStatus'):
+        # Blocks never written hold NoData
+        flags, _ = rb.GetDataCoverageStatus(0, 0, x_sz, y_sz)
+        if flags == gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY:
+            return True
+
+    if rb.GetOverviewCount() > 0:
+        ovr = rb.GetOverview(rb.GetOverviewCount() - 1)
+        if valid_pixels(ovr.ReadAsArray(), nodata_val).any():
+            return False
+        if approx:
+            return True
+
+    for yoff in range(0, y_sz, block_rows):
+        rows = min(block_rows, y_sz - yoff)
+        if valid_pixels(rb.ReadAsArray(0, yoff, x_sz, rows), nodata_val).any():
+            return False
+
+    return True
+
+
+def sample_raster(raster, xs, ys, band=1, block_rows=1024):
+    """
+    Sample a raster at points, reading only the row blocks (and columns)
+    that contain points.
+
+    Parameters
+    ----------
+    raster : str / gdal.Dataset
+    xs, ys : np.ndarray
+        Point coordinates, in the raster's coordinate system.
+    band : int
+    block_rows : int
+        Number of rows to read at a time.
+
+    Returns
+    -------
+    tuple : (values as float64, NaN outside the raster; boolean array of
+             points with valid, non-NoData values)
+    """
+    ds = raster if isinstance(raster, gdal.Dataset) else gdal.Open(str(raster))
+    gt = ds.GetGeoTransform()
+    rb = ds.GetRasterBand(band)
+    nodata_val = rb.GetNoDataValue()
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+
+    with np.errstate(invalid='ignore'):
+        px = np.floor((xs - gt[0]) / gt[1])
+        py = np.floor((ys - gt[3]) / gt[5])
+    inside = ((px >= 0) & (px < ds.RasterXSize) &
+              (py >= 0) & (py < ds.RasterYSize))
+    values = np.full(len(xs), np.nan)
+    valid = np.zeros(len(xs), dtype=bool)
+    pos = np.flatnonzero(inside)
+    px = px[pos].astype(np.int64)
+    py = py[pos].astype(np.int64)
+
+    blocks = py // block_rows
+    order = np.argsort(blocks, kind='stable')
+    starts = np.flatnonzero(np.r_[True, blocks[order][1:] != blocks[order][:-1]])
+    for s, e in zip(starts, np.r_[starts[1:], len(order)]):
+        sel = order[s:e]
+        y0 = blocks[sel[0]] * block_rows
+        rows = min(block_rows, ds.RasterYSize - y0)
+        x0 = px[sel].min()
+        cols = px[sel].max() - x0 + 1
+        arr = rb.ReadAsArray(int(x0), int(y0), int(cols), int(rows))
+        block_values = arr[py[sel] - y0, px[sel] - x0]
+        values[pos[sel]] = block_values
+        valid[pos[sel]] = valid_pixels(block_values, nodata_val)
+
+    return values, valid
+
+
+def label_pixel_counts(geoms, raster, band=1, srs=None, all_touched=False,
+                       block_rows=1024):
+    """
+    Count the pixels of a raster under each geometry, and how many of those
+    are valid (not NoData), by rasterizing geometry labels onto the raster
+    grid one block of rows at a time. Only the window covering geoms is
+    read. Where geometries overlap, pixels are counted for the last one.
+
+    Parameters
+    ----------
+    geoms : iterable
+        Shapely geometries, in the raster's coordinate system.
+    raster : str / gdal.Dataset
+    band : int
+    srs : osr.SpatialReference, str
+        Spatial reference of geoms, the raster's if not provided.
+    all_touched : bool
+        Count all pixels touched by a geometry, rather than pixels whose
+        centers are within it.
+    block_rows : int
+        Number of rows to rasterize and read at a time.
+
+    Returns
+    -------
+    tuple : (np.ndarray of pixel counts, np.ndarray of valid pixel counts),
+            one per geometry
+    """
+    ds = raster if isinstance(raster, gdal.Dataset) else gdal.Open(str(raster))
+    gt = ds.GetGeoTransform()
+    rb = ds.GetRasterBand(band)
+    nodata_val = rb.GetNoDataValue()
+    geoms = list(geoms)
+    n = len(geoms)
+    n_pixels = np.zeros(n + 1, dtype=np.int64)
+    n_valid = np.zeros(n + 1, dtype=np.int64)
+
+    bounds = [g.bounds for g in geoms if g is not None and not g.is_empty]
+    window = None
+    if bounds:
+        bounds = np.array(bounds)
+        window = pixel_window(gt, ds.RasterXSize, ds.RasterYSize,
+                              (bounds[:, 0].min(), bounds[:, 1].min(),
+                               bounds[:, 2].max(), bounds[:, 3].max()))
+    if window is None:
+        return n_pixels[1:], n_valid[1:]
+
+    # Labels are 1-based positions, 0 is background
+    srs = srs if srs is not None else ds.GetProjection()
+    ogr_ds, lyr = gdf2ogr_mem(geoms, srs=srs,
+                              fields={'label': np.arange(1, n + 1)})
+    options = ['ATTRIBUTE=label']
+    if all_touched:
+        options.append('ALL_TOUCHED=TRUE')
+    xoff, yoff, cols, rows = window
+    mem = gdal.GetDriverByName('MEM')
+    for y0 in range(yoff, yoff + rows, block_rows):
+        block = min(block_rows, yoff + rows - y0)
+        ulx = gt[0] + xoff * gt[1]
+        uly = gt[3] + y0 * gt[5]
+        lyr.SetSpatialFilterRect(ulx, uly + block * gt[5], ulx + cols * gt[1], uly)
+        if lyr.GetFeatureCount() == 0:
+            continue
+        label_ds = mem.Create('', cols, block, 1, gdal.GDT_Int32)
+        label_ds.SetGeoTransform((ulx, gt[1], 0, uly, 0, gt[5]))
+        label_ds.SetProjection(ds.GetProjection())
+        gdal.RasterizeLayer(label_ds, [1], lyr, options=options)
+        labels = label_ds.ReadAsArray()
+        label_ds = None
+
+        in_geom = labels > 0
+        arr = rb.ReadAsArray(xoff, y0, cols, block)
+        n_pixels += np.bincount(labels[in_geom], minlength=n + 1)
+        n_valid += np.bincount(labels[in_geom & valid_pixels(arr, nodata_val)],
+                               minlength=n + 1)
+    lyr.SetSpatialFilter(None)
+    ogr_ds = None
+
+    return n_pixels[1:], n_valid[1:]
+
+
 # v = r'E:\disbr007\umn\2020sep27_eureka\rts_test2021jan18\classified\rts_class_out.shp'
 # rs = r'E:\disbr007\umn\2020sep27_eureka\dems\sel' \
 #      r'\WV02_20140703_1030010033A84300_1030010032B54F00_test_aoi' \
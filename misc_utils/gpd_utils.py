@@ -14,9 +14,10 @@ from pathlib import Path
 import fiona
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Point, LineString, Polygon
-from shapely.ops import split
+from shapely.geometry import Point, Polygon, box
+from scipy.sparse import coo_matrix
 from scipy.sparse.csgraph import connected_components
+from shapely.ops import unary_union
 from tqdm import tqdm
 
 import multiprocessing
@@ -26,15 +27,40 @@ from misc_utils.logging_utils import create_logger
 
 logger = create_logger(__name__, 'sh', 'DEBUG')
 
-
-def multiprocess_gdf(fxn, gdf, *args, num_cores=None, **kwargs):
-    from joblib import Parallel, delayed
-    num_cores = num_cores if num_cores else multiprocessing.cpu_count() - 2
-    split_dfs = [gdf.iloc[[i]] for i in range(len(gdf))]
-    # Run fxn in counts
-    results = Parallel(n_jobs=num_cores)(delayed(fxn)(i, *args, **kwargs) for i in tqdm.tqdm(split_dfs))
-    # Combine individual gdfs back into one
-    output = pd.concat(results)
+try:
+    # Bulk spatial index queries and unions, shapely >= 2.0
+    from shapely import STRtree, union_all
+    from shapely import box as shp_box, intersection as shp_intersection, area as shp_area
+except ImportError:
+    STRtree = None
+    union_all = None
+    shp_intersection = None
+
+try:
+    # Vectorized OGR reads and writes
+    import pyogrio
+    try:
+        # Reading through Arrow streams requires GDAL >= 3.6
+        import pyarrow
+        OGR_ARROW = pyogrio.__gdal_version__ >= (3, 6, 0)
+    except ImportError:
+        OGR_ARROW = False
+except ImportError:
+    pyogrio = None
+    OGR_ARROW = False
+
+
+def multiprocess_gdf(fxn, gdf, *args, num_cores=None, by='rows', shared=None,
+                     **kwargs):
+    """
+    Apply fxn to chunks of rows of gdf in parallel, returning the combined
+    results in the order of gdf. fxn is called as
+    fxn(chunk, *args, **shared, **kwargs). See
+    misc_utils.parallel_apply.parallel_apply.
+    """
+    from misc_utils.parallel_apply import parallel_apply
+    output = parallel_apply(fxn, gdf, *args, n_jobs=num_cores, by=by,
+                            shared=shared, **kwargs)
 
     return output
 
@@ -50,192 +76,71 @@ def merge_gdfs(gdfs):
     return gdf
 
 
-## Function begins
+def _grid_cells(geoms, nrows, ncols):
+    """
+    Clip an nrows x ncols grid over the bounding box of each geometry to
+    the geometry, for all geometries at once.
+
+    Returns
+    -------
+    tuple : (position of source geometry of each cell, cells)
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    bounds = np.array([g.bounds for g in geoms]).reshape(-1, 4)
+    minx, miny, maxx, maxy = [bounds[:, i, None, None] for i in range(4)]
+    # Cell edges as fractions of each bounding box, cells are ordered by
+    # feature, then row (bottom up), then column
+    fx = np.arange(ncols) / ncols
+    fy = (np.arange(nrows) / nrows)[:, None]
+    width = (maxx - minx)
+    height = (maxy - miny)
+    x0 = (minx + width * fx).repeat(nrows, axis=1)
+    x1 = (minx + width * (fx + 1 / ncols)).repeat(nrows, axis=1)
+    y0 = (miny + height * fy).repeat(ncols, axis=2)
+    y1 = (miny + height * (fy + 1 / nrows)).repeat(ncols, axis=2)
+    x0, y0, x1, y1 = [a.ravel() for a in (x0, y0, x1, y1)]
+    src = np.repeat(np.arange(len(geoms)), nrows * ncols)
+
+    if shp_intersection is not None:
+        cells = shp_intersection(geoms[src], shp_box(x0, y0, x1, y1))
+        keep = shp_area(cells) > 0
+    else:
+        cells = np.array([geoms[i].intersection(box(*c))
+                          for i, c in zip(src, zip(x0, y0, x1, y1))], dtype=object)
+        keep = np.array([c.area > 0 for c in cells], dtype=bool)
+
+    return src[keep], cells[keep]
+
+
 def grid_poly(poly_gdf, nrows, ncols):
     '''
     Takes a geodataframe with Polygon geom and creates a grid of nrows and ncols 
-    in its bounding box
+    in the bounding box of each feature, clipped to the feature. Each cell
+    keeps the attributes of its feature.
     poly: geodataframe with Polygon geometry
     nrows: number of rows in grid
     ncols: numner of cols in grid
     '''
-    
-    def multiline_split(polygon, split_lines):
-        '''
-        Split a shapely Polygon by shapely LineStrings
-        '''
-        base = polygon
-        split_polygons = []
-        # For each line in split lines (3)
-        for i, ln in enumerate(split_lines):
-            # Split base at the line, returning two parts
-            chopped = list(split(base, ln))
-            keep = chopped[0]
-            base = chopped[1]
-            # Want to keep the smaller area, rechop the bigger, so switch if necessary
-            # Output of shapely.ops.split ambiguous in returning smaller or bigger pieces first or second
-            if keep.area > base.area:
-                keep, base = base, keep
-            split_polygons.append(keep)
-            if i == len(split_lines)-1:
-                split_polygons.append(base)
-                break
-        return split_polygons
-
-
-    # Get meta from input gdf
-    crs = poly_gdf.crs
-    cols = list(poly_gdf)
-    cols.remove('geometry')
-    
-    # Determine how many split lines
-    num_row_split_pts = nrows - 1
-    num_col_split_pts = ncols - 1
-    
-    master_gdf = gpd.GeoDataFrame(columns=cols, crs=crs)
-    
-    for i in tqdm(range(len(poly_gdf))):
-
-        feat = poly_gdf.iloc[[i]]
-
-        p = feat.geometry.values[0]
-
-        minx, miny, maxx, maxy = p.bounds
-        
-        top = LineString([(minx, maxy), (maxx, maxy)])
-        left = LineString([(minx, miny), (minx, maxy)])
-        
-        ## Make vertical split lines
-        v_splt_lns = []
-        length = top.length
-        step = length / nrows
-        dist = 0
-        for n in range(num_row_split_pts):
-            dist += step
-            top_pt = top.interpolate(dist)
-            bot_pt = Point(top_pt.x, miny)
-            ln = LineString([top_pt, bot_pt])
-            v_splt_lns.append(ln)
-            
-        ## Make horizontal split lines
-        h_splt_lns = []
-        length = left.length
-        step = length / ncols
-        dist = 0
-        for n in range(num_col_split_pts):
-            dist += step
-            left_pt = left.interpolate(dist)
-            right_pt = Point(maxx, left_pt.y)
-            ln = LineString([left_pt, right_pt])
-            h_splt_lns.append(ln)
-        
-        ## Cells for each feature
-        feat_cells = []
-        
-        # Split into rows
-        intermed_geoms = multiline_split(p, v_splt_lns)
-        
-        
-        # Split into columns
-        for g in intermed_geoms:
-            cells = multiline_split(g, h_splt_lns)
-            for cell in cells:
-                feat_cells.append(cell)
-                
-        # Create gdf of current feature's newly created cells
-        feat_gdf = gpd.GeoDataFrame(geometry=feat_cells, crs=crs)
-        
-        ## Add information from current feature to all newly created cells **SLOW**
-        for col in cols:
-            feat_gdf[col] = poly_gdf[i:i+1][col].values[0]
-        
-        # Merge current feature with master
-        master_gdf = merge_gdf(master_gdf, feat_gdf)
+    src, cells = _grid_cells(poly_gdf.geometry.values, nrows, ncols)
+    master_gdf = poly_gdf.drop(columns=poly_gdf.geometry.name).iloc[src]
+    master_gdf = gpd.GeoDataFrame(master_gdf.reset_index(drop=True),
+                                  geometry=list(cells) if shp_intersection is None else cells,
+                                  crs=poly_gdf.crs)
 
     return master_gdf
 
 
-## Function begins
 def grid_poly_row(row, nrows, ncols):
     '''
-    Takes a geodataframe with Polygon geom and creates a grid of nrows and ncols in its bounding box
-    poly: geodataframe with Polygon geometry
+    Takes a row of a geodataframe with Polygon geom and creates a grid of nrows
+    and ncols in its bounding box, clipped to the feature
+    row: row (pd.Series) with Polygon geometry
     nrows: number of rows in grid
     ncols: numner of cols in grid
     '''
-    
-    def multiline_split(polygon, split_lines):
-        '''
-        Split a shapely Polygon by shapely LineStrings
-        '''
-        base = polygon
-        split_polygons = []
-        # For each line in split lines (3)
-        for i, ln in enumerate(split_lines):
-            # Split base at the line, returning two parts
-            chopped = list(split(base, ln))
-            keep = chopped[0]
-            base = chopped[1]
-            # Want to keep the smaller area, rechop the bigger, so switch if necessary
-            # Output of shapely.ops.split ambiguous in returning smaller or bigger pieces first or second
-            if keep.area > base.area:
-                keep, base = base, keep
-            split_polygons.append(keep)
-            if i == len(split_lines)-1:
-                split_polygons.append(base)
-                break
-        return split_polygons
-
-
-    # Determine how many split lines
-    num_row_split_pts = nrows - 1
-    num_col_split_pts = ncols - 1
-    
-    feat = row
-    p = feat.geometry
-    minx, miny, maxx, maxy = feat.geometry.bounds
-    
-    top = LineString([(minx, maxy), (maxx, maxy)])
-    left = LineString([(minx, miny), (minx, maxy)])
-    
-    ## Create split lines
-    ## vertical split lines
-    v_splt_lns = []
-    length = top.length
-    step = length / nrows
-    dist = 0
-    for n in range(num_row_split_pts):
-        dist += step
-        top_pt = top.interpolate(dist)
-        bot_pt = Point(top_pt.x, miny)
-        ln = LineString([top_pt, bot_pt])
-        v_splt_lns.append(ln)
-    ## horizontal split lines
-    h_splt_lns = []
-    length = left.length
-    step = length / ncols
-    dist = 0
-    for n in range(num_col_split_pts):
-        dist += step
-        left_pt = left.interpolate(dist)
-        right_pt = Point(maxx, left_pt.y)
-        ln = LineString([left_pt, right_pt])
-        h_splt_lns.append(ln)
-    
-    ## Cells for each feature
-    feat_cells = []
-    
-    # Split into rows
-    intermed_geoms = multiline_split(p, v_splt_lns)
-    
-    
-    # Split into columns
-    for g in intermed_geoms:
-        cells = multiline_split(g, h_splt_lns)
-        for cell in cells:
-            feat_cells.append(cell)
-            
-    return feat_cells
+    _, feat_cells = _grid_cells([row.geometry], nrows, ncols)
+
+    return list(feat_cells)
 
 
 def coords2gdf(xs, ys, epsg=4326):
@@ -329,26 +234,80 @@ def explode_multi(gdf):
     return gdf_out
 
 
+# Formats written through Arrow, and OGR drivers for other formats
+ARROW_FORMATS = ('parquet', 'geoparquet')
+OGR_DRIVERS = {'shp': 'ESRI Shapefile',
+               'geojson': 'GeoJSON',
+               'gpkg': 'GPKG',
+               'fgb': 'FlatGeobuf'}
+
+
 def datetime2str_df(df, date_format='%Y-%m-%d %H:%M:%S'):
-    # Convert datetime columns to str
+    # Convert datetime columns to str, replacing (rather than writing into)
+    # each column so shallow copies do not alter their source
+    date_format = date_format if date_format else '%Y-%m-%d %H:%M:%S'
     date_cols = df.select_dtypes(include=['datetime64']).columns
     for dc in date_cols:
-        df[dc] = df[dc].apply(lambda x: x.strftime('%Y-%m-%d %H:%M:%S'))
+        _replace_col(df, dc, df[dc].dt.strftime(date_format))
 
 
-def write_gdf(src_gdf, out_footprint, to_str_cols=None,
-              out_format=None, date_format=None,
-              nan_to=None,
-              overwrite=True,
-              **kwargs):
-    gdf = copy.deepcopy(src_gdf)
+def _replace_col(df, col, values):
+    loc = df.columns.get_loc(col)
+    del df[col]
+    df.insert(loc, col, values)
 
+
+def list2str_col(series, sep=','):
+    """
+    Join list-like (or dict keys) values of series into strings, with
+    empty or null values as ''.
+    """
+    index = series.index
+    series = series.map(lambda v: list(v) if isinstance(v, dict) else v).reset_index(drop=True)
+    exploded = series.explode()
+    joined = exploded[exploded.notna()].astype(str).groupby(level=0).agg(sep.join)
+    # Non list-like values (already strings) are kept
+    scalar = ~series.map(lambda v: isinstance(v, (list, tuple, set, np.ndarray)))
+    out = pd.Series('', index=series.index, dtype=object)
+    out.loc[joined.index] = joined
+    out[scalar & series.notna()] = series[scalar & series.notna()].astype(str)
+    out.index = index
+
+    return out
+
+
+def _parse_out_path(out_footprint, out_format=None):
+    """Return (format, file path, layer) for an output path."""
     if not isinstance(out_footprint, pathlib.PurePath):
         out_footprint = Path(out_footprint)
+    layer = None
+    if not out_format:
+        out_format = out_footprint.suffix.replace('.', '')
+        if not out_format:
+            # if still no extension, check if gpkg (package.gpkg/layer)
+            out_format = out_footprint.parent.suffix.replace('.', '')
+            if not out_format:
+                logger.error('Could not recognize out format from file extension: {}'.format(out_footprint))
+    out_format = out_format.lower()
+    if out_format == 'gpkg':
+        if out_footprint.suffix == '.gpkg':
+            layer = out_footprint.stem
+        else:
+            layer = out_footprint.stem
+            out_footprint = out_footprint.parent
 
-    # convert NaNs to empty string
+    return out_format, out_footprint, layer
+
+
+def _prep_for_ogr(gdf, to_str_cols=None, date_format=None, nan_to=None):
+    """
+    Convert columns OGR formats cannot store. Columns are replaced on a
+    shallow copy, so neither the data nor the geometries are copied.
+    """
     if nan_to:
-        gdf = gdf.replace(np.nan, nan_to, regex=True)
+        gdf = gdf.fillna(nan_to)
+    else:
+        gdf = gdf.copy(deep=False)
 
     # remove datetime - specifiy datetime if desired format
     if not gdf.select_dtypes(include=['datetime64']).columns.empty:
@@ -358,53 +317,495 @@ def write_gdf(src_gdf, out_footprint, to_str_cols=None,
     if to_str_cols:
         for col in to_str_cols:
             logger.debug('Converting to string field: {}'.format(col))
-            gdf[col] = [','.join(map(str, l)) if isinstance(l, (dict, list))
-                        and len(l) > 0 else '' for l in gdf[col]]
+            _replace_col(gdf, col, list2str_col(gdf[col]))
 
-    logger.debug('Writing to file: {}'.format(out_footprint))
-    if not out_format:
-        out_format = out_footprint.suffix.replace('.', '')
-        if not out_format:
-            # if still no extension, check if gpkg (package.gpkg/layer)
-            out_format = out_footprint.parent.suffix
-            if not out_format:
-                logger.error('Could not recognize out format from file extension: {}'.format(out_footprint))
+    return gdf
+
+
+def _geo_metadata(gdf, geometry_types=None):
+    """GeoParquet 'geo' metadata for the geometry column of gdf."""
+    geom_col = gdf.geometry.name
+    crs = gdf.crs
+    if crs is not None:
+        from pyproj import CRS
+        crs = CRS.from_user_input(crs).to_json_dict()
+    column = {'encoding': 'WKB',
+              'geometry_types': geometry_types if geometry_types is not None else [],
+              'crs': crs}
+    return {'version': '1.0.0', 'primary_column': geom_col,
+            'columns': {geom_col: column}}
+
+
+def gdf_to_arrow(gdf, geometry_types=None):
+    """
+    Convert a GeoDataFrame to a pyarrow Table with WKB geometry and
+    GeoParquet metadata. List columns are stored as Arrow lists and
+    datetimes as timestamps.
+    """
+    import json
+    import pyarrow as pa
+    from misc_utils.parallel_apply import geoms_to_wkb
 
-    if out_footprint.exists():
-        if overwrite:
-            logger.warning('Overwriting existing file: '
-                           '{}'.format(out_footprint))
-            os.remove(out_footprint)
+    geom_col = gdf.geometry.name
+    cols = [c for c in gdf.columns if c != geom_col]
+    table = pa.Table.from_pandas(pd.DataFrame(gdf[cols]), preserve_index=False)
+    wkbs = pa.array(geoms_to_wkb(gdf.geometry.values), type=pa.binary())
+    table = table.append_column(geom_col, wkbs)
+    if geometry_types is None:
+        geometry_types = sorted(gdf.geometry.geom_type.dropna().unique())
+    meta = dict(table.schema.metadata or {})
+    meta[b'geo'] = json.dumps(_geo_metadata(gdf, geometry_types)).encode('utf-8')
+
+    return table.replace_schema_metadata(meta)
+
+
+class GDFWriter:
+    """
+    Write GeoDataFrames to a file in batches.
+
+    Parquet is written through pyarrow, one row group per batch. Other
+    formats are written with pyogrio if it is installed, otherwise with
+    fiona, appending each batch after the first. FlatGeobuf requires GDAL
+    >= 3.1.
+
+    Parameters
+    ----------
+    out_footprint : str / Path
+        Output path, 'package.gpkg/layer' for a GeoPackage layer.
+    out_format : str
+        One of ARROW_FORMATS or OGR_DRIVERS keys, from the extension if
+        not provided.
+    to_str_cols : list
+        Columns of lists to join into strings, for non-Arrow formats.
+    date_format : str
+        strftime format for datetime columns, for non-Arrow formats.
+    nan_to : value to replace NaNs with, for non-Arrow formats.
+    overwrite : bool
+        Overwrite an existing file.
+    """
+
+    def __init__(self, out_footprint, out_format=None, to_str_cols=None,
+                 date_format=None, nan_to=None, overwrite=True, **kwargs):
+        self.out_format, self.path, self.layer = _parse_out_path(out_footprint,
+                                                                 out_format)
+        self.to_str_cols = to_str_cols
+        self.date_format = date_format
+        self.nan_to = nan_to
+        # Written in one batch, so geometry types can be recorded
+        self.single_batch = kwargs.pop('single_batch', False)
+        self.compression = kwargs.pop('compression', 'snappy')
+        self.kwargs = kwargs
+        self.n_written = 0
+        self._writer = None
+        self._schema = None
+        self.skip = False
+        if self.out_format not in ARROW_FORMATS and self.out_format not in OGR_DRIVERS:
+            logger.error('Unrecognized format: {}'.format(self.out_format))
+            raise ValueError('Unrecognized format: {}'.format(self.out_format))
+
+        if self.path.exists() and not (self.out_format == 'gpkg' and self.layer):
+            if overwrite:
+                logger.warning('Overwriting existing file: '
+                               '{}'.format(self.path))
+                os.remove(self.path)
+            else:
+                logger.warning('Out file exists and overwrite not specified, '
+                               'skipping writing.')
+                self.skip = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, gdf):
+        """Write a batch of features."""
+        if self.skip or len(gdf) == 0:
+            return
+        if self.out_format in ARROW_FORMATS:
+            self._write_arrow(gdf)
         else:
-            logger.warning('Out file exists and overwrite not specified, '
-                           'skipping writing.')
-            return None
-
-    # write out in format specified
-    if out_format == 'shp':
-        gdf.to_file(out_footprint, **kwargs)
-    elif out_format == 'geojson':
-        if gdf.crs != 4326:
+            self._write_ogr(gdf)
+        self.n_written += len(gdf)
+
+    def _write_arrow(self, gdf):
+        import pyarrow.parquet as pq
+        # Geometry types are not known ahead of all batches when streaming
+        table = gdf_to_arrow(gdf, geometry_types=None if self.single_batch else [])
+        if self._writer is None:
+            self._schema = table.schema
+            self._writer = pq.ParquetWriter(str(self.path), self._schema,
+                                            compression=self.compression)
+        elif not table.schema.equals(self._schema, check_metadata=False):
+            table = table.cast(self._schema)
+        self._writer.write_table(table)
+
+    def _write_ogr(self, gdf):
+        gdf = _prep_for_ogr(gdf, to_str_cols=self.to_str_cols,
+                            date_format=self.date_format, nan_to=self.nan_to)
+        if self.out_format == 'geojson' and gdf.crs != 4326:
             logger.warning('Attempting to write GeoDataFrame with non-WGS84 '
                            'CRS to GeoJSON. Reprojecting to WGS84.')
             gdf = gdf.to_crs('epsg:4326')
-        gdf.to_file(out_footprint,
-                    driver='GeoJSON', **kwargs)
-    elif out_format == 'gpkg':
-        gdf.to_file(out_footprint.parent, layer=out_footprint.stem,
-                    driver='GPKG', **kwargs)
+        driver = OGR_DRIVERS[self.out_format]
+        append = self.n_written > 0
+        kwargs = dict(self.kwargs)
+        if self.layer:
+            kwargs['layer'] = self.layer
+        if pyogrio is not None:
+            pyogrio.write_dataframe(gdf, str(self.path), driver=driver,
+                                    append=append, **kwargs)
+        else:
+            gdf.to_file(str(self.path), driver=driver,
+                        mode='a' if append else 'w', **kwargs)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def write_gdf(src_gdf, out_footprint, to_str_cols=None,
+              out_format=None, date_format=None,
+              nan_to=None,
+              overwrite=True,
+              **kwargs):
+    """
+    Write a GeoDataFrame to shp, geojson, gpkg, FlatGeobuf (fgb) or
+    GeoParquet (parquet). src_gdf is not modified or copied. For
+    GeoParquet, list and datetime columns are written natively, and
+    to_str_cols, date_format and nan_to are ignored. See GDFWriter to
+    write in batches.
+    """
+    logger.debug('Writing to file: {}'.format(out_footprint))
+    with GDFWriter(out_footprint, out_format=out_format,
+                   to_str_cols=to_str_cols, date_format=date_format,
+                   nan_to=nan_to, overwrite=overwrite,
+                   single_batch=True, **kwargs) as writer:
+        writer.write(src_gdf)
+
+
+def _parse_in_path(path, layer=None):
+    """Return (file path, layer) for an input path, which may be
+    'package.gpkg/layer'."""
+    path = Path(path)
+    if layer is None and not path.exists() and path.parent.suffix.lower() == '.gpkg':
+        layer = path.name
+        path = path.parent
+
+    return path, layer
+
+
+def _is_arrow_path(path):
+    return path.suffix.lower().replace('.', '') in ARROW_FORMATS
+
+
+def vector_info(path, layer=None):
+    """
+    Return the crs, field names and number of features of a vector file,
+    without reading any features.
+
+    Returns
+    -------
+    dict : {'crs': crs, 'fields': list, 'features': int}
+    """
+    path, layer = _parse_in_path(path, layer)
+    if _is_arrow_path(path):
+        import json
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(str(path))
+        schema = pf.schema.to_arrow_schema()
+        geo = json.loads(schema.metadata[b'geo'])
+        geom_col = geo['primary_column']
+        crs = geo['columns'][geom_col].get('crs')
+        if crs is not None:
+            from pyproj import CRS
+            crs = CRS.from_user_input(crs).to_wkt()
+        return {'crs': crs,
+                'fields': [n for n in schema.names if n != geom_col],
+                'features': pf.metadata.num_rows}
+    if pyogrio is not None:
+        info = pyogrio.read_info(str(path), layer=layer)
+        return {'crs': info['crs'], 'fields': list(info['fields']),
+                'features': info['features']}
+    with fiona.open(str(path), layer=layer) as src:
+        return {'crs': src.crs_wkt, 'fields': list(src.schema['properties']),
+                'features': len(src)}
+
+
+def _filter_geom(geom, path, layer):
+    """Return geom (shapely geometry or GeoDataFrame / GeoSeries) as a
+    single geometry in the crs of the file being read."""
+    if not hasattr(geom, 'geometry'):
+        return geom
+    src_crs = vector_info(path, layer)['crs']
+    if src_crs and geom.crs and geom.crs != src_crs:
+        geom = geom.to_crs(src_crs)
+    geom = geom.geometry if isinstance(geom, gpd.GeoDataFrame) else geom
+
+    return union_all(geom.values) if union_all is not None else unary_union(list(geom))
+
+
+def arrow_to_gdf(table, read_geometry=True):
+    """Convert a pyarrow Table with GeoParquet metadata and a WKB
+    geometry column to a GeoDataFrame."""
+    import json
+    from misc_utils.parallel_apply import wkb_to_geoms
+
+    geo = json.loads(table.schema.metadata[b'geo'])
+    geom_col = geo['primary_column']
+    crs = geo['columns'][geom_col].get('crs')
+    if crs is not None:
+        from pyproj import CRS
+        crs = CRS.from_user_input(crs).to_wkt()
+    df = table.drop([geom_col]).to_pandas()
+    if not read_geometry:
+        return df
+    geoms = wkb_to_geoms(table.column(geom_col).to_pandas().values)
+    gdf = gpd.GeoDataFrame(df, geometry=geoms, crs=crs)
+    if geom_col != 'geometry':
+        gdf = gdf.rename_geometry(geom_col)
+
+    return gdf
+
+
+def read_vector(path, layer=None, columns=None, bbox=None, mask=None,
+                where=None, limit=None, skip=0, read_geometry=True):
+    """
+    Read a vector file into a GeoDataFrame, reading only the features and
+    columns requested.
+
+    OGR formats are read with pyogrio (through Arrow where GDAL supports
+    it), which decodes whole layers at once, otherwise with fiona.
+    GeoParquet is read with pyarrow.
+
+    Parameters
+    ----------
+    path : str / Path
+        Vector file, 'package.gpkg/layer' for a GeoPackage layer.
+    layer : str
+        Layer to read.
+    columns : list
+        Fields to read, all if None. An empty list reads no fields.
+    bbox : tuple / gpd.GeoDataFrame / gpd.GeoSeries
+        (minx, miny, maxx, maxy) in the crs of the file, or features
+        whose bounds, in the crs of the file, are used.
+    mask : shapely geometry / gpd.GeoDataFrame / gpd.GeoSeries
+        Only features intersecting mask are read. GeoDataFrames and
+        GeoSeries are reprojected to the crs of the file.
+    where : str
+        OGR SQL WHERE clause, evaluated by the driver, e.g.
+        "acqdate > '2019-01-01' AND cloudcover < 20". Not supported for
+        GeoParquet.
+    limit : int
+        Maximum number of features to read.
+    skip : int
+        Number of features to skip before reading.
+    read_geometry : bool
+        False to read attributes only, returning a pd.DataFrame.
+
+    Returns
+    -------
+    gpd.GeoDataFrame, or pd.DataFrame if not read_geometry.
+    """
+    path, layer = _parse_in_path(path, layer)
+    mask = _filter_geom(mask, path, layer) if mask is not None else None
+    if hasattr(bbox, 'geometry'):
+        bbox = tuple(_filter_geom(bbox, path, layer).bounds)
+    if mask is not None:
+        # Spatial filter on the bounds of the mask, exact test below
+        bbox = tuple(mask.bounds)
+    if columns is not None:
+        columns = list(columns)
+
+    if _is_arrow_path(path):
+        if where:
+            logger.error('WHERE clauses are not supported for GeoParquet: {}'.format(path))
+            raise ValueError('WHERE clauses are not supported for GeoParquet.')
+        return _read_parquet(path, columns=columns, bbox=bbox, mask=mask,
+                             limit=limit, skip=skip, read_geometry=read_geometry)
+
+    if pyogrio is not None:
+        kwargs = {'use_arrow': True} if OGR_ARROW else {}
+        # Through Arrow, a bbox filter without geometry can match nothing
+        # (e.g. shapefiles), so geometry is read and dropped below
+        gdf = pyogrio.read_dataframe(str(path), layer=layer, columns=columns,
+                                     bbox=bbox, where=where, skip_features=skip,
+                                     max_features=limit,
+                                     read_geometry=(read_geometry or bbox is not None
+                                                    or mask is not None),
+                                     **kwargs)
     else:
-        logger.error('Unrecognized format: {}'.format(out_format))
+        if where:
+            # Passed through to fiona.open, requires fiona >= 1.9
+            kwargs = {'where': where}
+        else:
+            kwargs = {}
+        rows = slice(skip, skip + limit if limit else None) if skip or limit else None
+        gdf = gpd.read_file(str(path), layer=layer, bbox=bbox, rows=rows, **kwargs)
+        if columns is not None:
+            gdf = gdf[columns + [gdf.geometry.name]]
+
+    if mask is not None:
+        gdf = gdf[gdf.intersects(mask)]
+    if not read_geometry and isinstance(gdf, gpd.GeoDataFrame):
+        gdf = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+
+    return gdf
 
 
-def dissolve_touching(gdf: gpd.GeoDataFrame):
+def _read_parquet(path, columns=None, bbox=None, mask=None, limit=None,
+                  skip=0, read_geometry=True):
+    """Read GeoParquet, see read_vector. Spatial filters are applied
+    after reading, before skip and limit."""
+    import json
+    import pyarrow.parquet as pq
+
+    spatial = bbox is not None or mask is not None
+    geom_col = json.loads(pq.read_schema(str(path)).metadata[b'geo'])['primary_column']
+    if columns is not None:
+        columns = columns + [geom_col] if read_geometry or spatial else columns
+    table = pq.read_table(str(path), columns=columns)
+    if not spatial:
+        table = table.slice(skip, limit)
+        if not read_geometry and geom_col not in table.column_names:
+            return table.to_pandas()
+    gdf = arrow_to_gdf(table, read_geometry=read_geometry or spatial)
+    if spatial:
+        gdf = gdf.cx[bbox[0]:bbox[2], bbox[1]:bbox[3]]
+        if mask is not None:
+            gdf = gdf[gdf.intersects(mask)]
+        gdf = gdf.iloc[skip:skip + limit if limit else None]
+        if not read_geometry:
+            gdf = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+
+    return gdf
+
+
+def read_vector_chunks(path, chunk_size, layer=None):
+    """
+    Yield the features of a vector file as GeoDataFrames of up to
+    chunk_size features, in order.
+
+    With pyogrio, and for GeoParquet, each chunk is read with skip and
+    limit. fiona has no random access to features - reading a chunk with
+    rows=slice(...) iterates from the first feature - so with fiona the
+    file is iterated once and chunks are built as it is read.
+    """
+    in_path = path
+    path, layer = _parse_in_path(path, layer)
+    if pyogrio is not None or _is_arrow_path(path):
+        n_feats = vector_info(in_path, layer=layer)['features']
+        for skip in range(0, n_feats, chunk_size):
+            yield read_vector(in_path, layer=layer, skip=skip, limit=chunk_size)
+        return
+
+    with fiona.open(str(path), layer=layer) as src:
+        crs = src.crs_wkt
+        columns = list(src.schema['properties']) + ['geometry']
+        feats = []
+        for feat in src:
+            feats.append(feat)
+            if len(feats) == chunk_size:
+                yield gpd.GeoDataFrame.from_features(feats, crs=crs)[columns]
+                feats = []
+        if feats:
+            yield gpd.GeoDataFrame.from_features(feats, crs=crs)[columns]
+
+
+def touching_components(gdf: gpd.GeoDataFrame, predicate='touches'):
+    """
+    Label the connected components of gdf, where two features are
+    connected if they satisfy predicate ('touches' or 'intersects').
+    The adjacency is built as a sparse matrix from a spatial index query,
+    so memory grows with the number of touching pairs rather than n^2.
+
+    Returns
+    -------
+    tuple : (number of components, np.ndarray of component label per row)
+    """
+    n = len(gdf)
+    if STRtree is not None:
+        geoms = np.asarray(gdf.geometry.values)
+        left, right = STRtree(geoms).query(geoms, predicate=predicate)
+    else:
+        # geopandas spatial join is backed by an rtree index
+        pos = gpd.GeoDataFrame(geometry=gdf.geometry.values, crs=gdf.crs)
+        sj = gpd.sjoin(pos, pos, op=predicate)
+        left = sj.index.values
+        right = sj['index_right'].values
+    adjacency = coo_matrix((np.ones(len(left), dtype=bool), (left, right)),
+                           shape=(n, n))
+
+    return connected_components(adjacency, directed=False)
+
+
+def _union_groups(geoms, labels):
+    """Union geometries sharing a label, returning (labels, unions)."""
+    order = np.argsort(labels, kind='stable')
+    labels = labels[order]
+    geoms = np.asarray(geoms, dtype=object)[order]
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    groups = np.split(geoms, starts[1:])
+    if union_all is not None:
+        unions = [union_all(g) if len(g) > 1 else g[0] for g in groups]
+    else:
+        unions = [unary_union(list(g)) if len(g) > 1 else g[0] for g in groups]
+
+    return labels[starts], unions
+
+
+def dissolve_touching(gdf: gpd.GeoDataFrame, aggfunc='first',
+                      predicate='touches', n_jobs=None,
+                      parallel_min=10_000):
+    """
+    Dissolve features of gdf that touch, directly or through other
+    features, into one feature per connected component.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+    aggfunc : str / function
+        Aggregation for attribute columns, as in GeoDataFrame.dissolve.
+    predicate : str
+        'touches' or 'intersects', how features are connected.
+    n_jobs : int
+        Number of workers unioning components, defaults to all but two
+        cores.
+    parallel_min : int
+        Union serially when gdf has fewer features than this.
+
+    Returns
+    -------
+    gpd.GeoDataFrame : indexed by 'dissolve_group'
+    """
     dg = 'dissolve_group'
 
-    overlap_matrix = gdf.geometry.apply(
-        lambda x: gdf.geometry.touches(x)).values.astype(int)
-    n, ids = connected_components(overlap_matrix)
+    n, ids = touching_components(gdf, predicate=predicate)
     gdf[dg] = ids
+    logger.debug('Dissolving {:,} features into {:,} components'.format(len(gdf), n))
 
-    dissolved = gdf.dissolve(by=dg)
+    geoms = gdf.geometry.values
+    if len(gdf) < parallel_min:
+        labels, unions = _union_groups(geoms, ids)
+    else:
+        from joblib import Parallel, delayed
+        n_jobs = n_jobs if n_jobs else max(multiprocessing.cpu_count() - 2, 1)
+        # Split components (not rows) across workers. Vectorized shapely
+        # releases the GIL, so threads suffice there.
+        chunk = ids % (n_jobs * 4)
+        results = Parallel(n_jobs=n_jobs,
+                           prefer='threads' if union_all is not None else 'processes')(
+            delayed(_union_groups)(geoms[chunk == c], ids[chunk == c])
+            for c in np.unique(chunk))
+        labels = np.concatenate([r[0] for r in results])
+        unions = [u for r in results for u in r[1]]
+
+    geom_col = gdf.geometry.name
+    attrs = gdf.drop(columns=geom_col).groupby(dg).agg(aggfunc)
+    dissolved = gpd.GeoDataFrame(attrs,
+                                 geometry=pd.Series(unions, index=labels).reindex(attrs.index).values,
+                                 crs=gdf.crs)
 
     return dissolved
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent, memory-mapped index of catalog IDs.
+
+IDs are stored as a sorted NumPy array of fixed-width byte strings saved to
+a .npy file, with a small json sidecar recording the source the index was
+built from. Loading memory-maps the array, so opening an index of millions
+of IDs takes milliseconds, and membership tests for a whole column of IDs
+are a single np.searchsorted.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Extensions for index files
+IDX_EXT = '.idx.npy'
+META_EXT = '.idx.json'
+
+# Loaded indices, keyed on index path
+_loaded = {}
+
+
+def _to_fixed_width(ids):
+    """
+    Convert an iterable of IDs to a NumPy array of byte strings, dropping
+    nulls and empty strings.
+    """
+    ids = pd.Series(ids, dtype=object) if not isinstance(ids, pd.Series) else ids
+    ids = ids[ids.notna()].astype(str).str.strip()
+    ids = ids[ids != '']
+    if len(ids) == 0:
+        return np.array([], dtype='S1')
+
+    return np.array(ids.values, dtype='U').astype('S')
+
+
+def _sorted_unique(ids):
+    return np.unique(_to_fixed_width(ids))
+
+
+def _default_index_path(src):
+    return '{}{}'.format(os.path.splitext(src)[0], IDX_EXT)
+
+
+def _meta_path(index_path):
+    return index_path.replace(IDX_EXT, META_EXT)
+
+
+class IDIndex:
+    """
+    Sorted, fixed-width array of IDs supporting vectorized membership tests.
+
+    Parameters
+    ----------
+    ids : np.ndarray
+        Sorted, unique array of byte strings (dtype 'S<width>').
+    index_path : str, optional
+        Path the index is persisted to.
+    """
+
+    def __init__(self, ids=None, index_path=None):
+        if ids is None:
+            ids = np.array([], dtype='S1')
+        self.ids = ids
+        self.index_path = index_path
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, item):
+        return bool(self.isin([item])[0])
+
+    def __iter__(self):
+        for i in self.ids:
+            yield i.decode()
+
+    @property
+    def width(self):
+        return self.ids.dtype.itemsize
+
+    @classmethod
+    def from_ids(cls, ids, index_path=None):
+        """Build an index from any iterable of IDs."""
+        return cls(_sorted_unique(ids), index_path=index_path)
+
+    @classmethod
+    def from_text(cls, src, index_path=None, sep=None):
+        """
+        Build an index from a text file of one ID per line, optionally
+        with other fields after "sep".
+        """
+        ids = pd.read_csv(src, header=None, names=['id'], usecols=[0],
+                          sep=sep if sep else ',', dtype=str,
+                          skip_blank_lines=True)
+        return cls.from_ids(ids['id'], index_path=index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        """Memory-map an existing index."""
+        ids = np.load(index_path, mmap_mode='r')
+        return cls(ids, index_path=index_path)
+
+    def save(self, index_path=None, meta=None):
+        """Write the index (and optional metadata) to disk."""
+        index_path = index_path if index_path else self.index_path
+        if not index_path:
+            raise ValueError('No path provided to save IDIndex to.')
+        # A file can't be replaced while memory-mapped on Windows, so read
+        # the IDs into memory and drop the cached map of index_path first
+        self.ids = np.array(self.ids)
+        _loaded.pop(index_path, None)
+        # Write to temp file then replace, so readers never see a partial index
+        tmp = '{}.tmp.npy'.format(index_path)
+        np.save(tmp, self.ids)
+        os.replace(tmp, index_path)
+        if meta is not None:
+            with open(_meta_path(index_path), 'w') as dst:
+                json.dump(meta, dst)
+        self.index_path = index_path
+
+    def isin(self, values):
+        """
+        Test each of values for membership in the index.
+
+        Parameters
+        ----------
+        values : list, pd.Series, np.ndarray
+            IDs to check.
+
+        Returns
+        -------
+        np.ndarray : boolean array the same length as values.
+        """
+        values = pd.Series(values, dtype=object).reset_index(drop=True)
+        found = np.zeros(len(values), dtype=bool)
+        if len(self.ids) == 0 or len(values) == 0:
+            return found
+        # Values wider than the index can't be members and would be
+        # truncated by the fixed-width cast
+        vals = values.where(values.notna(), '').astype(str)
+        valid = ((vals.str.len() <= self.width) & (vals != '')).values
+        if not valid.any():
+            return found
+        fixed = np.array(vals[valid].values, dtype='U').astype('S{}'.format(self.width))
+        pos = np.searchsorted(self.ids, fixed)
+        pos[pos == len(self.ids)] = 0
+        found[valid] = self.ids[pos] == fixed
+
+        return found
+
+    def union(self, other):
+        """Return a new IDIndex of IDs in either index."""
+        ids = other.ids if isinstance(other, IDIndex) else _sorted_unique(other)
+        return IDIndex(np.union1d(self.ids, ids))
+
+    def difference(self, other):
+        """Return a new IDIndex of IDs in this index but not other."""
+        ids = other.ids if isinstance(other, IDIndex) else _sorted_unique(other)
+        return IDIndex(np.setdiff1d(self.ids, ids, assume_unique=True))
+
+    def add(self, ids, save=True):
+        """
+        Incrementally add IDs to the index, returning the number of new IDs.
+        """
+        new = _sorted_unique(ids)
+        new = new[~self.isin(new.astype('U'))]
+        if len(new) == 0:
+            return 0
+        self.ids = np.union1d(np.asarray(self.ids), new)
+        if save and self.index_path:
+            meta = read_meta(self.index_path)
+            self.save(meta=meta)
+
+        return len(new)
+
+    def to_set(self):
+        """Return IDs as a set of str, for compatibility with older callers."""
+        return set(self.ids.astype('U'))
+
+
+def read_meta(index_path):
+    meta_path = _meta_path(index_path)
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, 'r') as src:
+        return json.load(src)
+
+
+def _src_stamp(src):
+    st = os.stat(src)
+    return {'src': os.path.abspath(src), 'size': st.st_size,
+            'mtime': st.st_mtime}
+
+
+def index_for_file(src, index_path=None, rebuild=False):
+    """
+    Return the IDIndex for a text file of IDs, building it if it does
+    not exist or the source has changed since it was built. Indices are
+    cached per process, so repeated calls only stat the source file.
+
+    Parameters
+    ----------
+    src : str
+        Path to text file of one ID per line.
+    index_path : str, optional
+        Path to write index to. Defaults to src with .idx.npy extension.
+    rebuild : bool
+        Rebuild the index even if it is current.
+
+    Returns
+    -------
+    IDIndex
+    """
+    index_path = index_path if index_path else _default_index_path(src)
+    stamp = _src_stamp(src) if os.path.exists(src) else None
+
+    cached = _loaded.get(index_path)
+    if cached is not None and not rebuild:
+        idx, cached_stamp = cached
+        if stamp is None or stamp == cached_stamp:
+            return idx
+
+    meta = read_meta(index_path)
+    current = (os.path.exists(index_path)
+               and (stamp is None or
+                    {k: meta.get(k) for k in stamp} == stamp))
+    if current and not rebuild:
+        logger.debug('Loading ID index: {}'.format(index_path))
+        idx = IDIndex.load(index_path)
+    else:
+        if stamp is None:
+            raise FileNotFoundError('No ID index or source found: {}'.format(src))
+        logger.info('Building ID index from: {}'.format(src))
+        idx = IDIndex.from_text(src, index_path=index_path)
+        meta.update(stamp)
+        idx.save(meta=meta)
+        logger.info('IDs indexed: {:,}'.format(len(idx)))
+    _loaded[index_path] = (idx, stamp)
+
+    return idx
+
+
+def append_ids(src, ids, index_path=None):
+    """
+    Append IDs not already present to both a text file of IDs and its
+    index, without rewriting either from scratch.
+
+    Returns
+    -------
+    list : IDs that were added.
+    """
+    index_path = index_path if index_path else _default_index_path(src)
+    if os.path.exists(src):
+        idx = index_for_file(src, index_path=index_path)
+    else:
+        idx = IDIndex(index_path=index_path)
+
+    ids = pd.Series(pd.unique(_to_fixed_width(ids))).str.decode('utf-8')
+    new = list(ids[~idx.isin(ids)])
+    if not new:
+        return new
+
+    needs_newline = False
+    if os.path.exists(src) and os.path.getsize(src) > 0:
+        with open(src, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+    with open(src, 'a') as dst:
+        if needs_newline:
+            dst.write('\n')
+        for each_id in new:
+            dst.write('{}\n'.format(each_id))
+
+    # Record the appended source so the index is not rebuilt from it
+    meta = read_meta(index_path)
+    meta.update(_src_stamp(src))
+    _loaded.pop(index_path, None)
+    idx = IDIndex(np.union1d(np.asarray(idx.ids), _sorted_unique(new)),
+                  index_path=index_path)
+    idx.save(meta=meta)
+
+    return new
@@ -12,10 +12,12 @@ import sys
 # import tqdm
 import geopandas as gpd
 import pandas as pd
-#import numpy as np
+import numpy as np
 
 from selection_utils.query_danco import query_footprint
 from misc_utils.dataframe_utils import determine_id_col, determine_stereopair_col
+from misc_utils.id_index import index_for_file
+from misc_utils.gpd_utils import read_vector, vector_info
 #from ids_order_sources import get_ordered_ids
 from misc_utils.logging_utils import create_logger
 
@@ -97,11 +99,16 @@ def read_ids(ids_file, field=None, sep=None, stereo=False):
                 ids.append(the_id)
     # DBF
     elif file_type == 'dbf':
-        df = gpd.read_file(ids_file)
+        # Read only the ID (and stereopair) columns, without geometries
+        fields = vector_info(ids_file)['fields']
         if field == None:
-            id_col = determine_id_col(df)
+            id_col = determine_id_col(fields)
         else:
             id_col = field
+        read_cols = [id_col]
+        if stereo == True:
+            read_cols.append(determine_stereopair_col(fields))
+        df = read_vector(ids_file, columns=read_cols, read_geometry=False)
         df_ids = list(df[id_col])
         for each_id in df_ids:
             ids.append(each_id)
@@ -112,17 +119,19 @@ def read_ids(ids_file, field=None, sep=None, stereo=False):
                 ids.append(sp_id)
     # SHP
     elif file_type == 'shp':
-        df = gpd.read_file(ids_file)
         if field:
             # ids = list(df[field].unique())
+            df = read_vector(ids_file, columns=[field], read_geometry=False)
             ids = list(df[field])
         else:
             id_fields = ['catalogid', 'catalog_id', 'CATALOGID', 'CATALOG_ID']
-            field = [x for x in id_fields if x in list(df)]
+            fields = vector_info(ids_file)['fields']
+            field = [x for x in id_fields if x in fields]
             if len(field) != 1:
                 logger.error('Unable to read IDs, no known ID fields found.')
             else:
                 field = field[0]
+            df = read_vector(ids_file, columns=[field], read_geometry=False)
             ids = df[field].unique()
 
     # PKL
@@ -433,43 +442,64 @@ def get_offline_ids():
     offline_ids = set(read_ids(offline_ids_path))
     return offline_ids
 
-def mfp_ids(online=False):
+
+def mfp_index(online=False):
     """
-    Returns all catalogids in the current masterfootprint.
+    Returns an IDIndex of all catalogids in the current masterfootprint.
+    The index is built from the text file of MFP IDs the first time it is
+    requested (or when that file changes) and memory-mapped thereafter.
     """
-    ids_path = pgc_index_path(ids=True)
-    ids = set(read_ids(ids_path))
+    idx = index_for_file(pgc_index_path(ids=True))
     if online is True:
-        offline_ids = get_offline_ids()
-        ids = ids.difference(offline_ids)
+        idx = idx.difference(index_for_file(offline_ids_path))
 
-    return ids
+    return idx
 
 
-def ordered_ids(update=False):
+def ordered_index(update=False):
     """
-    Returns all catalogids that are in order sheets.
+    Returns an IDIndex of all catalogids that are in order sheets.
     """
-    global ordered_path
     if update:
         # Read all IDs in order sheets and rewrite txt file
         update_ordered()
-    ordered = list(set(read_ids(ordered_path)))
-    ordered = set([o for o in ordered if o != ''])
 
-    return ordered
+    return index_for_file(ordered_path)
+
+
+def mfp_ids(online=False):
+    """
+    Returns all catalogids in the current masterfootprint.
+    """
+    return mfp_index(online=online).to_set()
+
+
+def ordered_ids(update=False):
+    """
+    Returns all catalogids that are in order sheets.
+    """
+    return ordered_index(update=update).to_set()
 
 
 def onhand_ids(update=False):
     """
     Returns all ids in MFP or order sheets.
     """
-    mfp = mfp_ids()
-    ordered = ordered_ids(update)
-    
-    onhand = mfp | ordered
-    
-    return onhand
+    return mfp_index().union(ordered_index(update)).to_set()
+
+
+def _remove_indexed(src, indices):
+    """
+    Remove any of src found in any of indices, keeping the first
+    occurence of each remaining ID in src.
+    """
+    src_ids = pd.Series(pd.unique(pd.Series(list(src), dtype=object)))
+    found = np.zeros(len(src_ids), dtype=bool)
+    for idx in indices:
+        found |= idx.isin(src_ids)
+    logger.debug('IDs removed: {}'.format(found.sum()))
+
+    return list(src_ids[~found])
 
 
 def remove_mfp(src):
@@ -479,15 +509,7 @@ def remove_mfp(src):
     src: list of ids
     """
     logger.debug('Removing IDs that are in master footprint...')
-    src_ids = set(src)
-    # logger.debug('src_ids: {}'.format(list(src_ids)[:10]))
-    onhand_ids = set(mfp_ids())
-    # logger.debug('onhand ids: {}'.format(list(onhand_ids)[:10]))
-    not_mfp = list(src_ids - onhand_ids)
-    # logger.debug('not mfp ids: {}'.format(list(not_mfp)[:10]))
-    logger.debug('IDs removed: {}'.format((len(src_ids) - len(not_mfp))))
-
-    return not_mfp
+    return _remove_indexed(src, [mfp_index()])
 
 
 def remove_ordered(src):
@@ -497,14 +519,7 @@ def remove_ordered(src):
     src: list of ids
     """
     logger.debug('Removing IDs in order sheets...')
-    logger.debug('Removing ordered...')
-    src_ids = set(src)
-    ordered = set(ordered_ids())
-
-    not_ordered = list(src_ids - ordered)
-    logger.debug('IDs removed: {}'.format((len(src_ids) - len(not_ordered))))
-
-    return not_ordered
+    return _remove_indexed(src, [ordered_index()])
 
 
 def remove_onhand(src):
@@ -513,10 +528,8 @@ def remove_onhand(src):
     ids that are either in the mfp or ordered.
     src: list of ids
     """
-    not_mfp = remove_mfp(src)
-    not_mfp_ordered = remove_ordered(not_mfp)
-    
-    return not_mfp_ordered
+    logger.debug('Removing IDs in master footprint or order sheets...')
+    return _remove_indexed(src, [mfp_index(), ordered_index()])
 
 
 def parse_filename(filename, att, fullpath=False):
@@ -674,61 +687,22 @@ def create_s_filepath(scene_id, strip_id, acqdate, prod_code):
 
 
 #%% Update ordered
-def update_ordered(ordered_dir=None, ordered_loc=None, exclude=('NASA'),
-                   new_only=True):
-    # TODO: Add a config file that is a list of filepaths that have already been processed,
-    # TODO: then only read files not in that list
-    """Update the text file of ordered IDs by reading from order sheets"""
-    from tqdm import tqdm
+def update_ordered(ordered_dir=None, ordered_loc=None, exclude=('NASA', ),
+                   new_only=True, num_cores=None):
+    """
+    Update the text file of ordered IDs by reading from order sheets. Only
+    sheets that are new or changed since the last update (as recorded in the
+    order sheet manifest) are read, and new IDs are appended to the text
+    file and its index. See misc_utils.order_sheet_ingest.
+    """
+    from misc_utils.order_sheet_ingest import ingest_order_sheets
 
     if not ordered_loc:
-        # global ordered_p
         ordered_loc = ordered_path
     if not ordered_dir:
-        # global ordered_directory
         ordered_dir = ordered_directory
 
-    # Get last modified time for ordered list
-    last_update = os.path.getmtime(ordered_loc)
-
-    # List for all IDs
-    logger.info('Reading existing list of ordered ids...')
-    ordered = read_ids(ordered_loc)
-    logger.info('Ordered IDs found: {:,}'.format(len(ordered)))
-
-    # Progress bar set up
-    total_len = sum([len(files) for r, d, files in os.walk(ordered_dir)])
-    pbar = tqdm(total=total_len, desc='Iterating imagery order sheets...')
-
-    logger.debug('Reading sheets from: {}'.format(ordered_dir))
-    for root, dirs, files in os.walk(ordered_dir):
-        dirs = [d for d in dirs if not any(ex in d for ex in exclude)]
-        last_dir = None
-        for f in files:
-            f_path = os.path.join(root, f)
-            if new_only:
-                # Check if file newer than last update
-                if not os.path.getmtime(f_path) > last_update:
-                    # print('skipping already read file.')
-                    continue
-            cur_dir = os.path.basename(os.path.dirname(os.path.join(root, f)))
-            if exclude and not any(ex in cur_dir for ex in exclude):
-                if cur_dir != last_dir:
-                    pbar.write('Reading from: {}'.format(cur_dir))
-                ext = os.path.splitext(f)[1]
-                if ext in ['.txt', '.csv', '.xls', '.xlsx']:
-                    try:
-                        # logger.info('Reading; {}'.format(f))
-                        sheet_ids = read_ids(f_path)
-                        ordered.extend(sheet_ids)
-                    except Exception as e:
-                        print('failed to read: {}'.format(f))
-                        logger.error(e)
-
-                pbar.update(1)
-                last_dir = cur_dir
-
-
-    ordered = list(set(ordered))
-    logger.info('Writing {:,} ordered IDs to: {}'.format(len(ordered), ordered_loc))
-    write_ids(ordered, ordered_loc)
+    new_ids = ingest_order_sheets(ordered_dir, ordered_loc, exclude=exclude,
+                                  new_only=new_only, num_cores=num_cores)
+
+    return new_ids
@@ -8,58 +8,47 @@ Created on Tue May 12 12:14:25 2020
 import argparse
 import os
 
+from misc_utils.fs_index import find_files
 from misc_utils.logging_utils import create_logger
 
 
 logger = create_logger(__name__, 'sh', 'DEBUG')
 
 
-def matching_files(directory, recursive=True, 
+def matching_files(directory, recursive=True,
                    starts=None, ends=None,
-                   contains=None, ext=None):
+                   contains=None, ext=None,
+                   pattern=None, regex=None,
+                   catalog_path=None, threads=8):
     logger.info('Scanning {} for files matching filters...'.format(directory))
     logger.debug("""Filters:
                  starts: {}
                  ends: {}
                  contains: {}
                  ext: {}
-                 recursive: {}""".format(starts, ends, contains, ext, recursive))
-    # Create file list
-    match_fullpaths = []
-    if recursive:
-        for root, dirs, files in os.walk(directory):
-            if starts:
-                files = [f for f in files if f.startswith(starts)]
-            if ends:
-                files = [f for f in files if os.path.splitext(f)[0].endswith(ends)]
-            if contains:
-                files = [f for f in files if contains in f]
-            if ext:
-                files = [f for f in files if f.endswith(ext)]
-            
-            # Add full paths to matches to master list
-            match_fullpaths.extend([os.path.join(root, f) for f in files])
-            
-    else:
-        files = [f for f in os.listdir(directory) 
-                 if os.path.isfile(os.path.join(directory, f))]
-        
-        if starts:
-            files = [f for f in files if f.startswith(starts)]
-        if ends:
-            files = [f for f in files if os.path.splitext(f)[0].endswith(ends)]
-        if contains:
-            files = [f for f in files if contains in f]
-        if ext:
-            files = [f for f in files if f.endswith(ext)]
-        
-        # Add full paths to master list
-        match_fullpaths.extend([os.path.join(directory, f) for f in files])
-        
+                 pattern: {}
+                 regex: {}
+                 recursive: {}""".format(starts, ends, contains, ext,
+                                         pattern, regex, recursive))
+
+    def match(f):
+        if starts and not f.startswith(starts):
+            return False
+        if ends and not os.path.splitext(f)[0].endswith(ends):
+            return False
+        if contains and contains not in f:
+            return False
+        if ext and not f.endswith(ext):
+            return False
+        return True
+
+    match_fullpaths = find_files(directory, pattern=pattern, regex=regex,
+                                 match=match, recursive=recursive,
+                                 catalog_path=catalog_path, threads=threads)
     logger.info('Found matching files: {}'.format(len(match_fullpaths)))
-    
+
     return match_fullpaths
-        
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -78,6 +67,13 @@ if __name__ == '__main__':
                                 I.e.: 'pansh.tif'""")
     parser.add_argument('-r', '--recursive', action='store_true',
                         help='Flag to search recursively through input_directory.')
+    parser.add_argument('-p', '--pattern', type=str,
+                        help="Glob pattern filenames must match, e.g. '*dem.tif'")
+    parser.add_argument('-re', '--regex', type=str,
+                        help='Regular expression searched for in filenames.')
+    parser.add_argument('--catalog', type=os.path.abspath,
+                        help='json catalog of input_directory, reused for '
+                             'unchanged subdirectories when rescanning.')
     
     args = parser.parse_args()
     
@@ -86,7 +82,10 @@ if __name__ == '__main__':
                         starts=args.starts_with,
                         ends=args.ends_with,
                         contains=args.contains,
-                        ext=args.ext)
+                        ext=args.ext,
+                        pattern=args.pattern,
+                        regex=args.regex,
+                        catalog_path=args.catalog)
     
     with open(args.out_txt, 'w') as out:
         for f in mf:
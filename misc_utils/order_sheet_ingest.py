@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental ingestion of imagery order sheets into the ordered IDs list.
+
+A manifest (json) next to the ordered IDs text file records the path, size,
+mtime and content hash of every sheet that has been read. Each update does
+a single walk of the order sheet directory, parses only sheets that are new
+or whose content has changed (in parallel), and appends any new IDs to the
+ordered IDs text file and its index.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from misc_utils.fs_index import FileIndex
+from misc_utils.id_index import append_ids
+from misc_utils.id_parse_utils import read_ids
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+SHEET_EXTS = ('.txt', '.csv', '.xls', '.xlsx')
+
+
+def manifest_path(ordered_loc):
+    return '{}_manifest.json'.format(os.path.splitext(ordered_loc)[0])
+
+
+def load_manifest(manifest_p):
+    if not os.path.exists(manifest_p):
+        return {}
+    with open(manifest_p, 'r') as src:
+        return json.load(src)
+
+
+def write_manifest(manifest, manifest_p):
+    tmp = '{}.tmp'.format(manifest_p)
+    with open(tmp, 'w') as dst:
+        json.dump(manifest, dst, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_p)
+
+
+def file_hash(path, block_size=2**20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as src:
+        for block in iter(lambda: src.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_sheets(ordered_dir, exclude=None, exts=SHEET_EXTS, catalog_path=None,
+                threads=8):
+    """
+    Scan ordered_dir once, returning {path: {'size', 'mtime'}} for every
+    order sheet, skipping any directory whose name contains one of exclude.
+    See misc_utils.fs_index.FileIndex for catalog_path.
+    """
+    idx = FileIndex(ordered_dir, catalog_path=catalog_path, threads=threads,
+                    exclude_dirs=exclude).scan()
+    sheets = {path: {'size': size, 'mtime': mtime}
+              for path, size, mtime in idx.entries(
+                  match=lambda f: os.path.splitext(f)[1].lower() in exts)}
+
+    return sheets
+
+
+def _parse_sheet(path, known_sha1=None):
+    """
+    Hash a single sheet and, if its hash differs from known_sha1, read its
+    IDs. IDs are None for a sheet whose content is unchanged.
+    """
+    try:
+        sha1 = file_hash(path)
+        if known_sha1 is not None and sha1 == known_sha1:
+            return path, sha1, None, None
+        ids = [str(i).strip() for i in read_ids(path)]
+        ids = [i for i in ids if i and i != 'nan']
+        return path, sha1, ids, None
+    except Exception as e:
+        return path, None, [], str(e)
+
+
+def changed_sheets(sheets, manifest):
+    """
+    Compare scanned sheets to the manifest, returning paths whose size or
+    mtime differ from (or are missing in) the manifest.
+    """
+    changed = []
+    for path, stamp in sheets.items():
+        entry = manifest.get(path)
+        if (entry is None or entry['size'] != stamp['size']
+                or entry['mtime'] != stamp['mtime']):
+            changed.append(path)
+
+    return changed
+
+
+def ingest_order_sheets(ordered_dir, ordered_loc, exclude=('NASA', ),
+                        new_only=True, num_cores=None):
+    """
+    Parse new or changed order sheets in ordered_dir and append their IDs
+    to ordered_loc (and its ID index).
+
+    Parameters
+    ----------
+    ordered_dir : str
+        Directory holding order sheets.
+    ordered_loc : str
+        Path to text file of ordered IDs.
+    exclude : tuple
+        Skip directories whose names contain any of these strings.
+    new_only : bool
+        When no manifest exists yet, record sheets older than ordered_loc
+        without parsing them, as their IDs are already in ordered_loc.
+        If False, every sheet missing from the manifest is parsed.
+    num_cores : int
+        Number of processes to parse sheets with.
+
+    Returns
+    -------
+    list : new IDs added to ordered_loc.
+    """
+    manifest_p = manifest_path(ordered_loc)
+    manifest = load_manifest(manifest_p)
+
+    logger.info('Scanning order sheets in: {}'.format(ordered_dir))
+    sheets = scan_sheets(ordered_dir, exclude=exclude)
+    logger.info('Order sheets found: {:,}'.format(len(sheets)))
+
+    if not manifest and new_only and os.path.exists(ordered_loc):
+        # Seed manifest with sheets already captured in ordered_loc. No hash
+        # is recorded, so any later change to these sheets is reparsed.
+        last_update = os.path.getmtime(ordered_loc)
+        for path, stamp in sheets.items():
+            if stamp['mtime'] <= last_update:
+                manifest[path] = dict(stamp, sha1=None, num_ids=None)
+
+    to_check = changed_sheets(sheets, manifest)
+    logger.info('New or modified order sheets: {:,}'.format(len(to_check)))
+
+    new_ids = []
+    if to_check:
+        num_cores = num_cores if num_cores else max(multiprocessing.cpu_count() - 2, 1)
+        results = Parallel(n_jobs=min(num_cores, len(to_check)))(
+            delayed(_parse_sheet)(p, (manifest.get(p) or {}).get('sha1'))
+            for p in tqdm(to_check, desc='Reading order sheets'))
+
+        sheet_ids = []
+        for path, sha1, ids, err in results:
+            if err:
+                logger.error('Failed to read: {}\n{}'.format(path, err))
+                continue
+            if ids is None:
+                logger.debug('Sheet touched but unchanged: {}'.format(path))
+                manifest[path] = dict(manifest[path], **sheets[path])
+                continue
+            sheet_ids.extend(ids)
+            manifest[path] = dict(sheets[path], sha1=sha1, num_ids=len(ids))
+
+        new_ids = append_ids(ordered_loc, sheet_ids)
+        logger.info('New ordered IDs added: {:,}'.format(len(new_ids)))
+
+    # Drop sheets that no longer exist. Their IDs remain in ordered_loc, as
+    # they were still ordered.
+    for path in set(manifest) - set(sheets):
+        manifest.pop(path)
+    write_manifest(manifest, manifest_p)
+
+    return new_ids
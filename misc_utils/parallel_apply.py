@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked parallel apply over (Geo)DataFrames.
+
+Rows are split into a few chunks per process, either evenly by row count
+or by spatial locality (Morton order of representative points), rather
+than one task per row. Geometries are sent to and from workers as WKB
+arrays, which pickle much faster than shapely objects. Large read-only
+inputs (footprints, rasters, lookup tables) passed as `shared` are
+inherited by forked workers instead of being pickled for every task.
+Results are reassembled in the order of the input rows.
+"""
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from joblib import Parallel, delayed
+from shapely import wkb
+from tqdm import tqdm
+
+from misc_utils.logging_utils import create_logger
+
+try:
+    # Vectorized WKB conversion, shapely >= 2.0
+    from shapely import to_wkb, from_wkb
+except ImportError:
+    to_wkb = None
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Read-only inputs set before workers are forked
+_SHARED = {}
+
+
+def get_shared(name):
+    """Return a shared input by name, from within a worker."""
+    return _SHARED[name]
+
+
+def geoms_to_wkb(geoms):
+    """Convert geometries to an object array of WKB bytes (None for null)."""
+    geoms = np.asarray(geoms, dtype=object)
+    if to_wkb is not None:
+        return to_wkb(geoms)
+    return np.array([g.wkb if g is not None else None for g in geoms], dtype=object)
+
+
+def wkb_to_geoms(wkbs):
+    """Convert an array of WKB bytes to shapely geometries."""
+    if to_wkb is not None:
+        return from_wkb(wkbs)
+    return [wkb.loads(w) if w is not None else None for w in wkbs]
+
+
+def pack(df):
+    """
+    Split a (Geo)DataFrame into parts that pickle cheaply: attributes,
+    geometry as WKB, geometry column name and crs.
+    """
+    if not isinstance(df, gpd.GeoDataFrame):
+        return df, None, None, None
+    geom_col = df.geometry.name
+    crs = df.crs.to_wkt() if hasattr(df.crs, 'to_wkt') else df.crs
+    return df.drop(columns=geom_col), geoms_to_wkb(df.geometry.values), geom_col, crs
+
+
+def unpack(attrs, wkbs, geom_col, crs):
+    """Rebuild a (Geo)DataFrame from pack()."""
+    if wkbs is None:
+        return attrs
+    gdf = gpd.GeoDataFrame(attrs, geometry=wkb_to_geoms(wkbs), crs=crs)
+    if geom_col != 'geometry':
+        gdf = gdf.rename_geometry(geom_col)
+    return gdf
+
+
+def morton_order(gdf, bits=16):
+    """
+    Return positions of gdf rows sorted along a Z-order (Morton) curve of
+    their representative points, so neighbouring rows are close in space.
+    """
+    pts = gdf.geometry.representative_point()
+    xs = pts.x.values
+    ys = pts.y.values
+    scale = (1 << bits) - 1
+    span_x = max(np.nanmax(xs) - np.nanmin(xs), 1e-12)
+    span_y = max(np.nanmax(ys) - np.nanmin(ys), 1e-12)
+    qx = ((xs - np.nanmin(xs)) / span_x * scale).astype(np.uint64)
+    qy = ((ys - np.nanmin(ys)) / span_y * scale).astype(np.uint64)
+    code = np.zeros(len(gdf), dtype=np.uint64)
+    for b in range(bits):
+        code |= ((qx >> np.uint64(b)) & np.uint64(1)) << np.uint64(2 * b)
+        code |= ((qy >> np.uint64(b)) & np.uint64(1)) << np.uint64(2 * b + 1)
+
+    return np.argsort(code, kind='stable')
+
+
+def chunk_positions(gdf, n_chunks, by='rows'):
+    """
+    Split row positions of gdf into n_chunks of (nearly) equal size.
+
+    by : str
+        'rows' - consecutive rows
+        'space' - rows in Morton order of their representative points
+    """
+    n_chunks = max(min(n_chunks, len(gdf)), 1)
+    if by == 'space' and isinstance(gdf, gpd.GeoDataFrame) and len(gdf) > 0:
+        order = morton_order(gdf)
+    else:
+        order = np.arange(len(gdf))
+    return np.array_split(order, n_chunks)
+
+
+def _run_chunk(fxn, packed, args, kwargs, shared_names, shared_values):
+    if shared_values is not None:
+        # Workers that were not forked receive shared inputs directly
+        _SHARED.update(shared_values)
+    chunk = unpack(*packed)
+    kwargs = dict(kwargs, **{name: _SHARED[name] for name in shared_names})
+    result = fxn(chunk, *args, **kwargs)
+    if isinstance(result, (pd.DataFrame, gpd.GeoDataFrame)):
+        return True, pack(result)
+    return False, result
+
+
+def parallel_apply(fxn, gdf, *args, n_jobs=None, chunks_per_job=4,
+                   by='rows', shared=None, ordered=True, concat=True,
+                   **kwargs):
+    """
+    Apply fxn to chunks of gdf in parallel.
+
+    Parameters
+    ----------
+    fxn : function
+        Called as fxn(chunk, *args, **shared, **kwargs) where chunk is a
+        (Geo)DataFrame of rows of gdf. Should return a (Geo)DataFrame.
+    gdf : pd.DataFrame / gpd.GeoDataFrame
+    n_jobs : int
+        Number of processes, defaults to all but two cores.
+    chunks_per_job : int
+        Number of chunks per process, more chunks balance uneven work.
+    by : str
+        'rows' or 'space', see chunk_positions.
+    shared : dict
+        Large read-only inputs passed to fxn as keyword arguments. Workers
+        are forked with these in memory, where the platform supports it,
+        so they are never pickled.
+    ordered : bool
+        Return rows in the order of gdf, when the results of fxn keep the
+        index of their chunk. Otherwise results are in chunk order.
+    concat : bool
+        Concatenate results, otherwise return a list of results per chunk.
+
+    Returns
+    -------
+    pd.DataFrame / gpd.GeoDataFrame, or list if not concat.
+    """
+    n_jobs = n_jobs if n_jobs else max(multiprocessing.cpu_count() - 2, 1)
+    shared = shared if shared else {}
+    chunks = chunk_positions(gdf, n_jobs * chunks_per_job, by=by)
+    packed = [pack(gdf.iloc[pos]) for pos in chunks]
+
+    fork = 'fork' in multiprocessing.get_all_start_methods()
+    if shared and fork:
+        # Set shared inputs before the multiprocessing backend forks workers
+        backend = 'multiprocessing'
+        _SHARED.clear()
+        _SHARED.update(shared)
+        shared_values = None
+    else:
+        backend = 'loky'
+        shared_values = shared if shared else None
+
+    try:
+        results = Parallel(n_jobs=n_jobs, backend=backend)(
+            delayed(_run_chunk)(fxn, p, args, kwargs, list(shared), shared_values)
+            for p in tqdm(packed))
+    finally:
+        _SHARED.clear()
+
+    results = [unpack(*r) if is_df else r for is_df, r in results]
+    if not concat:
+        return results
+    frames = [r for r in results if r is not None]
+    if not frames:
+        return gdf.iloc[:0]
+    out = pd.concat(frames)
+    if isinstance(frames[0], gpd.GeoDataFrame):
+        out = gpd.GeoDataFrame(out, geometry=frames[0].geometry.name,
+                               crs=frames[0].crs)
+    if ordered and gdf.index.is_unique:
+        pos = gdf.index.get_indexer(out.index)
+        if (pos >= 0).all():
+            out = out.iloc[np.argsort(pos, kind='stable')]
+
+    return out
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled, parallel polygonization of label rasters.
+
+The raster is split into tiles that are polygonized in parallel, each
+with gdal.Polygonize into an in memory layer with an integer label field.
+Polygons that do not touch an inner tile edge are complete and are
+written as each batch of tiles finishes. Polygons touching an inner edge
+are held back and stitched by label once all tiles are done: pieces with
+the same label are unioned and split into their connected parts, so the
+result matches polygonizing the whole raster at once (with 8
+connectedness, parts joined only at a corner are kept together as a
+MultiPolygon). Output can be any
+format supported by GDFWriter (GeoPackage, FlatGeobuf, GeoParquet, ...).
+"""
+import argparse
+import multiprocessing
+import os
+
+import numpy as np
+import geopandas as gpd
+from joblib import Parallel, delayed
+from osgeo import gdal, ogr
+from shapely.geometry import MultiPolygon
+from shapely.ops import unary_union
+from tqdm import tqdm
+
+from misc_utils.gdal_tools import valid_pixels
+from misc_utils.gpd_utils import GDFWriter
+from misc_utils.logging_utils import create_logger
+from misc_utils.parallel_apply import wkb_to_geoms
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+
+def tile_windows(x_sz, y_sz, tile_size):
+    """Return (xoff, yoff, cols, rows) windows of tile_size covering a raster."""
+    return [(xoff, yoff, min(tile_size, x_sz - xoff), min(tile_size, y_sz - yoff))
+            for yoff in range(0, y_sz, tile_size)
+            for xoff in range(0, x_sz, tile_size)]
+
+
+def polygonize_tile(img, window, band=1, mask_nodata=True, connectedness=4):
+    """
+    Polygonize one window of a label raster.
+
+    Returns
+    -------
+    tuple : (labels, WKB geometries, pixel counts, whether each polygon
+             touches an inner tile edge)
+    """
+    xoff, yoff, cols, rows = window
+    src = gdal.Open(img)
+    gt = src.GetGeoTransform()
+    src_band = src.GetRasterBand(band)
+    arr = src_band.ReadAsArray(xoff, yoff, cols, rows)
+    nodata_val = src_band.GetNoDataValue()
+    x_sz, y_sz = src.RasterXSize, src.RasterYSize
+    tile_gt = (gt[0] + xoff * gt[1], gt[1], 0, gt[3] + yoff * gt[5], 0, gt[5])
+    src = None
+
+    mem = gdal.GetDriverByName('MEM')
+    tile_ds = mem.Create('', cols, rows, 1, gdal.GDT_Int32)
+    tile_ds.SetGeoTransform(tile_gt)
+    tile_ds.GetRasterBand(1).WriteArray(arr.astype(np.int32))
+    mask_band = None
+    if mask_nodata:
+        mask_ds = mem.Create('', cols, rows, 1, gdal.GDT_Byte)
+        mask_ds.SetGeoTransform(tile_gt)
+        mask_ds.GetRasterBand(1).WriteArray(valid_pixels(arr, nodata_val).astype(np.uint8))
+        mask_band = mask_ds.GetRasterBand(1)
+
+    vec_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    lyr = vec_ds.CreateLayer('tile')
+    lyr.CreateField(ogr.FieldDefn('label', ogr.OFTInteger64))
+    options = ['8CONNECTED=8'] if connectedness == 8 else []
+    gdal.Polygonize(tile_ds.GetRasterBand(1), mask_band, lyr, 0, options)
+
+    labels = []
+    wkbs = []
+    for feat in lyr:
+        labels.append(feat.GetField(0))
+        wkbs.append(bytes(feat.GetGeometryRef().ExportToWkb()))
+    tile_ds = None
+    mask_ds = None
+    vec_ds = None
+
+    geoms = wkb_to_geoms(np.array(wkbs, dtype=object))
+    bounds = np.array([g.bounds for g in geoms]).reshape(-1, 4)
+    pixel_area = abs(gt[1] * gt[5])
+    n_pixels = np.round(np.array([g.area for g in geoms]) / pixel_area).astype(np.int64)
+    # Polygons reaching an edge shared with another tile
+    tol = abs(gt[1]) / 2
+    minx, maxy = tile_gt[0], tile_gt[3]
+    maxx, miny = minx + cols * gt[1], maxy + rows * gt[5]
+    on_edge = np.zeros(len(geoms), dtype=bool)
+    if xoff > 0:
+        on_edge |= bounds[:, 0] <= minx + tol
+    if xoff + cols < x_sz:
+        on_edge |= bounds[:, 2] >= maxx - tol
+    if yoff > 0:
+        on_edge |= bounds[:, 3] >= maxy - tol
+    if yoff + rows < y_sz:
+        on_edge |= bounds[:, 1] <= miny + tol
+
+    return np.array(labels, dtype=np.int64), np.array(wkbs, dtype=object), n_pixels, on_edge
+
+
+def _touching_groups(parts):
+    """Group parts that touch, including at a single vertex."""
+    group = list(range(len(parts)))
+
+    def find(i):
+        while group[i] != i:
+            group[i] = group[group[i]]
+            i = group[i]
+        return i
+
+    for i in range(len(parts)):
+        for j in range(i + 1, len(parts)):
+            if parts[i].intersects(parts[j]):
+                group[find(j)] = find(i)
+    groups = {}
+    for i in range(len(parts)):
+        groups.setdefault(find(i), []).append(i)
+
+    return list(groups.values())
+
+
+def stitch_by_label(labels, geoms, n_pixels, connectedness=4):
+    """
+    Union pieces of polygons with the same label, split into connected
+    parts. Pixel counts of the parts are summed from their pieces.
+
+    With connectedness 8, parts touching only at a corner are connected,
+    as gdal.Polygonize with 8CONNECTED=8 would join them, and are
+    written as a single MultiPolygon.
+
+    Returns
+    -------
+    tuple : (labels, geometries, pixel counts)
+    """
+    out_labels, out_geoms, out_pixels = [], [], []
+    order = np.argsort(labels, kind='stable')
+    labels, n_pixels = labels[order], n_pixels[order]
+    geoms = [geoms[i] for i in order]
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]]) if len(labels) else []
+    for s, e in zip(starts, np.r_[starts[1:], len(labels)] if len(labels) else []):
+        pieces = geoms[s:e]
+        merged = unary_union(pieces) if e - s > 1 else pieces[0]
+        parts = list(merged.geoms) if hasattr(merged, 'geoms') else [merged]
+        if connectedness == 8 and len(parts) > 1:
+            parts = [MultiPolygon([parts[i] for i in g]) if len(g) > 1 else parts[g[0]]
+                     for g in _touching_groups(parts)]
+        if len(parts) == 1:
+            part_pixels = [n_pixels[s:e].sum()]
+        else:
+            # Assign pieces to the part containing them
+            part_pixels = [0] * len(parts)
+            for piece, n in zip(pieces, n_pixels[s:e]):
+                pt = piece.representative_point()
+                idx = next((i for i, p in enumerate(parts) if p.intersects(pt)), 0)
+                part_pixels[idx] += n
+        out_labels.extend([labels[s]] * len(parts))
+        out_geoms.extend(parts)
+        out_pixels.extend(part_pixels)
+
+    return (np.array(out_labels, dtype=np.int64), out_geoms,
+            np.array(out_pixels, dtype=np.int64))
+
+
+def _to_gdf(labels, geoms, n_pixels, fieldname, crs, area, pixel_area):
+    gdf = gpd.GeoDataFrame({fieldname: labels}, geometry=list(geoms), crs=crs)
+    if area:
+        gdf['n_pixels'] = n_pixels
+        gdf['area'] = n_pixels * pixel_area
+
+    return gdf
+
+
+def polygonize_tiles(img, out_vec, band=1, fieldname='label', tile_size=4096,
+                     n_jobs=None, area=False, mask_nodata=True,
+                     connectedness=4, overwrite=True):
+    """
+    Polygonize a label raster in tiles, in parallel.
+
+    Parameters
+    ----------
+    img : str
+        Label raster.
+    out_vec : str
+        Output vector, e.g. .gpkg, .fgb or .parquet.
+    band : int
+        Band to polygonize.
+    fieldname : str
+        Name of the integer label field.
+    tile_size : int
+        Side of tiles, in pixels.
+    n_jobs : int
+        Number of processes, defaults to all but two cores.
+    area : bool
+        Add 'n_pixels' and 'area' (in units of the raster crs) fields,
+        counted from pixels.
+    mask_nodata : bool
+        Do not polygonize NoData pixels. gdal_polygonize does not mask
+        NoData, set False for the same output.
+    connectedness : int
+        4 or 8 connected pixels form polygons. With 8, regions joined
+        only diagonally across a tile edge are written as a MultiPolygon.
+    overwrite : bool
+        Overwrite out_vec if it exists.
+
+    Returns
+    -------
+    str : out_vec
+    """
+    src = gdal.Open(img)
+    x_sz, y_sz = src.RasterXSize, src.RasterYSize
+    gt = src.GetGeoTransform()
+    crs = src.GetProjection()
+    src = None
+    pixel_area = abs(gt[1] * gt[5])
+    windows = tile_windows(x_sz, y_sz, tile_size)
+    n_jobs = n_jobs if n_jobs else max(multiprocessing.cpu_count() - 2, 1)
+    logger.info('Polygonizing {} in {:,} tiles...'.format(img, len(windows)))
+
+    edge_labels, edge_wkbs, edge_pixels = [], [], []
+    n_written = 0
+    with GDFWriter(out_vec, overwrite=overwrite) as writer, \
+            Parallel(n_jobs=n_jobs) as parallel:
+        # Batches of tiles, so only complete polygons of a batch are in memory
+        for i in tqdm(range(0, len(windows), n_jobs)):
+            results = parallel(delayed(polygonize_tile)(img, w, band=band,
+                                                        mask_nodata=mask_nodata,
+                                                        connectedness=connectedness)
+                               for w in windows[i:i + n_jobs])
+            for labels, wkbs, n_pixels, on_edge in results:
+                if (~on_edge).any():
+                    writer.write(_to_gdf(labels[~on_edge], wkb_to_geoms(wkbs[~on_edge]),
+                                         n_pixels[~on_edge], fieldname, crs,
+                                         area, pixel_area))
+                    n_written += (~on_edge).sum()
+                edge_labels.append(labels[on_edge])
+                edge_wkbs.append(wkbs[on_edge])
+                edge_pixels.append(n_pixels[on_edge])
+
+        logger.info('Stitching polygons across tile edges...')
+        labels, geoms, n_pixels = stitch_by_label(
+            np.concatenate(edge_labels) if edge_labels else np.array([], dtype=np.int64),
+            list(wkb_to_geoms(np.concatenate(edge_wkbs))) if edge_wkbs else [],
+            np.concatenate(edge_pixels) if edge_pixels else np.array([], dtype=np.int64),
+            connectedness=connectedness)
+        if len(labels) > 0:
+            writer.write(_to_gdf(labels, geoms, n_pixels, fieldname, crs,
+                                 area, pixel_area))
+            n_written += len(labels)
+    logger.info('Polygons written: {:,}'.format(n_written))
+
+    return out_vec
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--img', type=os.path.abspath, required=True,
+                        help='Label raster to polygonize.')
+    parser.add_argument('-o', '--out_vec', type=os.path.abspath, required=True,
+                        help='Output vector, e.g. .gpkg, .fgb or .parquet.')
+    parser.add_argument('-b', '--band', type=int, default=1,
+                        help='Band to polygonize.')
+    parser.add_argument('-f', '--fieldname', type=str, default='label',
+                        help='Name of the integer label field.')
+    parser.add_argument('-ts', '--tile_size', type=int, default=4096,
+                        help='Side of tiles, in pixels.')
+    parser.add_argument('-j', '--n_jobs', type=int,
+                        help='Number of processes.')
+    parser.add_argument('--area', action='store_true',
+                        help='Add pixel count and area fields.')
+    parser.add_argument('--eight_connected', action='store_true',
+                        help='Use 8 connected pixels rather than 4.')
+
+    args = parser.parse_args()
+
+    polygonize_tiles(img=args.img, out_vec=args.out_vec, band=args.band,
+                     fieldname=args.fieldname, tile_size=args.tile_size,
+                     n_jobs=args.n_jobs, area=args.area,
+                     connectedness=8 if args.eight_connected else 4)
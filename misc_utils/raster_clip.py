@@ -6,16 +6,19 @@ Created on Tue Aug 27 15:36:40 2019
 Clip raster to shapefile extent. Must be in the same projection.
 """
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import shutil
+import threading
 
-from osgeo import ogr, gdal
+from osgeo import ogr, gdal, osr
 import os, logging, argparse
 
-import geopandas as gpd
-# import shapely
-
-from misc_utils.gdal_tools import check_sr, ogr_reproject, get_raster_sr, \
-    remove_shp
+from shapely import wkb
+from shapely.geometry import Polygon, mapping
+from shapely.ops import unary_union
 from misc_utils.id_parse_utils import read_ids
 from misc_utils.logging_utils import create_logger
 
@@ -43,102 +46,193 @@ def move_meta_files(raster_p, out_dir, raster_ext=None):
         shutil.copy(src, out_dir)
 
 
+# Cutlines reprojected and dissolved, by (hash of dissolved geometry,
+# shape SRS, target SRS)
+_CUTLINES = {}
+_CUTLINES_LOCK = threading.Lock()
+
+Cutline = namedtuple('Cutline', ['path', 'geometry', 'rectangular'])
+
+
+def _traditional_order(srs):
+    # GDAL >= 3 honours authority axis order (lat, lon) unless told not to
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def get_cutline(shp_p, srs_wkt=None):
+    """
+    Return the features of shp_p dissolved into a single geometry,
+    reprojected to srs_wkt, and written to /vsimem for use as a cutline.
+    Cutlines are cached on the content of the shape (its dissolved
+    geometry and SRS) and srs_wkt, so clipping many rasters to the same
+    shape reprojects and writes it once, and a path rewritten with a new
+    shape (e.g. a fixed /vsimem path) is never served a stale cutline.
+
+    Parameters
+    ----------
+    shp_p : str
+        Path to vector file, may be in /vsimem.
+    srs_wkt : str
+        WKT of the SRS to reproject to, the shape's SRS if None.
+
+    Returns
+    -------
+    Cutline : namedtuple of (path, shapely geometry, whether the geometry
+              is an axis-aligned rectangle)
+    """
+    ds = ogr.Open(shp_p)
+    lyr = ds.GetLayer()
+    geoms = [wkb.loads(bytes(feat.GetGeometryRef().ExportToWkb()))
+             for feat in lyr if feat.GetGeometryRef() is not None]
+    if len(geoms) > 1:
+        logger.debug('Dissolving clipping shape with multiple features...')
+    geom = unary_union(geoms)
+    shp_srs = lyr.GetSpatialRef()
+    shp_srs = shp_srs.Clone() if shp_srs is not None else None
+    ds = None
+
+    key = (hashlib.sha1(geom.wkb).hexdigest(),
+           shp_srs.ExportToWkt() if shp_srs is not None else None, srs_wkt)
+    with _CUTLINES_LOCK:
+        if key in _CUTLINES:
+            return _CUTLINES[key]
+
+        if srs_wkt and shp_srs is not None:
+            srs = _traditional_order(osr.SpatialReference(wkt=srs_wkt))
+            if not shp_srs.IsSame(srs):
+                logger.debug('Reprojecting clipping shape to raster SRS...')
+                ogr_geom = ogr.CreateGeometryFromWkb(geom.wkb)
+                ogr_geom.AssignSpatialReference(_traditional_order(shp_srs))
+                ogr_geom.TransformTo(srs)
+                geom = wkb.loads(bytes(ogr_geom.ExportToWkb()))
+
+        rectangular = (isinstance(geom, Polygon) and not geom.interiors and
+                       abs(geom.envelope.area - geom.area) <= 1e-9 * geom.envelope.area)
+        path = '/vsimem/clip_cutline_{}.geojson'.format(len(_CUTLINES))
+        feature_collection = {'type': 'FeatureCollection',
+                              'features': [{'type': 'Feature', 'properties': {},
+                                            'geometry': mapping(geom)}]}
+        gdal.FileFromMemBuffer(path, json.dumps(feature_collection))
+        _CUTLINES[key] = Cutline(path, geom, rectangular)
+
+        return _CUTLINES[key]
+
+
+def clip_raster(raster_p, out_path, cutline, out_format=None):
+    """
+    Clip a raster to a Cutline. Rectangular cutlines are clipped with
+    gdal.Translate to the pixels covering the rectangle, on the grid of
+    the raster, without resampling. Other cutlines are clipped with
+    gdal.Warp, cropping to the cutline.
+
+    out_format : str
+        GDAL driver, from the out_path extension if not provided. With
+        'VRT' only a lightweight window onto raster_p is written.
+    """
+    if out_format is None:
+        out_format = 'VRT' if out_path.lower().endswith('.vrt') else 'GTiff'
+    raster_ds = gdal.Open(raster_p, gdal.GA_ReadOnly)
+    if cutline.rectangular:
+        minx, miny, maxx, maxy = cutline.geometry.bounds
+        translate_options = gdal.TranslateOptions(format=out_format,
+                                                  projWin=[minx, maxy, maxx, miny])
+        gdal.Translate(out_path, raster_ds, options=translate_options)
+    else:
+        x_res = raster_ds.GetGeoTransform()[1]
+        y_res = raster_ds.GetGeoTransform()[5]
+        warp_options = gdal.WarpOptions(format=out_format,
+                                        cutlineDSName=cutline.path,
+                                        cropToCutline=True,
+                                        targetAlignedPixels=True,
+                                        xRes=x_res,
+                                        yRes=y_res)
+        gdal.Warp(out_path, raster_ds, options=warp_options)
+    # Close the raster
+    raster_ds = None
+    logger.debug('Clipped raster created at {}'.format(out_path))
+
+    return out_path
+
+
 def clip_rasters(shp_p, rasters, out_path=None, out_dir=None, out_suffix='_clip',
-                 out_prj_shp=None, raster_ext=None, move_meta=False, 
-                 in_mem=False, skip_srs_check=False, overwrite=False):
+                 out_prj_shp=None, raster_ext=None, move_meta=False,
+                 in_mem=False, skip_srs_check=False, overwrite=False,
+                 out_format='GTiff', threads=4):
     """
     Take a list of rasters and warps (clips) them to the shapefile feature
     bounding box.
     rasters : LIST or STR
         List of rasters to clip, or if STR, path to single raster.
+    out_path : STR or LIST
+        Path to write clipped raster to, or list of paths, one per raster.
     out_prj_shp : os.path.abspath
-        Path to create the projected shapefile if necessary to match raster prj
+        Path to write the shape reprojected to the raster prj, if it was
+        necessary to reproject it. Reprojection is otherwise in memory.
+    skip_srs_check : bool
+        Assume the shape and rasters have the same spatial reference.
+    out_format : str
+        'GTiff' or 'VRT'. VRTs are lightweight windows onto the source
+        rasters, for when clipped rasters are only read.
+    threads : int
+        Number of rasters to clip concurrently.
     """
-    # TODO: Fix permission error if out_prj_shp not supplied -- create in-mem
-    #  OGR?
     # Use in memory directory if specified
     if out_dir is None:
         in_mem = True
     if in_mem:
         out_dir = r'/vsimem'
+    out_ext = '.vrt' if out_format.upper() == 'VRT' else '.tif'
 
-    # Check that spatial references match, if not reproject (assumes all rasters have same projection)
-    # TODO: support different extension (slow to check all of them in the loop below)
     # Check if list of rasters provided or if single raster
-    if isinstance(rasters, list):
-        check_raster = rasters[0]
-    else:
-        check_raster = rasters
+    if not isinstance(rasters, list):
         rasters = [rasters]
+    if isinstance(out_path, (list, tuple)):
+        out_paths = list(out_path)
+    else:
+        out_paths = [out_path] * len(rasters)
 
-    if not skip_srs_check:
-        logger.debug('Checking spatial reference match:\n{}\n{}'.format(shp_p, check_raster))
-        sr_match = check_sr(shp_p, check_raster)
-        if not sr_match:
-            logger.debug('Spatial references do not match. Reprojecting to AOI...')
-            if not out_prj_shp:
-                out_prj_shp = shp_p.replace('.shp', '_prj.shp')
-            shp_p = ogr_reproject(shp_p,
-                                  to_sr=get_raster_sr(check_raster),
-                                  output_shp=out_prj_shp)
-
-    shp = gpd.read_file(shp_p)
-    if len(shp) > 1:
-        logger.debug('Dissolving clipping shape with multiple features...')
-        shp['dissolve'] = 1
-        shp = shp.dissolve(by='dissolve')
-        shp_p = r'/vsimem/clip_shp_dissolve.shp'
-        shp.to_file(shp_p)
-
-    # Do the 'warping' / clipping
+    jobs = []
     warped = []
-    for raster_p in rasters:
+    for raster_p, raster_out_path in zip(rasters, out_paths):
         # TODO: Handle this with platform.sys and pathlib.Path objects
         raster_p = raster_p.replace(r'\\', os.sep)
         raster_p = raster_p.replace(r'/', os.sep)
 
         # Create out_path if not provided
-        if not out_path:
-            if not out_dir:
-                logger.debug('NO OUT_DIR')
-            # Create outpath
-            raster_out_name = '{}{}.tif'.format(
-                os.path.basename(raster_p).split('.')[0], out_suffix)
+        if not raster_out_path:
+            raster_out_name = '{}{}{}'.format(
+                os.path.basename(raster_p).split('.')[0], out_suffix, out_ext)
             raster_out_path = os.path.join(out_dir, raster_out_name)
-        else:
-            raster_out_path = out_path
 
-        # Clip to shape
+        # Cutline in the spatial reference of each raster, reprojected once
+        # per spatial reference
+        srs_wkt = None if skip_srs_check else gdal.Open(raster_p).GetProjection()
+        cutline = get_cutline(shp_p, srs_wkt)
+        if out_prj_shp and srs_wkt and not os.path.exists(out_prj_shp):
+            gdal.VectorTranslate(out_prj_shp, cutline.path)
+
         logger.info('Clipping:\n{}\n\t---> '
-                     '{}'.format(os.path.basename(raster_p),
-                                 raster_out_path))
+                    '{}'.format(os.path.basename(raster_p),
+                                raster_out_path))
         if os.path.exists(raster_out_path) and not overwrite:
             logger.warning('Outpath exists, skipping: '
                            '{}'.format(raster_out_path))
-            pass
         else:
-            raster_ds = gdal.Open(raster_p, gdal.GA_ReadOnly)
-            x_res = raster_ds.GetGeoTransform()[1]
-            y_res = raster_ds.GetGeoTransform()[5]
-            warp_options = gdal.WarpOptions(cutlineDSName=shp_p,
-                                            cropToCutline=True,
-                                            targetAlignedPixels=True,
-                                            xRes=x_res,
-                                            yRes=y_res)
-            gdal.Warp(raster_out_path, raster_ds, options=warp_options)
-            # Close the raster
-            raster_ds = None
-            logger.debug('Clipped raster created at {}'.format(raster_out_path))
-            # Add clipped raster path to list of clipped rasters to return
-            warped.append(raster_out_path)
+            jobs.append((raster_p, raster_out_path, cutline))
+        warped.append(raster_out_path)
         # Move meta-data files if specified
         if move_meta:
             logger.debug('Moving metadata files to clip destination...')
             move_meta_files(raster_p, out_dir, raster_ext=raster_ext)
 
-    # Remove projected shp
-    if in_mem is True:
-        remove_shp(out_prj_shp)
+    # Do the clipping, GDAL releases the GIL while reading and writing
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        futures = [executor.submit(clip_raster, r, o, c, out_format=out_format)
+                   for r, o, c in jobs]
+        for f in futures:
+            f.result()
 
     # If only one raster provided, just return the single path as str
     if len(warped) == 1:
@@ -161,6 +255,10 @@ if __name__ == '__main__':
                         help='Use this flag to move associated metadata files to clip destination.')
     parser.add_argument('--overwrite', action='store_true',
                         help='Overwrite output files.')
+    parser.add_argument('--vrt', action='store_true',
+                        help='Write clipped rasters as VRTs referencing the input rasters.')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Number of rasters to clip concurrently.')
     parser.add_argument('--dryrun', action='store_true', help='Prints inputs without running.')
 
     args = parser.parse_args()
@@ -172,6 +270,8 @@ if __name__ == '__main__':
     raster_ext = args.raster_ext
     move_meta = args.move_meta
     overwrite = args.overwrite
+    out_format = 'VRT' if args.vrt else 'GTiff'
+    threads = args.threads
     dryrun = args.dryrun
 
     # Check if list of rasters given or directory
@@ -196,4 +296,5 @@ if __name__ == '__main__':
 
     if not dryrun:
         clip_rasters(shp_path, rasters, out_dir=out_dir, out_suffix=out_suffix, raster_ext=raster_ext,
-                     move_meta=move_meta, overwrite=overwrite)
+                     move_meta=move_meta, overwrite=overwrite,
+                     out_format=out_format, threads=threads)
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+Antimeridian and pole aware spatial partitioning of global datasets.
+
+Geometries are assigned to square tiles in one of three zones:
+    N - polar stereographic north (EPSG:3413), latitudes >= polar_lat
+    S - polar stereographic south (EPSG:3031), latitudes <= -polar_lat
+    G - geographic (EPSG:4326) lon / lat tiles between them
+Geometries crossing the antimeridian are split before being assigned to
+geographic tiles, and polar geometries are tiled in polar stereographic
+coordinates, where their bounding boxes are meaningful. Tiles holding more
+than max_items features are subdivided into quadrants, so the work in
+each partition is bounded.
+
+Tiles are named '<zone><level>_<ix>_<iy>'.
+"""
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from joblib import Parallel, delayed
+from shapely.geometry import box, MultiPolygon
+from shapely.ops import transform
+
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+ZONE_CRS = {'G': 'epsg:4326', 'N': 'epsg:3413', 'S': 'epsg:3031'}
+
+
+def crosses_antimeridian(geoms):
+    """
+    Flag geographic geometries whose longitudes span more than 180
+    degrees, which are assumed to cross the antimeridian.
+    """
+    bounds = geoms.bounds
+    return ((bounds['maxx'] - bounds['minx']) > 180).values
+
+
+def _shift_west(geom):
+    # Move western hemisphere coordinates east of 180
+    return transform(lambda x, y, z=None: (np.where(np.asarray(x) < 0,
+                                                    np.asarray(x) + 360, x), y),
+                     geom)
+
+
+def split_antimeridian(geoms):
+    """
+    Split geographic geometries that cross the antimeridian into parts
+    on either side of it.
+
+    Parameters
+    ----------
+    geoms : gpd.GeoSeries
+        Geometries in EPSG:4326.
+
+    Returns
+    -------
+    gpd.GeoSeries : geometries, with crossing geometries as multi-part
+                    geometries split at 180.
+    """
+    crossing = crosses_antimeridian(geoms)
+    if not crossing.any():
+        return geoms
+    east = box(-180, -90, 180, 90)
+    west = box(180, -90, 540, 90)
+    out = geoms.copy()
+    split = []
+    for geom in geoms[crossing]:
+        shifted = _shift_west(geom)
+        east_part = shifted.intersection(east)
+        west_part = transform(lambda x, y, z=None: (np.asarray(x) - 360, y),
+                              shifted.intersection(west))
+        parts = [p for p in (east_part, west_part) if not p.is_empty]
+        polys = []
+        for p in parts:
+            polys.extend(getattr(p, 'geoms', [p]))
+        polys = [p for p in polys if p.geom_type == 'Polygon']
+        split.append(MultiPolygon(polys) if polys else geom)
+    out[crossing] = split
+
+    return out
+
+
+def lonlat_where(geoms, lon_fld, lat_fld, pad=0, max_gap=20):
+    """
+    Build a SQL where clause selecting records with lon_fld / lat_fld
+    within the extent of geoms, without wrapping the antimeridian.
+    Longitude ranges of geometry parts that are less than max_gap
+    degrees apart are merged.
+
+    Parameters
+    ----------
+    geoms : gpd.GeoSeries
+        Geometries in EPSG:4326.
+    lon_fld, lat_fld : str
+        Longitude and latitude fields.
+    pad : float
+        Degrees to pad the extent by.
+    max_gap : float
+        Merge longitude ranges closer than this.
+
+    Returns
+    -------
+    str
+    """
+    parts = split_antimeridian(geoms).explode()
+    bounds = parts.bounds.sort_values(by='minx')
+    ranges = []
+    for _, b in bounds.iterrows():
+        if ranges and b['minx'] - ranges[-1][1] <= max_gap:
+            r = ranges[-1]
+            ranges[-1] = [r[0], max(r[1], b['maxx']),
+                          min(r[2], b['miny']), max(r[3], b['maxy'])]
+        else:
+            ranges.append([b['minx'], b['maxx'], b['miny'], b['maxy']])
+
+    wheres = []
+    for minx, maxx, miny, maxy in ranges:
+        wheres.append('({0} > {2} AND {0} < {3} AND {1} > {4} AND {1} < {5})'.format(
+            lon_fld, lat_fld, minx - pad, maxx + pad, miny - pad, maxy + pad))
+
+    return '({})'.format(' OR '.join(wheres))
+
+
+def _expand_ranges(pos, ix0, ix1, iy0, iy1):
+    """
+    Expand per-feature inclusive tile index ranges into one row per
+    (feature, tile).
+    """
+    nx = ix1 - ix0 + 1
+    ny = iy1 - iy0 + 1
+    n = nx * ny
+    rep = np.repeat(np.arange(len(pos)), n)
+    # Offset of each row within its feature's block of tiles
+    offset = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    ix = ix0[rep] + offset // ny[rep]
+    iy = iy0[rep] + offset % ny[rep]
+
+    return pos[rep], ix, iy
+
+
+class TilePartitioner:
+    """
+    Assign features to zone tiles, see module docstring.
+
+    Parameters
+    ----------
+    tile_size : float
+        Size of level 0 geographic tiles, in degrees.
+    polar_tile_size : float
+        Size of level 0 polar stereographic tiles, in meters.
+    polar_lat : float
+        Latitude poleward of which polar stereographic tiles are used.
+    max_items : int
+        Subdivide tiles with more than this many features.
+    max_level : int
+        Maximum number of subdivisions.
+    """
+
+    def __init__(self, tile_size=10, polar_tile_size=1_000_000, polar_lat=60,
+                 max_items=50_000, max_level=6):
+        self.tile_size = tile_size
+        self.polar_tile_size = polar_tile_size
+        self.polar_lat = polar_lat
+        self.max_items = max_items
+        self.max_level = max_level
+
+    def _size(self, zone, level):
+        size = self.tile_size if zone == 'G' else self.polar_tile_size
+        return size / 2**level
+
+    def _origin(self, zone):
+        return (-180, -90) if zone == 'G' else (0, 0)
+
+    def tile_id(self, zone, level, ix, iy):
+        return '{}{}_{}_{}'.format(zone, level, ix, iy)
+
+    def tile_bounds(self, tile_id):
+        """Return (crs, (minx, miny, maxx, maxy)) of a tile."""
+        zone = tile_id[0]
+        level, ix, iy = [int(x) for x in tile_id[1:].split('_')]
+        size = self._size(zone, level)
+        ox, oy = self._origin(zone)
+        minx = ox + ix * size
+        miny = oy + iy * size
+        return ZONE_CRS[zone], (minx, miny, minx + size, miny + size)
+
+    def _zone_geoms(self, geoms):
+        """
+        Split geographic geometries into the zones they fall in, returning
+        {zone: (positions, geometries in the zone crs)}.
+        """
+        bounds = geoms.bounds
+        miny = bounds['miny'].values
+        maxy = bounds['maxy'].values
+        pos = np.arange(len(geoms))
+        zones = {}
+        in_g = (miny < self.polar_lat) & (maxy > -self.polar_lat)
+        in_n = maxy >= self.polar_lat
+        in_s = miny <= -self.polar_lat
+        if in_g.any():
+            split = split_antimeridian(geoms[in_g]).explode()
+            # Exploded parts keep the position of their geometry in the
+            # first level of their index
+            part_pos = split.index.get_level_values(0).values
+            zones['G'] = (part_pos, split)
+        for zone, mask in (('N', in_n), ('S', in_s)):
+            if mask.any():
+                zones[zone] = (pos[mask], geoms[mask].to_crs(ZONE_CRS[zone]))
+
+        return zones
+
+    def _assign_level(self, zone, zpos, zgeoms, level, how):
+        size = self._size(zone, level)
+        ox, oy = self._origin(zone)
+        if how == 'centroid':
+            pts = zgeoms.representative_point()
+            ix = np.floor((pts.x.values - ox) / size).astype(np.int64)
+            iy = np.floor((pts.y.values - oy) / size).astype(np.int64)
+            return zpos, ix, iy
+        b = zgeoms.bounds
+        # Geometries that could not be projected to the zone
+        valid = np.isfinite(b.values).all(axis=1)
+        if not valid.all():
+            logger.warning('Skipping {:,} geometries with invalid bounds in zone '
+                           '{}'.format((~valid).sum(), zone))
+            b = b[valid]
+            zpos = zpos[valid]
+        ix0 = np.floor((b['minx'].values - ox) / size).astype(np.int64)
+        ix1 = np.floor((b['maxx'].values - ox) / size).astype(np.int64)
+        iy0 = np.floor((b['miny'].values - oy) / size).astype(np.int64)
+        iy1 = np.floor((b['maxy'].values - oy) / size).astype(np.int64)
+        return _expand_ranges(zpos, ix0, ix1, iy0, iy1)
+
+    def _centroid_zones(self, geoms):
+        """Zone of each geometry's representative point, as a single zone."""
+        lat = geoms.representative_point().y.values
+        zone = np.where(lat >= self.polar_lat, 'N',
+                        np.where(lat <= -self.polar_lat, 'S', 'G'))
+        pos = np.arange(len(geoms))
+        zones = {}
+        for z in ('G', 'N', 'S'):
+            mask = zone == z
+            if mask.any():
+                zgeoms = geoms[mask]
+                if z == 'G':
+                    # Representative point of the split geometry, so crossing
+                    # geometries are not placed near 0 longitude
+                    zgeoms = split_antimeridian(zgeoms)
+                else:
+                    zgeoms = zgeoms.to_crs(ZONE_CRS[z])
+                zones[z] = (pos[mask], zgeoms)
+        return zones
+
+    def _geographic(self, gdf):
+        geoms = gdf.geometry
+        if gdf.crs is not None and gdf.crs != ZONE_CRS['G']:
+            geoms = geoms.to_crs(ZONE_CRS['G'])
+        return geoms.reset_index(drop=True)
+
+    def assign(self, gdf, how='intersects', tiles=None):
+        """
+        Assign features to tiles.
+
+        Parameters
+        ----------
+        gdf : gpd.GeoDataFrame
+            Features, in any crs.
+        how : str
+            'intersects' - each feature is assigned to every tile its
+                           bounding box (in the zone crs) overlaps
+            'centroid' - each feature is assigned to the single tile
+                         holding its representative point
+        tiles : list
+            Tile IDs to assign to, e.g. from partition(). If not provided,
+            level 0 tiles are used.
+
+        Returns
+        -------
+        pd.DataFrame : columns 'pos' (position of feature in gdf) and
+                       'tile', one row per (feature, tile).
+        """
+        geoms = self._geographic(gdf)
+        zones = self._centroid_zones(geoms) if how == 'centroid' else self._zone_geoms(geoms)
+
+        levels = {0}
+        if tiles is not None:
+            tiles = pd.Index(tiles)
+            levels = set(int(t[1:].split('_')[0]) for t in tiles)
+
+        pairs = []
+        for zone, (zpos, zgeoms) in zones.items():
+            for level in sorted(levels):
+                pos, ix, iy = self._assign_level(zone, zpos, zgeoms, level, how)
+                tile = ['{}{}_{}_{}'.format(zone, level, x, y) for x, y in zip(ix, iy)]
+                zp = pd.DataFrame({'pos': pos, 'tile': tile})
+                if tiles is not None:
+                    zp = zp[zp['tile'].isin(tiles)]
+                pairs.append(zp)
+        if not pairs:
+            return pd.DataFrame({'pos': [], 'tile': []})
+        pairs = pd.concat(pairs, ignore_index=True).drop_duplicates()
+
+        return pairs
+
+    def partition(self, gdf, how='centroid'):
+        """
+        Assign features to tiles, subdividing any tile with more than
+        max_items features until it is below max_items or max_level is
+        reached.
+
+        Returns
+        -------
+        pd.DataFrame : see assign.
+        """
+        pairs = self.assign(gdf, how=how)
+        for level in range(1, self.max_level + 1):
+            counts = pairs['tile'].value_counts()
+            full = counts[counts > self.max_items].index
+            if len(full) == 0:
+                break
+            logger.debug('Subdividing {:,} tiles to level {}'.format(len(full), level))
+            full_rows = pairs['tile'].isin(full)
+            parents = pairs[full_rows]
+            sub = self.assign(gdf.iloc[parents['pos'].unique()], how=how,
+                              tiles=self._children(full, level))
+            # Map positions in the subset back to gdf
+            sub['pos'] = parents['pos'].unique()[sub['pos'].values]
+            pairs = pd.concat([pairs[~full_rows], sub], ignore_index=True)
+
+        return pairs
+
+    def tile_extents(self, gdf, pairs):
+        """
+        Bounding boxes of the features of gdf placed in each tile, per zone
+        crs. Features reaching past their tile, or across polar_lat into
+        another zone, extend the box of their tile.
+
+        Parameters
+        ----------
+        gdf : gpd.GeoDataFrame
+        pairs : pd.DataFrame
+            Assignment of each feature of gdf to a single tile, from
+            partition(how='centroid').
+
+        Returns
+        -------
+        dict : {(tile, zone): (minx, miny, maxx, maxy)}
+        """
+        tile_of = pairs.drop_duplicates('pos').set_index('pos')['tile']
+        extents = {}
+        for zone, (zpos, zgeoms) in self._zone_geoms(self._geographic(gdf)).items():
+            b = pd.DataFrame(zgeoms.bounds.values, columns=['minx', 'miny', 'maxx', 'maxy'])
+            b['tile'] = tile_of.reindex(zpos).values
+            b = b[np.isfinite(b[['minx', 'miny', 'maxx', 'maxy']].values).all(axis=1)
+                  & b['tile'].notna()]
+            agg = b.groupby('tile').agg({'minx': 'min', 'miny': 'min',
+                                         'maxx': 'max', 'maxy': 'max'})
+            for t, row in agg.iterrows():
+                extents[(t, zone)] = tuple(row.values)
+
+        return extents
+
+    def assign_extents(self, gdf, extents):
+        """
+        Assign features to every tile whose extent (from tile_extents)
+        their bounding box overlaps, in the crs of each zone.
+
+        Returns
+        -------
+        pd.DataFrame : see assign.
+        """
+        pairs = []
+        for zone, (zpos, zgeoms) in self._zone_geoms(self._geographic(gdf)).items():
+            zone_extents = [(t, bnds) for (t, z), bnds in extents.items() if z == zone]
+            if not zone_extents:
+                continue
+            sindex = zgeoms.reset_index(drop=True).sindex
+            for t, bnds in zone_extents:
+                hits = np.fromiter(sindex.intersection(bnds), dtype=np.int64)
+                pairs.append(pd.DataFrame({'pos': zpos[hits], 'tile': t}))
+        if not pairs:
+            return pd.DataFrame({'pos': [], 'tile': []})
+
+        return pd.concat(pairs, ignore_index=True).drop_duplicates()
+
+    def _children(self, tiles, level):
+        children = []
+        for t in tiles:
+            zone = t[0]
+            _, ix, iy = [int(x) for x in t[1:].split('_')]
+            for dx in (0, 1):
+                for dy in (0, 1):
+                    children.append(self.tile_id(zone, level, 2 * ix + dx, 2 * iy + dy))
+        return children
+
+
+def map_partitions(fxn, gdf, other=None, partitioner=None, n_jobs=None,
+                   concat=True, **kwargs):
+    """
+    Run fxn over the tiles of gdf in parallel.
+
+    Each feature of gdf is placed in exactly one tile (by representative
+    point), so results for gdf features are not duplicated. Features of
+    other are passed to every tile whose gdf features' extent they
+    overlap, which can reach past the tile itself.
+
+    Parameters
+    ----------
+    fxn : function
+        Called as fxn(gdf_tile, other_tile, **kwargs), or fxn(gdf_tile,
+        **kwargs) if other is None. Must return a (Geo)DataFrame.
+    gdf : gpd.GeoDataFrame
+        Features to partition, e.g. geocells or AOIs.
+    other : gpd.GeoDataFrame
+        Features to pass alongside, e.g. footprints.
+    partitioner : TilePartitioner
+        Defaults to TilePartitioner().
+    n_jobs : int
+        Number of processes, defaults to all but two cores.
+    concat : bool
+        Concatenate results, otherwise return {tile: result}.
+    """
+    partitioner = partitioner if partitioner else TilePartitioner()
+    pairs = partitioner.partition(gdf, how='centroid')
+    tiles = pairs.groupby('tile')['pos'].apply(np.asarray)
+    if other is not None:
+        extents = partitioner.tile_extents(gdf, pairs)
+        other_pairs = partitioner.assign_extents(other, extents)
+        other_tiles = other_pairs.groupby('tile')['pos'].apply(np.asarray)
+    logger.info('Processing {:,} partitions...'.format(len(tiles)))
+
+    n_jobs = n_jobs if n_jobs else max(multiprocessing.cpu_count() - 2, 1)
+    # Largest partitions first for better load balance
+    order = tiles.apply(len).sort_values(ascending=False).index
+    args = []
+    for t in order:
+        if other is not None:
+            opos = other_tiles.get(t, np.array([], dtype=np.int64))
+            args.append((gdf.iloc[tiles[t]], other.iloc[opos]))
+        else:
+            args.append((gdf.iloc[tiles[t]], ))
+    results = Parallel(n_jobs=max(min(n_jobs, len(args)), 1))(
+        delayed(fxn)(*a, **kwargs) for a in args)
+
+    if not concat:
+        return dict(zip(order, results))
+    if not results:
+        return gdf.iloc[:0]
+    out = pd.concat(results)
+    if isinstance(results[0], gpd.GeoDataFrame):
+        out = gpd.GeoDataFrame(out, geometry=results[0].geometry.name,
+                               crs=results[0].crs)
+
+    return out
@@ -22,18 +22,16 @@ gdal.UseExceptions()
 def main(args):
     rasters = args.input_rasters
     out_path = args.out_path
-    # min_bb = args.min_bb
+    minbb = args.minbb
     rescale = args.rescale
     rescale_min = args.rescale_min
     rescale_max = args.rescale_max
 
-    # if min_bb:
-    #     logger.warning('Clipping to minimum bounding box not supported yet.')
-        # rasters = clip_rasters()
     logger.info('Stacking rasters:\n{}'.format('\n'.join(rasters)))
     stacked = stack_rasters(rasters=rasters, out=out_path,
                             rescale=rescale,
-                            rescale_min=rescale_min, rescale_max=rescale_max)
+                            rescale_min=rescale_min, rescale_max=rescale_max,
+                            minbb=minbb)
 
     logger.info('Done.')
 
@@ -45,9 +43,9 @@ if __name__ == '__main__':
                         help='Paths to the rasters to stack.')
     parser.add_argument('-o', '--out_path', type=os.path.abspath,
                         help='Path to write stacked, multiband raster to.')
-    # parser.add_argument('-mb', '--minbb', action='store_true',
-    #                     help="""Use flag to clip to minimum bounding box of rasters.
-    #                             Required for rasters of different dimensions.""")
+    parser.add_argument('-mb', '--minbb', action='store_true',
+                        help="""Use flag to clip to minimum bounding box of rasters.
+                                Required for rasters of different dimensions.""")
     parser.add_argument('-r', '--rescale', action='store_true',
                         help='Use flag to rescale stacked rasters between 0 and 1.')
     parser.add_argument('--rescale_min', type=float,
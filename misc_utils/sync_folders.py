@@ -1,59 +1,37 @@
 import argparse
 import os
 from pathlib import Path
-import shutil
-import time
-
-from tqdm import tqdm
 
+from misc_utils.copy_engine import copy_files
 from misc_utils.logging_utils import create_logger
 
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
 
-def sync_folders(src_dir, dst_dir, mod_date=True, dryrun=False):
+def sync_folders(src_dir, dst_dir, mod_date=True, dryrun=False,
+                 threads=4, manifest_path=None):
+    """
+    Copy files in src_dir missing from dst_dir, or with mod_date, files
+    that are newer in src_dir. Files are copied concurrently, see
+    misc_utils.copy_engine.copy_files.
+    """
     logger.info('Finding directory differences...')
     logger.info('Source 1:      {}'.format(src_dir))
     logger.info('Destination 2: {}'.format(dst_dir))
-    copy_list = []
+    pairs = []
     for root, dirs, files in os.walk(src_dir):
         r = Path(root)
-        pbar = tqdm(files)
-        prev_dir = ''
-        for f in pbar:
-            fp = r / f
-            cur_dir = fp.parent
-            if cur_dir != prev_dir:
-                pbar.write('Scanning: {}'.format(cur_dir.relative_to(src_dir)))
-            rp = fp.relative_to(src_dir)
-            dst = dst_dir / rp
-            if not dst.exists():
-                copy_list.append((fp, dst))
-            elif mod_date and (os.path.getmtime(fp) > os.path.getmtime(dst)):
-                copy_list.append((fp, dst))
-            prev_dir = cur_dir
-    logger.info('Differences found: {:,}'.format(len(copy_list)))
-    time.sleep(5)
+        pairs.extend((r / f, Path(dst_dir) / (r / f).relative_to(src_dir))
+                     for f in files)
 
     logger.info('Syncing files...')
-    if not dryrun:
-        error_files = []
-        pbar = tqdm(copy_list)
-        for src, dst in pbar:
-            if not dst.parent.exists():
-                os.makedirs(dst.parent)
-            pbar.write('Copying to: {}'.format(dst))
-            try:
-                shutil.copy2(src, dst)
-            except Exception as e:
-                logger.error('Error copying file: {}'.format(src))
-                logger.error(e)
-                error_files = []
-    if len(error_files) > 0:
-        logger.warning('Errors during file copy: {}'.format(len(error_files)))
-        logger.debug('Error files:\n{}'.format('\n'.join(error_files)))
-
+    result = copy_files(pairs, manifest_path=manifest_path, threads=threads,
+                        compare='newer' if mod_date else 'exists',
+                        dryrun=dryrun)
+    if len(result.failed) > 0:
+        logger.warning('Errors during file copy: {}'.format(len(result.failed)))
+        logger.debug('Error files:\n{}'.format('\n'.join(src for src, _ in result.failed)))
 
 
 if __name__ == '__main__':
@@ -70,16 +48,23 @@ if __name__ == '__main__':
                         help='Also sync directory2 to directory1.')
     parser.add_argument('--dryrun', action='store_true',
                         help='Locate differences but do not sync.')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='Number of files to copy concurrently.')
+    parser.add_argument('-m', '--manifest', type=os.path.abspath,
+                        help='json manifest of copied files, to resume from.')
 
     args = parser.parse_args()
 
     sync_folders(src_dir=args.directory1, dst_dir=args.directory2,
                  mod_date=args.mod_date,
-                 dryrun=args.dryrun)
+                 dryrun=args.dryrun,
+                 threads=args.threads,
+                 manifest_path=args.manifest)
 
     if args.reverse:
         sync_folders(src_dir=args.directory2, dst_dir=args.directory1,
-                     mod_date=mod_date,
-                     dryrun=args.dryrun)
+                     mod_date=args.mod_date,
+                     dryrun=args.dryrun,
+                     threads=args.threads)
 
     logger.info('Done.')
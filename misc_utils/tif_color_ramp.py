@@ -10,6 +10,8 @@ import logging
 import os
 import subprocess
 
+from misc_utils.fs_index import find_files
+
 
 # # Inputs
 # parent_dir = r'E:\disbr007\temp\arctic_dem_cmap'
@@ -87,12 +89,8 @@ def main(args):
         cmap = os.path.join(cwd, r'cmap.txt')
     
     # Collect 10m DEM stack count tifs
-    tifs = []
-    for root, dirs, files in os.walk(parent_dir, topdown=True):
-        dirs[:] = [d for d in dirs if d != 'subtiles']
-        for f in files:
-            if f.endswith(suffix):
-                tifs.append(os.path.join(root, f))
+    tifs = find_files(parent_dir, match=lambda f: f.endswith(suffix),
+                      exclude_names=['subtiles'])
                 
     # Create a IMG with colors corresponding to RGB values color_map text file
     for tif in tifs:
@@ -1,13 +1,20 @@
 import argparse
-import copy
+from itertools import islice
 import os
 from pathlib import PurePath
 
 from osgeo import gdal
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-
-from misc_utils.gpd_utils import write_gdf
+from joblib import Parallel, delayed
+from pyproj import CRS
+from tqdm import tqdm
+
+from misc_utils.gdal_tools import sample_raster, label_pixel_counts
+from misc_utils.gpd_utils import write_gdf, read_vector, read_vector_chunks, \
+    vector_info, GDFWriter
+from misc_utils.parallel_apply import pack, unpack
 from misc_utils.RasterWrapper import Raster
 from misc_utils.logging_utils import create_logger
 
@@ -17,13 +24,14 @@ gdal.UseExceptions()
 gdal.SetConfigOption('CHECK_DISK_FREE_SPACE', 'FALSE')
 
 
-def load_objs(objects):
+def load_objs(objects, **kwargs):
+    """Load objects, kwargs (columns, bbox, mask, where, limit, skip)
+    are passed to read_vector."""
     if isinstance(objects, PurePath):
         objects = str(objects)
     # Load objects
-    # TODO: Read in chunks, parallelize, recombine and write
     logger.info('Reading in objects...')
-    objs = gpd.read_file(objects)
+    objs = read_vector(objects, **kwargs)
     logger.info('Objects found: {:,}'.format(len(objs)))
 
     return objs
@@ -37,7 +45,69 @@ def remove_small_objects(objects, min_size):
     return objects
 
 
-def mask_objs(objs, mask_on, out_mask_img=None, out_mask_vec=None):
+def mask_objs(objs, mask_on, method='overlay', threshold=0.5, band=1,
+              out_mask_img=None, out_mask_vec=None):
+    """
+    Remove objects in NoData areas of a raster.
+
+    Parameters
+    ----------
+    objs : gpd.GeoDataFrame
+    mask_on : str
+        Raster whose NoData pixels are masked.
+    method : str
+        'centroid' / 'representative' - keep objects whose centroid /
+            representative point falls on a valid pixel.
+        'fraction' - keep objects whose fraction of valid pixels is at
+            least threshold. Objects smaller than a pixel use their
+            representative point.
+        'overlay' - intersect objects with the polygonized mask, which
+            also clips objects to valid areas.
+    threshold : float
+        Minimum fraction of valid pixels, for method='fraction'.
+    band : int
+        Band of mask_on to check for NoData.
+
+    Returns
+    -------
+    gpd.GeoDataFrame : objects kept.
+    """
+    if method == 'overlay':
+        return _overlay_mask_objs(objs, mask_on, out_mask_img=out_mask_img,
+                                  out_mask_vec=out_mask_vec)
+
+    logger.info('Removing objects in masked areas of: {}'.format(mask_on))
+    ds = gdal.Open(str(mask_on))
+    raster_crs = CRS.from_wkt(ds.GetProjection())
+    geoms = objs.geometry
+    if objs.crs is not None and CRS.from_user_input(objs.crs) != raster_crs:
+        geoms = geoms.to_crs(raster_crs.to_wkt())
+
+    if method in ('centroid', 'representative'):
+        pts = geoms.centroid if method == 'centroid' else geoms.representative_point()
+        _, keep = sample_raster(ds, pts.x.values, pts.y.values, band=band)
+    elif method == 'fraction':
+        n_pixels, n_valid = label_pixel_counts(geoms.values, ds, band=band)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            keep = n_valid / n_pixels >= threshold
+        # Objects not covering any pixel center
+        small = n_pixels == 0
+        if small.any():
+            pts = geoms[small].representative_point()
+            _, keep[small] = sample_raster(ds, pts.x.values, pts.y.values,
+                                           band=band)
+    else:
+        logger.error('Unrecognized mask method: {}'.format(method))
+        raise ValueError('Unrecognized mask method: {}'.format(method))
+    ds = None
+
+    keep_objs = objs[keep]
+    logger.info('Objects kept: {:,}'.format(len(keep_objs)))
+
+    return keep_objs
+
+
+def _overlay_mask_objs(objs, mask_on, out_mask_img=None, out_mask_vec=None):
     if out_mask_img is None:
         out_mask_img = r'/vsimem/temp_mask.tif'
     if out_mask_vec is None:
@@ -51,10 +121,6 @@ def mask_objs(objs, mask_on, out_mask_img=None, out_mask_vec=None):
 
     # Select only objects in valid areas of mask
     logger.info('Removing objects in masked areas...')
-    # TODO: use centroids for faster cleanup - Begin
-    objs_centroids = copy.deepcopy(objs).set_geometry(objs.geometry.centroid)
-    # use centroids for faster cleanup - End
-
     keep_objs = gpd.overlay(objs, not_mask)
     logger.info('Objects kept: {:,}'.format(len(keep_objs)))
 
@@ -67,41 +133,103 @@ def remove_null_objects(objects, fields=['all']):
         fields = list(objects)
     logger.info('Fields considered: {}'.format(fields))
 
-    keep_objs = objects[objects.apply(lambda x: all([pd.notna(x[f])
-                                                     for f in fields]), axis=1)]
-    # keep_objs = keep_objs[keep_objs[fields].notnull()]
+    keep_objs = objects[objects[fields].notna().all(axis=1)]
 
     logger.info('Objects kept: {:,}'.format(len(keep_objs)))
 
     return keep_objs
 
 
+def cleanup_chunk(objs, min_size=None, mask_on=None, mask_method='overlay',
+                  mask_threshold=0.5, out_mask_img=None, out_mask_vec=None,
+                  drop_na=None):
+    """Apply the cleanup filters to objs, cheapest first."""
+    if min_size:
+        objs = remove_small_objects(objects=objs, min_size=min_size)
+    if drop_na:
+        objs = remove_null_objects(objs, fields=drop_na)
+    if mask_on and len(objs) > 0:
+        objs = mask_objs(objs=objs, mask_on=mask_on,
+                         method=mask_method,
+                         threshold=mask_threshold,
+                         out_mask_img=out_mask_img,
+                         out_mask_vec=out_mask_vec)
+
+    return objs
+
+
+def _cleanup_chunk(packed, **kwargs):
+    # Clean and return the chunk packed for pickling
+    return pack(cleanup_chunk(unpack(*packed), **kwargs))
+
+
 def cleanup_objects(input_objects,
                     out_objects=None,
                     min_size=None,
                     mask_on=None,
+                    mask_method='overlay',
+                    mask_threshold=0.5,
                     out_mask_img=None,
                     out_mask_vec=None,
                     drop_na=None,
-                    overwrite=False):
-
-    keep_objs = load_objs(input_objects)
-
-    if min_size:
-        keep_objs = remove_small_objects(objects=keep_objs,
-                                         min_size=min_size)
-    if mask_on:
-        keep_objs = mask_objs(objs=keep_objs, mask_on=mask_on,
-                              out_mask_img=out_mask_img,
-                              out_mask_vec=out_mask_vec)
-    if drop_na:
-        keep_objs = remove_null_objects(keep_objs, fields=drop_na)
-
-    if out_objects:
+                    overwrite=False,
+                    chunk_size=None,
+                    n_jobs=1):
+    """
+    Remove small objects, objects with null fields and objects in NoData
+    areas of a raster.
+
+    With chunk_size, objects are read, cleaned and written chunk_size at
+    a time, n_jobs chunks in parallel, so the whole layer is never held
+    in memory. The input is read once, in order (see
+    gpd_utils.read_vector_chunks), and chunks are written in that order.
+
+    Returns
+    -------
+    out_objects, or the kept objects if out_objects is None and not
+    chunked.
+    """
+    filters = dict(min_size=min_size, mask_on=mask_on,
+                   mask_method=mask_method, mask_threshold=mask_threshold,
+                   out_mask_img=out_mask_img, out_mask_vec=out_mask_vec,
+                   drop_na=drop_na)
+    if not chunk_size:
+        keep_objs = cleanup_chunk(load_objs(input_objects), **filters)
+        if not out_objects:
+            return keep_objs
         logger.info('Writing kept objects ({:,}) to: {}'.format(len(keep_objs),
                                                                 out_objects))
-        keep_objs.to_file(out_objects)
         write_gdf(keep_objs, out_objects, overwrite=overwrite)
+        return out_objects
+
+    if not out_objects:
+        logger.error('out_objects must be provided to clean up in chunks.')
+        raise ValueError('out_objects must be provided to clean up in chunks.')
+    if mask_on and mask_method == 'overlay':
+        logger.warning('The overlay mask method polygonizes the whole mask '
+                       'raster for every chunk.')
+    n_objs = vector_info(input_objects)['features']
+    n_chunks = -(-n_objs // chunk_size)
+    logger.info('Cleaning up {:,} objects in {:,} chunks...'.format(n_objs,
+                                                                    n_chunks))
+    n_jobs = max(n_jobs, 1)
+    n_kept = 0
+    chunks = read_vector_chunks(input_objects, chunk_size)
+    with GDFWriter(out_objects, overwrite=overwrite) as writer, \
+            Parallel(n_jobs=n_jobs) as parallel, \
+            tqdm(total=n_chunks) as pbar:
+        # Process n_jobs chunks at a time, so only those are in memory
+        batch = list(islice(chunks, n_jobs))
+        while batch:
+            results = parallel(delayed(_cleanup_chunk)(pack(objs), **filters)
+                               for objs in batch)
+            for packed in results:
+                keep_objs = unpack(*packed)
+                writer.write(keep_objs)
+                n_kept += len(keep_objs)
+            pbar.update(len(batch))
+            batch = list(islice(chunks, n_jobs))
+    logger.info('Objects kept: {:,} / {:,}'.format(n_kept, n_objs))
 
     return out_objects
 
@@ -115,6 +243,17 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--raster', type=os.path.abspath,
                         help='Path to raster to use to remove objects in NoData'
                              ' areas.')
+    parser.add_argument('--mask_method', default='overlay',
+                        choices=['centroid', 'representative', 'fraction',
+                                 'overlay'],
+                        help='How to remove objects in NoData areas of '
+                             'raster: by the pixel at their centroid or '
+                             'representative point, by their fraction of '
+                             'valid pixels, or by overlay with the '
+                             'polygonized mask (clips objects).')
+    parser.add_argument('--mask_threshold', type=float, default=0.5,
+                        help='Minimum fraction of valid pixels to keep an '
+                             'object, with --mask_method fraction.')
     parser.add_argument('-dna', '--drop_na', nargs='+',
                         help='Drop objects where the passed fields are NaN. '
                              'Pass "all" to check all fields for NaN.')
@@ -130,6 +269,11 @@ if __name__ == '__main__':
                              'polygonized from mask raster.')
     parser.add_argument('--overwrite', action='store_true',
                         help='Overwrite outfile if it exists.')
+    parser.add_argument('--chunk_size', type=int,
+                        help='Read, clean up and write this many objects at '
+                             'a time, rather than loading all objects.')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='Number of chunks to clean up in parallel.')
 
     import sys
     # sys.argv = [r'C:\code\pgc-code-all\obia_utils\cleanup_objects.py',
@@ -148,6 +292,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     mask_on = args.raster
+    mask_method = args.mask_method
+    mask_threshold = args.mask_threshold
     drop_na = args.drop_na
     min_size = args.min_size
     input_objects = args.input_objects
@@ -155,12 +301,18 @@ if __name__ == '__main__':
     out_mask_img = args.out_mask_img
     out_mask_vec = args.out_mask_vec
     overwrite = args.overwrite
+    chunk_size = args.chunk_size
+    n_jobs = args.n_jobs
 
     cleanup_objects(input_objects=input_objects,
                     out_objects=out_objects,
                     min_size=min_size,
                     mask_on=mask_on,
+                    mask_method=mask_method,
+                    mask_threshold=mask_threshold,
                     drop_na=drop_na,
                     out_mask_vec=out_mask_vec,
                     out_mask_img=out_mask_img,
-                    overwrite=overwrite)
+                    overwrite=overwrite,
+                    chunk_size=chunk_size,
+                    n_jobs=n_jobs)
@@ -6,7 +6,6 @@ Created on Sat Mar 14 12:27:22 2020
 """
 # import traceback, sys, pdb
 import copy
-from random import randint
 from tqdm import tqdm
 
 import numpy as np
@@ -16,6 +15,7 @@ import geopandas as gpd
 
 from misc_utils.logging_utils import create_logger #LOGGING_CONFIG
 from misc_utils.RasterWrapper import Raster
+from misc_utils.gdal_tools import gdf2ogr_mem, pixel_window
 # from obia_utils.calc_zonal_stats import calc_zonal_stats
 # from calc_zonal_stats import calc_zonal_stats
 
@@ -288,7 +288,7 @@ def neighbor_adjacent(gdf, subset, unique_id,
     return gdf
 
 
-def mask_class(gdf, column, raster, out_path, mask_value=1):
+def mask_class(gdf, column, raster, out_path, mask_value=1, block_rows=1024):
     """
     Mask (set to NoData) areas of raster where column == mask_value in gdf.
     Designed to mask an already classified area from subsequent 
@@ -309,51 +309,71 @@ def mask_class(gdf, column, raster, out_path, mask_value=1):
     mask_value : int, float, str, optional
         The value of column, where corresponding geometries should be set to NoData
         in output raster. The default is 1.
+    block_rows : int
+        Number of rows of raster to mask at a time.
 
     Returns
     -------
     out_path : str
 
     """
-    # Random number to append to temporary filenames to *attempt* to avoid overwriting if
-    # multiprocessing
-    ri = randint(0, 1000)
-
-    # Save class to temporary vector file
-    temp_seg = r'/vsimem/temp_seg_class{}.shp'.format(ri)
-    gdf[[column, 'geometry']].to_file(temp_seg)
-    vect_ds = ogr.Open(temp_seg)
-    vect_lyr = vect_ds.GetLayer()
-    
-    # Get metadata from raster to be burned into
-    img = Raster(raster)
-    ulx, uly, lrx, lry = img.get_projwin()
-    
+    # Only polygons to be masked are rasterized, straight from memory
+    mask_geoms = gdf.geometry[gdf[column] == mask_value]
+    logger.debug('Masking {:,} polygons'.format(len(mask_geoms)))
+
+    src = gdal.Open(raster)
+    gt = src.GetGeoTransform()
+    x_sz, y_sz, depth = src.RasterXSize, src.RasterYSize, src.RasterCount
+    nodata_val = src.GetRasterBand(1).GetNoDataValue()
+    if nodata_val is None:
+        logger.warning('Unable to determine NoData value of {}, '
+                       'using -9999'.format(raster))
+        nodata_val = -9999
+
     # Create output datasource with same metadata as input raster
-    temp_rast = r'/vsimem/temp_seg_rast{}.vrt'.format(ri)
-    target_ds = gdal.GetDriverByName('GTiff').Create(temp_rast, img.x_sz, img.y_sz, 1, img.dtype)
-    target_ds.SetGeoTransform(img.geotransform)
-    target_band = target_ds.GetRasterBand(1)
-    target_band.SetNoDataValue(img.nodata_val)
-    target_band.FlushCache()
-    
-    # Rasterize attribute into output datasource
-    gdal.RasterizeLayer(target_ds, [1], vect_lyr, options=["ATTRIBUTE={}".format(column)])
-    
-    # Read rasterized layer as array
-    t_arr = target_ds.ReadAsArray()
-    target_ds = None
-    
-    # Get original image as array
-    o_arr = img.MaskedArray
-    
-    # Convert where the column is value to no data in the orginal image, keeping other original
-    # values
-    new = np.where(t_arr == mask_value, img.nodata_val, o_arr)
-    
-    # Write the updated array/image out
-    img.WriteArray(new, out_path)
-        
+    out_ds = gdal.GetDriverByName('GTiff').Create(out_path, x_sz, y_sz, depth,
+                                                  src.GetRasterBand(1).DataType,
+                                                  options=['TILED=YES',
+                                                           'BIGTIFF=IF_SAFER'])
+    out_ds.SetGeoTransform(gt)
+    out_ds.SetProjection(src.GetProjection())
+    for b in range(1, depth + 1):
+        out_ds.GetRasterBand(b).SetNoDataValue(nodata_val)
+
+    vect_ds, vect_lyr = gdf2ogr_mem(mask_geoms.values, srs=src.GetProjection())
+    bounds = mask_geoms.bounds.values
+    mem = gdal.GetDriverByName('MEM')
+    # Copy the raster one block of rows at a time, burning the polygons
+    # that intersect each block only within their bounding window
+    for yoff in range(0, y_sz, block_rows):
+        rows = min(block_rows, y_sz - yoff)
+        uly = gt[3] + yoff * gt[5]
+        lry = uly + rows * gt[5]
+        in_block = (bounds[:, 3] > lry) & (bounds[:, 1] < uly)
+        window = None
+        if in_block.any():
+            window = pixel_window(gt, x_sz, y_sz,
+                                  (bounds[in_block, 0].min(), lry,
+                                   bounds[in_block, 2].max(), uly))
+        if window is not None:
+            xoff, _, cols, _ = window
+            ulx = gt[0] + xoff * gt[1]
+            vect_lyr.SetSpatialFilterRect(ulx, lry, ulx + cols * gt[1], uly)
+            mask_ds = mem.Create('', cols, rows, 1, gdal.GDT_Byte)
+            mask_ds.SetGeoTransform((ulx, gt[1], 0, uly, 0, gt[5]))
+            mask_ds.SetProjection(src.GetProjection())
+            gdal.RasterizeLayer(mask_ds, [1], vect_lyr, burn_values=[1])
+            mask = mask_ds.ReadAsArray().astype(bool)
+            mask_ds = None
+        for b in range(1, depth + 1):
+            arr = src.GetRasterBand(b).ReadAsArray(0, yoff, x_sz, rows)
+            if window is not None:
+                arr[:, xoff:xoff + cols][mask] = nodata_val
+            out_ds.GetRasterBand(b).WriteArray(arr, 0, yoff)
+    vect_ds = None
+    out_ds = None
+    src = None
+
     return out_path
 
 
@@ -13,7 +13,7 @@ import subprocess
 from subprocess import PIPE
 
 from misc_utils.logging_utils import create_logger, create_logfile_path
-from misc_utils.gdal_tools import gdal_polygonize
+from misc_utils.polygonize import polygonize_tiles
 # from cleanup_objects import mask_objs
 # from misc_utils.RasterWrapper import Raster
 
@@ -69,7 +69,9 @@ def otb_grm(img,
             speed=0,
             spectral=0.5,
             spatial=0.5,
-            init_otb_env=True):
+            init_otb_env=True,
+            vec_ext='shp',
+            n_jobs=None):
     """
     Run the Orfeo Toolbox GenericRegionMerging command via the command line.
     Requires that OTB environment is activated
@@ -94,6 +96,11 @@ def otb_grm(img,
         How much to consider spatial similarity, i.e. shape. The default is 0.5.
     out_format : str
         Format to write segmentation out as {raster, vector}
+    vec_ext : str
+        Extension of the vector segmentation, e.g. 'shp', 'gpkg', 'fgb'
+        or 'parquet'.
+    n_jobs : int
+        Number of processes used to polygonize the segmentation.
 
     Returns
     -------
@@ -169,8 +176,10 @@ def otb_grm(img,
     
     if out_format == 'vector':
         logger.info('Vectorizing...')
-        vec_seg = out_seg.replace('tif', 'shp')
-        gdal_polygonize(img=out_seg, out_vec=vec_seg, fieldname='label')
+        vec_seg = '{}.{}'.format(os.path.splitext(out_seg)[0], vec_ext)
+        # NoData is polygonized too, as gdal_polygonize did
+        polygonize_tiles(img=out_seg, out_vec=vec_seg, fieldname='label',
+                         n_jobs=n_jobs, mask_nodata=False)
         logger.info('Segmentation created at: {}'.format(vec_seg))
         logger.debug('Removing raster segmentation...')
         os.remove(out_seg)
@@ -162,8 +162,10 @@ def data_selection(aoi_p, out_dir=None,
 
     #%% Clip matchtags
     logger.info('Clipping {:,} matchtags to AOI...'.format(len(dems)))
-    dems[mtp_clipped] = clip_rasters(aoi_p, list(dems[mtp]), in_mem=True,
-                                     skip_srs_check=True)
+    # Matchtags are only read, so clip to in memory VRT windows
+    clipped = clip_rasters(aoi_p, list(dems[mtp]), in_mem=True,
+                           out_format='VRT')
+    dems[mtp_clipped] = clipped if isinstance(clipped, list) else [clipped]
 
     #%% Rank DEMs - Density
     logger.info('Ranking DEM pairs...')
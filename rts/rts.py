@@ -8,7 +8,6 @@ import subprocess
 from subprocess import PIPE
 import sys
 
-from tqdm import tqdm
 import geopandas as gpd
 
 from archive_analysis.archive_analysis_utils import grid_aoi
@@ -228,15 +227,15 @@ def main(image, dem, dem_prev, project_dir, config,
 
     if aoi:
         logger.info('Clipping inputs to AOI...')
-        for k, r in tqdm(inputs.items()):
-            out_path = r.parent / '{}{}{}'.format(r.stem, clip_sfx,
-                                                  r.suffix)
-            if clip_step not in skip_steps:
-                logger.debug(
-                    'Clipping input {} to AOI: {}'.format(k, aoi.name))
-                clip_rasters(str(aoi), str(r), out_path=str(out_path),
-                             out_suffix='')
-            inputs[k] = out_path
+        out_paths = {k: r.parent / '{}{}{}'.format(r.stem, clip_sfx, r.suffix)
+                     for k, r in inputs.items()}
+        if clip_step not in skip_steps:
+            logger.debug('Clipping inputs to AOI: {}'.format(aoi.name))
+            # AOI is read and reprojected once, inputs clipped concurrently
+            clip_rasters(str(aoi), [str(r) for r in inputs.values()],
+                         out_path=[str(out_paths[k]) for k in inputs],
+                         out_suffix='')
+        inputs = out_paths
 
     # %% DEM Derivatives
     if dem_deriv not in skip_steps:
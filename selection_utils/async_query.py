@@ -0,0 +1,186 @@
+"""
+Run several SQL queries against a Postgres/PostGIS database concurrently.
+
+Queries are issued with asyncpg on an event loop running in a background
+thread, with at most max_concurrent queries in flight. Results are handed
+back as they complete, and decoding to (Geo)DataFrames happens in the
+calling thread, so client-side processing of one result overlaps with the
+server working on the next.
+"""
+import asyncio
+import queue
+import threading
+
+import asyncpg
+import geopandas as gpd
+import pandas as pd
+from shapely import wkb
+
+from selection_utils.db import db_confs, load_db_config, generate_sql
+from misc_utils.logging_utils import create_logger
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+# Sentinel marking the end of results
+_DONE = object()
+
+
+def spec_sql(spec):
+    """
+    Return the SQL for a query spec: the 'sql' entry if present, otherwise
+    selection_utils.db.generate_sql called with the generate_sql keywords in
+    spec.
+    """
+    if spec.get('sql'):
+        return spec['sql']
+    gen_kwargs = {k: v for k, v in spec.items()
+                  if k not in ('key', 'sql', 'geom', 'crs')}
+    return generate_sql(**gen_kwargs)
+
+
+def records_to_df(records, geom=None, crs=4326):
+    """
+    Convert asyncpg Records to a DataFrame, or to a GeoDataFrame if geom is
+    the name of a hex-encoded WKB column.
+    """
+    if records:
+        df = pd.DataFrame.from_records(records, columns=list(records[0].keys()))
+    else:
+        df = pd.DataFrame()
+    if not geom:
+        return df
+    if len(df) == 0:
+        return gpd.GeoDataFrame(df, crs=crs)
+    geometry = [wkb.loads(g, hex=True) if isinstance(g, (str, bytes)) else None
+                for g in df[geom]]
+    return gpd.GeoDataFrame(df.drop(columns=geom), geometry=geometry, crs=crs)
+
+
+class AsyncQueryExecutor:
+    """
+    Execute lists of query specs concurrently.
+
+    Each spec is a dict of selection_utils.db.generate_sql keywords, or
+    a dict with a 'sql' entry, optionally with:
+        key  : identifier returned alongside the result (defaults to the
+               position of the spec in the list)
+        geom : name of the hex-WKB column to decode into geometries. Defaults
+               to encode_geom_col when generate_sql is used. If None a
+               DataFrame is returned.
+        crs  : crs of decoded geometries, default 4326
+
+    Parameters
+    ----------
+    db_name : str
+        Key in selection_utils.db.db_confs. Alternatively pass host,
+        database, user and password directly.
+    max_concurrent : int
+        Maximum number of queries running at once.
+    """
+
+    def __init__(self, db_name=None, max_concurrent=4, host=None,
+                 database=None, user=None, password=None):
+        if db_name:
+            config = load_db_config(db_confs[db_name])
+            host = config['host']
+            database = config['database']
+            user = config['user']
+            password = config['password']
+        self.host = host
+        self.database = database
+        self.user = user
+        self.password = password
+        self.max_concurrent = max_concurrent
+
+    async def _run_one(self, pool, sem, key, sql, out):
+        async with sem:
+            logger.debug('Running query {}: {}'.format(key, sql))
+            try:
+                async with pool.acquire() as conn:
+                    records = await conn.fetch(sql)
+                out(key, records, None)
+            except Exception as e:
+                out(key, None, e)
+
+    async def _run_all(self, specs, out):
+        sem = asyncio.Semaphore(self.max_concurrent)
+        pool = await asyncpg.create_pool(host=self.host, database=self.database,
+                                         user=self.user, password=self.password,
+                                         min_size=1, max_size=self.max_concurrent)
+        try:
+            await asyncio.gather(*[self._run_one(pool, sem, key, sql, out)
+                                   for key, sql in specs])
+        finally:
+            await pool.close()
+
+    async def fetch_iter(self, specs):
+        """
+        Async generator yielding (key, records) as each query completes,
+        for use from within a running event loop.
+        """
+        results = asyncio.Queue()
+        prepared = self._prepare(specs)
+
+        def out(key, records, err):
+            results.put_nowait((key, records, err))
+
+        task = asyncio.ensure_future(self._run_all([(k, s) for k, s, _, _ in prepared], out))
+        for _ in range(len(prepared)):
+            key, records, err = await results.get()
+            if err:
+                task.cancel()
+                raise err
+            yield key, records
+        await task
+
+    @staticmethod
+    def _prepare(specs):
+        prepared = []
+        for i, spec in enumerate(specs):
+            if isinstance(spec, str):
+                spec = {'sql': spec}
+            key = spec.get('key', i)
+            geom = spec.get('geom', spec.get('encode_geom_col'))
+            prepared.append((key, spec_sql(spec), geom, spec.get('crs', 4326)))
+
+        return prepared
+
+    def run(self, specs):
+        """
+        Run specs concurrently, yielding (key, DataFrame / GeoDataFrame) in
+        order of completion. Queries continue to run on the server while the
+        caller processes each yielded result.
+        """
+        prepared = self._prepare(specs)
+        if not prepared:
+            return
+        decode = {key: (geom, crs) for key, _, geom, crs in prepared}
+        results = queue.Queue()
+
+        def out(key, records, err):
+            results.put((key, records, err))
+
+        def worker():
+            try:
+                asyncio.run(self._run_all([(k, s) for k, s, _, _ in prepared], out))
+            except Exception as e:
+                results.put((None, None, e))
+            results.put(_DONE)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        while True:
+            item = results.get()
+            if item is _DONE:
+                break
+            key, records, err = item
+            if err:
+                logger.error('Error running query: {}'.format(key))
+                raise err
+            geom, crs = decode[key]
+            yield key, records_to_df(records, geom=geom, crs=crs)
+        thread.join()
+
+    def run_all(self, specs):
+        """Run specs concurrently, returning {key: result} once all finish."""
+        return dict(self.run(specs))
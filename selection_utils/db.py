@@ -1,17 +1,27 @@
+import io
 import json
 import re
 import os
 
 from sqlalchemy import create_engine
 from geoalchemy2 import Geometry, WKTElement
+import numpy as np
 import psycopg2
+from psycopg2 import sql as psql
 import pandas as pd
 import geopandas as gpd
+from shapely import wkb
 
 from misc_utils.logging_utils import create_logger
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
+try:
+    # Vectorized WKB encoding, shapely >= 2.0
+    from shapely import to_wkb, set_srid
+except ImportError:
+    to_wkb = None
+
 db_confs = {
     'sandwich-pool.dem': os.path.join(os.path.dirname(os.path.dirname(__file__)),
                                       'config', 'sandwich-pool.dem.json'),
@@ -83,6 +93,15 @@ def generate_sql(layer, columns=None, where=None, orderby=False, orderby_asc=Fal
     return sql
 
 
+def geoms_to_ewkb_hex(geoms, srid):
+    """Encode geometries as hex EWKB strings (with SRID) for COPY."""
+    if to_wkb is not None:
+        return to_wkb(set_srid(np.asarray(geoms), srid), hex=True,
+                      include_srid=True)
+    return [wkb.dumps(g, hex=True, srid=srid) if g is not None else None
+            for g in geoms]
+
+
 class Postgres(object):
     _instance = None
 
@@ -186,22 +205,109 @@ class Postgres(object):
 
         return df
 
+    def copy_upsert(self, df, table, unique_id, geom_col='geom', srid=None,
+                    batch_size=100_000):
+        """
+        Bulk insert rows of df into table, skipping any whose unique_id
+        already exists in table. Rows are streamed into a temporary staging
+        table with COPY FROM STDIN (CSV, geometries as hex EWKB), then moved
+        with INSERT ... ON CONFLICT DO NOTHING, so deduplication happens
+        on the server. Requires a unique constraint on unique_id in table.
+
+        Parameters
+        ----------
+        df : pd.DataFrame / gpd.GeoDataFrame
+            Records to insert. Column names must match columns in table. If
+            a GeoDataFrame, the active geometry is written to geom_col.
+        table : str
+            Destination table.
+        unique_id : str
+            Column with a unique constraint in table.
+        geom_col : str
+            Geometry column in table.
+        srid : int
+            SRID of geometries. Defaults to the EPSG code of df.crs.
+        batch_size : int
+            Number of rows to COPY at a time.
+
+        Returns
+        -------
+        int : number of rows inserted.
+        """
+        if isinstance(df, gpd.GeoDataFrame):
+            srid = srid if srid else df.crs.to_epsg()
+            geoms = df.geometry
+            df = pd.DataFrame(df.drop(columns=df.geometry.name))
+            df[geom_col] = geoms_to_ewkb_hex(geoms.values, srid)
+        columns = list(df.columns)
+        cols_sql = psql.SQL(', ').join(map(psql.Identifier, columns))
+        stage = psql.Identifier('{}_stage'.format(table.split('.')[-1]))
+        table_id = psql.Identifier(*table.split('.'))
+
+        try:
+            self.cursor.execute(psql.SQL(
+                "CREATE TEMP TABLE {} ON COMMIT DROP AS "
+                "SELECT {} FROM {} LIMIT 0").format(stage, cols_sql, table_id))
+            copy_sql = psql.SQL(
+                "COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+                stage, cols_sql).as_string(self.connection)
+            for start in range(0, len(df), batch_size):
+                buf = io.StringIO()
+                df.iloc[start:start+batch_size].to_csv(buf, index=False,
+                                                       header=False)
+                buf.seek(0)
+                self.cursor.copy_expert(copy_sql, buf)
+            self.cursor.execute(psql.SQL(
+                "INSERT INTO {} ({}) SELECT {} FROM {} "
+                "ON CONFLICT ({}) DO NOTHING").format(
+                table_id, cols_sql, cols_sql, stage,
+                psql.Identifier(unique_id)))
+            inserted = self.cursor.rowcount
+            self.connection.commit()
+        except psycopg2.Error as error:
+            self.connection.rollback()
+            logger.error('Error during bulk insert into {}'.format(table))
+            raise error
+
+        return inserted
+
+
+def insert_new_records(records, table, unique_id=None, dryrun=False,
+                       db_name='sandwich-pool.dgarchive', bulk=True):
+    """
+    Insert records into table, skipping any whose unique_id already exists.
+    If bulk, records are loaded with Postgres.copy_upsert and deduplicated on
+    the server, otherwise existing IDs are pulled back and records are
+    written with DataFrame.to_sql. With dryrun, existing IDs are pulled back
+    to count the new records, and nothing is written.
+    """
+    # Convert date column to datetime, on a copy of the caller's records
+    if 'acquired' in records.columns:
+        records = records.assign(acquired=pd.to_datetime(records['acquired'],
+                                                         format="%Y-%m-%dT%H:%M:%S.%fZ"))
+    if bulk and not dryrun:
+        with Postgres(db_name) as pg:
+            logger.info('Bulk loading {:,} records into {}...'.format(len(records), table))
+            inserted = pg.copy_upsert(records, table, unique_id=unique_id)
+            logger.info('New records written to {}: {:,}'.format(table, inserted))
+        return
 
-def insert_new_records(records, table, unique_id=None, dryrun=False):
     logger.debug('Loading existing IDs..')
-    with Postgres() as pg:
+    with Postgres(db_name) as pg:
 
         if table in pg.list_db_tables():
             existing_ids = pg.get_values(table, columns=[unique_id], distinct=True)
             logger.debug('Removing any existing IDs from search results...')
         else:
-            logger.error('Table "{}" not found in database "{}"'.format(table, pg.db_name))
+            logger.error('Table "{}" not found in database "{}"'.format(table, pg.database))
 
         logger.debug('Existing unique IDs in table "{}": {:,}'.format(table, len(existing_ids)))
         new = records[~records[unique_id].isin(existing_ids)].copy()
         del records
 
         logger.debug('Remaining IDs to add: {:,}'.format(len(new)))
+        if dryrun:
+            logger.info('New records to be written to {}: {:,}'.format(table, len(new)))
 
         # Get epsg code
         srid = new.crs.to_epsg()
@@ -209,8 +315,6 @@ def insert_new_records(records, table, unique_id=None, dryrun=False):
         geometry_name = new.geometry.name
         new['geom'] = new.geometry.apply(lambda x: WKTElement(x.wkt, srid=srid))
         new.drop(columns=geometry_name, inplace=True)
-        # Convert date column to datetime
-        new['acquired'] = pd.to_datetime(new['acquired'], format="%Y-%m-%dT%H:%M:%S.%fZ")
 
         # logger.debug('Dataframe column types:\n{}'.format(new.dtypes))
         if len(new) != 0 and not dryrun:
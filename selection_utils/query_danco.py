@@ -272,37 +272,80 @@ def layer_crs(layer, db='footprint'):
     return crs
     
     
-def stereo_noh(where=None, noh=True):
+def danco_executor(db='footprint', instance='danco.pgc.umn.edu',
+                   max_concurrent=4):
     '''
-    Returns a dataframe with all intrack stereo not on hand as individual rows, 
-    rather than as pairs.
-    where: string of SQL query syntax
+    Returns an AsyncQueryExecutor for a danco database, for running
+    several queries at once.
+    '''
+    from selection_utils.async_query import AsyncQueryExecutor
+
+    return AsyncQueryExecutor(host=instance, database=db, user=creds[0],
+                              password=creds[1],
+                              max_concurrent=max_concurrent)
+
+
+def iter_footprints(specs, db='footprint', max_concurrent=4):
+    '''
+    Run several query_footprint style queries concurrently, yielding
+    (key, dataframe) as each query completes.
+    specs: dict of {key: dict of generate_sql keywords (layer, where,
+           columns, table, etc.)}
+    '''
+    danco_specs = [{'key': key,
+                    'sql': generate_sql(**spec),
+                    'geom': None if spec.get('table') else 'geom'}
+                   for key, spec in specs.items()]
+
+    return danco_executor(db=db, max_concurrent=max_concurrent).run(danco_specs)
+
+
+def query_footprints(specs, db='footprint', max_concurrent=4):
+    '''
+    Run several query_footprint style queries concurrently.
+    specs: dict of {key: dict of generate_sql keywords (layer, where,
+           columns, table, etc.)}
+    returns a dict of {key: dataframe}, geodataframes unless table=True
+    '''
+    return dict(iter_footprints(specs, db=db, max_concurrent=max_concurrent))
+
+
+def _stereo_rows(left, oh_ids=None):
+    '''
+    Splits stereo pairs into individual rows, optionally removing on hand IDs.
     '''
     # TODO: Fix this - geometry is for catalogid/left, not stereopair. Look up stereopair in index_dg?
-    # Use all stereo layer, get both catalogid column and stereopair column
-    left = query_footprint('dg_imagery_index_stereo', where=where)
     right = left.drop(columns=['catalogid'])
     right.rename(index=str, columns={'stereopair': 'catalogid'}, inplace=True)
 
     stereo = pd.concat([left, right], sort=True)
     # Remove ids on hand
-    if noh:
+    if oh_ids is not None:
         logger.debug('Removing on hand IDs')
-        pgc_archive = query_footprint(layer='pgc_imagery_catalogids_stereo', table=True)
-        oh_ids = list(pgc_archive.catalog_id)
-        del pgc_archive
-        # left = left[~left.catalogid.isin(oh_ids)]
-        # right = right[~right.catalogid.isin(oh_ids)]
         stereo = stereo[~stereo.catalogid.isin(oh_ids)]
-    # Combine columns
-    # noh = pd.concat([left, right], sort=True)
-    del left, right
 
     stereo.drop_duplicates(subset='catalogid', inplace=True)
 
     return stereo
 
 
+def stereo_noh(where=None, noh=True):
+    '''
+    Returns a dataframe with all intrack stereo not on hand as individual rows, 
+    rather than as pairs.
+    where: string of SQL query syntax
+    '''
+    # Use all stereo layer, get both catalogid column and stereopair column
+    specs = {'stereo': {'layer': 'dg_imagery_index_stereo', 'where': where}}
+    if noh:
+        specs['oh'] = {'layer': 'pgc_imagery_catalogids_stereo', 'table': True,
+                       'columns': ['catalog_id']}
+    results = query_footprints(specs)
+    oh_ids = set(results['oh'].catalog_id) if noh else None
+
+    return _stereo_rows(results['stereo'], oh_ids=oh_ids)
+
+
 def mono_noh(where=None, noh=True):
     '''
     To determine mono not on hand, remove all stereo catalogids from all dg ids
@@ -314,11 +357,18 @@ def mono_noh(where=None, noh=True):
     # all_stereo = 'dg_stereo_catalogids_with_pairname'
     # all_stereo = query_footprint(all_stereo, where=where)
 
-    # Workaround to get all stereo catids
-    all_stereo = stereo_noh(where=where, noh=True)
+    # Workaround to get all stereo catids. Stereo, all ids and onhand ids are
+    # loaded concurrently.
+    results = query_footprints({
+        'stereo': {'layer': 'dg_imagery_index_stereo', 'where': where},
+        'all': {'layer': 'index_dg', 'where': where},
+        'oh': {'layer': 'pgc_imagery_catalogids_stereo', 'table': True,
+               'columns': ['catalog_id']}})
+    oh_ids = set(results['oh'].catalog_id)
+    all_stereo = _stereo_rows(results['stereo'], oh_ids=oh_ids)
 
     # All ids
-    all_mono_stereo = query_footprint('index_dg', where=where)
+    all_mono_stereo = results['all']
 
     # Remove stereo
     mono = all_mono_stereo[~all_mono_stereo['catalogid'].isin(all_stereo['catalogid'])]
@@ -326,8 +376,6 @@ def mono_noh(where=None, noh=True):
     if noh:
         logger.debug('Removing onhand IDs...')
         # Remove onhand
-        pgc_archive = query_footprint(layer='pgc_imagery_catalogids_stereo', table=True)
-        oh_ids = set(pgc_archive.catalog_id)
         mono = mono[~mono['catalogid'].isin(oh_ids)]
 
     return mono
@@ -382,12 +430,15 @@ def all_IK01(where=None, onhand=None):
         where = "source_abr = 'IK-2'"
     
     if onhand == True or onhand == False:
-        # Get all on hand ids
-        pgc_archive = query_footprint(layer='pgc_imagery_catalogids', table=True)
-        oh_ids = tuple(pgc_archive.catalog_id)
-        del pgc_archive
+        # Get all on hand ids and IKONOS footprints concurrently
+        results = query_footprints({
+            'oh': {'layer': 'pgc_imagery_catalogids', 'table': True,
+                   'columns': ['catalog_id']},
+            'IK01': {'layer': 'index_ge', 'where': where}})
+        oh_ids = set(results['oh'].catalog_id)
+        IK01 = results['IK01']
+        del results
         
-        IK01 = query_footprint('index_ge', where=where)
 #        lut = archive_id_lut('IK01')
 #        IK01['catalogid'] = IK01['strip_id'].map(lut)
         
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Greedy weighted set-cover selection of footprints over AOIs.
+
+Each AOI is gridded and a sparse footprint x grid point incidence matrix
+is built once with a single spatial index query. Footprints are then
+selected greedily by the number of still uncovered points they add
+(divided by an optional weight), using a lazy priority queue: a
+footprint's gain is only recomputed when it reaches the top of the queue,
+as gains can only decrease as points are covered. Ties in gain are broken
+by a ranking on attributes such as date, cloud cover or DEM density.
+"""
+from collections import namedtuple
+import heapq
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from joblib import Parallel, delayed
+from scipy import sparse
+
+from archive_analysis.archive_analysis_utils import grid_aoi
+from misc_utils.logging_utils import create_logger
+
+try:
+    # Bulk spatial index queries returning integer indices, shapely >= 2.0
+    from shapely import STRtree
+except ImportError:
+    STRtree = None
+
+logger = create_logger(__name__, 'sh', 'INFO')
+
+
+SetCover = namedtuple('SetCover', ['selected', 'added', 'coverage'])
+
+
+def incidence_matrix(fps, grid):
+    """
+    Build a sparse boolean matrix of which grid points (columns) each
+    footprint (rows) intersects. Rows and columns are positional.
+
+    Parameters
+    ----------
+    fps : gpd.GeoDataFrame
+        Footprints.
+    grid : gpd.GeoDataFrame
+        Grid points, in the same crs as fps.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix : len(fps) x len(grid)
+    """
+    if STRtree is not None:
+        tree = STRtree(np.asarray(grid.geometry.values))
+        fp_idx, pt_idx = tree.query(np.asarray(fps.geometry.values),
+                                    predicate='intersects')
+    else:
+        # geopandas spatial join is backed by an rtree index
+        sj = gpd.sjoin(fps[['geometry']].reset_index(drop=True),
+                       grid[['geometry']].reset_index(drop=True),
+                       how='inner')
+        fp_idx = sj.index.values
+        pt_idx = sj['index_right'].values
+    data = np.ones(len(fp_idx), dtype=bool)
+    incidence = sparse.csr_matrix((data, (fp_idx, pt_idx)),
+                                  shape=(len(fps), len(grid)), dtype=bool)
+
+    return incidence
+
+
+def tie_break_rank(fps, tie_breaks=None):
+    """
+    Rank footprints for breaking ties in gain, 0 being preferred.
+
+    Parameters
+    ----------
+    fps : pd.DataFrame
+    tie_breaks : list of tuples
+        (column, ascending) pairs in order of priority, e.g.
+        [('acqdate', False), ('cloudcover', True)] prefers the most recent
+        footprint, then the least cloudy. Columns not in fps are skipped.
+
+    Returns
+    -------
+    np.ndarray : rank of each row of fps.
+    """
+    keys = []
+    for col, ascending in (tie_breaks if tie_breaks else []):
+        if col not in fps.columns:
+            logger.warning('Tie break column not found, skipping: {}'.format(col))
+            continue
+        # Rank so that descending sorts can be done on any dtype, nulls last
+        key = fps[col].rank(method='dense', ascending=ascending,
+                            na_option='bottom').values
+        keys.append(key)
+    if not keys:
+        return np.arange(len(fps))
+    # lexsort sorts by last key first
+    order = np.lexsort(keys[::-1])
+    rank = np.empty(len(fps), dtype=np.int64)
+    rank[order] = np.arange(len(fps))
+
+    return rank
+
+
+def greedy_set_cover(incidence, weights=None, rank=None, min_added=0,
+                     target=100):
+    """
+    Greedily select rows of incidence that cover the most uncovered
+    columns, per unit weight.
+
+    Parameters
+    ----------
+    incidence : scipy.sparse matrix
+        Footprints (rows) x points (columns).
+    weights : np.ndarray
+        Cost of selecting each footprint, default 1.
+    rank : np.ndarray
+        Tie break rank of each footprint, lower is preferred.
+    min_added : float
+        Minimum percentage of points a footprint must newly cover to be
+        selected. With 0 any footprint adding a point is selected.
+    target : float
+        Stop once this percentage of points is covered.
+
+    Returns
+    -------
+    SetCover : namedtuple of
+        selected : positions of selected rows, in selection order
+        added : number of points newly covered by each selected row
+        coverage : percentage of points covered
+    """
+    incidence = sparse.csr_matrix(incidence)
+    n_fps, n_pts = incidence.shape
+    if n_pts == 0 or n_fps == 0:
+        return SetCover([], [], 0.0)
+    weights = np.ones(n_fps) if weights is None else np.asarray(weights, dtype=float)
+    rank = np.arange(n_fps) if rank is None else np.asarray(rank)
+    indptr, indices = incidence.indptr, incidence.indices
+
+    counts = np.diff(indptr)
+    candidates = np.flatnonzero((counts > 0) & (weights > 0))
+    heap = list(zip(-counts[candidates] / weights[candidates],
+                    rank[candidates], candidates))
+    heapq.heapify(heap)
+
+    covered = np.zeros(n_pts, dtype=bool)
+    num_covered = 0
+    selected = []
+    added = []
+    while heap and num_covered / n_pts * 100 < target:
+        _, r, i = heapq.heappop(heap)
+        pts = indices[indptr[i]:indptr[i + 1]]
+        new = pts[~covered[pts]]
+        if len(new) == 0 or len(new) / n_pts * 100 < min_added:
+            # Gains only decrease, so this footprint can never be selected
+            continue
+        gain = len(new) / weights[i]
+        if heap and (-gain, r) > heap[0][:2]:
+            # Stale entry - another footprint may now add more
+            heapq.heappush(heap, (-gain, r, i))
+            continue
+        covered[new] = True
+        num_covered += len(new)
+        selected.append(i)
+        added.append(len(new))
+
+    return SetCover(selected, added, num_covered / n_pts * 100)
+
+
+def cover_aoi(aoi_geom, fps, aoi_crs=None, grid=None, grid_fn=None,
+              weight_col=None, tie_breaks=None, min_added=0, target=100,
+              **grid_kwargs):
+    """
+    Select footprints covering a single AOI geometry.
+
+    Parameters
+    ----------
+    aoi_geom : shapely geometry
+    fps : gpd.GeoDataFrame
+        Candidate footprints, in the AOI crs.
+    grid : gpd.GeoDataFrame
+        Points to cover. If not provided, grid_fn(aoi_geom) is used, or
+        grid_aoi(aoi_geom, **grid_kwargs).
+    weight_col : str
+        Column of fps with the cost of selecting each footprint.
+    tie_breaks : list
+        See tie_break_rank.
+    min_added, target : float
+        See greedy_set_cover.
+
+    Returns
+    -------
+    tuple : (fps selected, in selection order, with 'added_perc' column;
+             percent coverage of the AOI; number of grid points)
+    """
+    if grid is None:
+        if grid_fn is not None:
+            grid = grid_fn(aoi_geom)
+        else:
+            grid = grid_aoi(aoi_geom, aoi_crs=aoi_crs, **grid_kwargs)
+    if len(grid) == 0 or len(fps) == 0:
+        return fps.iloc[:0].assign(added_perc=[]), 0.0, len(grid)
+
+    incidence = incidence_matrix(fps, grid)
+    weights = fps[weight_col].values if weight_col else None
+    rank = tie_break_rank(fps, tie_breaks)
+    cover = greedy_set_cover(incidence, weights=weights, rank=rank,
+                             min_added=min_added, target=target)
+
+    selected = fps.iloc[cover.selected].copy()
+    selected['added_perc'] = np.array(cover.added) / len(grid) * 100
+
+    return selected, cover.coverage, len(grid)
+
+
+def cover_aois(aoi, fps, fps_id, n_jobs=None, **kwargs):
+    """
+    Select footprints covering each polygon in aoi, in parallel.
+
+    Parameters
+    ----------
+    aoi : gpd.GeoDataFrame
+        AOI polygons, covered independently.
+    fps : gpd.GeoDataFrame
+        Footprints.
+    fps_id : str
+        Unique ID column in fps.
+    n_jobs : int
+        Number of processes, defaults to all but two cores.
+    **kwargs
+        Passed to cover_aoi.
+
+    Returns
+    -------
+    pd.DataFrame : indexed as aoi with columns:
+        fp_ids : list of selected IDs, in selection order
+        coverage : percent of AOI grid points covered
+        n_pts : number of grid points
+    """
+    if fps.crs != aoi.crs:
+        fps = fps.to_crs(aoi.crs)
+
+    # Match footprints to AOIs in one join, so each worker only receives
+    # the footprints over its AOI
+    aoi_pos = aoi[['geometry']].reset_index(drop=True)
+    sj = gpd.sjoin(fps.reset_index(drop=True), aoi_pos, how='inner')
+    fps_by_aoi = {k: g.drop(columns='index_right')
+                  for k, g in sj.groupby('index_right')}
+
+    n_jobs = n_jobs if n_jobs else max(multiprocessing.cpu_count() - 2, 1)
+    n_jobs = max(min(n_jobs, len(aoi)), 1)
+    logger.info('Selecting footprints over {:,} AOIs...'.format(len(aoi)))
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(cover_aoi)(geom, fps_by_aoi.get(i, fps.iloc[:0]),
+                           aoi_crs=aoi.crs, **kwargs)
+        for i, geom in enumerate(aoi.geometry))
+
+    covers = pd.DataFrame({'fp_ids': [list(sel[fps_id]) for sel, _, _ in results],
+                           'coverage': [cov for _, cov, _ in results],
+                           'n_pts': [n for _, _, n in results]},
+                          index=aoi.index)
+
+    return covers
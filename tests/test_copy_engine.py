@@ -0,0 +1,143 @@
+import json
+import os
+import time
+
+from misc_utils.copy_engine import copy_files, file_checksum
+from misc_utils.sync_folders import sync_folders
+
+
+def _write(path, content, mtime=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    if mtime is not None:
+        os.utime(str(path), (mtime, mtime))
+    return path
+
+
+def _tree(root):
+    return sorted(str(p.relative_to(root)) for p in root.rglob('*') if p.is_file())
+
+
+def _pairs(src, dst):
+    return [(str(p), str(dst / p.relative_to(src)))
+            for p in sorted(src.rglob('*')) if p.is_file()]
+
+
+def _make_src(tmp_path):
+    src = tmp_path / 'src'
+    _write(src / 'big.bin', os.urandom(300000))
+    _write(src / 'a' / 'mid.bin', os.urandom(20000))
+    _write(src / 'a' / 'b' / 'small.txt', b'small')
+    return src
+
+
+def test_copy(tmp_path):
+    src = _make_src(tmp_path)
+    dst = tmp_path / 'dst'
+    result = copy_files(_pairs(src, dst), threads=2)
+
+    assert len(result.copied) == 3
+    assert result.bytes_copied == 300000 + 20000 + 5
+    assert _tree(dst) == _tree(src)
+    for s, d in _pairs(src, dst):
+        assert file_checksum(s) == file_checksum(d)
+        assert os.path.getmtime(s) == os.path.getmtime(d)
+    # No temporary files left
+    assert not list(dst.rglob('*.part'))
+
+
+def test_skip_identical(tmp_path):
+    src = _make_src(tmp_path)
+    dst = tmp_path / 'dst'
+    copy_files(_pairs(src, dst))
+    result = copy_files(_pairs(src, dst))
+
+    assert result.copied == []
+    assert result.skipped == 3
+
+
+def test_resume_from_manifest(tmp_path):
+    src = _make_src(tmp_path)
+    dst = tmp_path / 'dst'
+    manifest = str(tmp_path / 'manifest.json')
+    pairs = _pairs(src, dst)
+    # Interrupted run: first file copied, second left partially written
+    copy_files(pairs[:1], manifest_path=manifest)
+    _write(tmp_path / 'dst' / 'a' / 'mid.bin.part', b'partial')
+    with open(manifest) as f:
+        assert pairs[0][1] in json.load(f)['files']
+    result = copy_files(pairs, manifest_path=manifest)
+
+    assert sorted(result.copied) == sorted(pairs[1:])
+    assert result.skipped == 1
+    assert _tree(dst) == _tree(src)
+
+
+def test_recopy_changed(tmp_path):
+    src = _make_src(tmp_path)
+    dst = tmp_path / 'dst'
+    manifest = str(tmp_path / 'manifest.json')
+    copy_files(_pairs(src, dst), manifest_path=manifest)
+    changed = _write(src / 'a' / 'b' / 'small.txt', b'changed', mtime=time.time() + 10)
+    result = copy_files(_pairs(src, dst), manifest_path=manifest)
+
+    assert result.copied == [(str(changed), str(dst / 'a' / 'b' / 'small.txt'))]
+    assert (dst / 'a' / 'b' / 'small.txt').read_bytes() == b'changed'
+
+
+def test_checksum_skips_same_content(tmp_path):
+    src = _make_src(tmp_path)
+    dst = tmp_path / 'dst'
+    _write(dst / 'big.bin', (src / 'big.bin').read_bytes(), mtime=1)
+    result = copy_files(_pairs(src, dst), checksum=True)
+
+    assert (str(src / 'big.bin'), str(dst / 'big.bin')) not in result.copied
+    assert result.skipped == 1
+
+
+def test_dryrun(tmp_path):
+    src = _make_src(tmp_path)
+    dst = tmp_path / 'dst'
+    result = copy_files(_pairs(src, dst), dryrun=True)
+
+    assert result.copied == []
+    assert not dst.exists()
+
+
+def test_missing_source(tmp_path):
+    src = _make_src(tmp_path)
+    dst = tmp_path / 'dst'
+    pairs = _pairs(src, dst) + [(str(src / 'missing.bin'), str(dst / 'missing.bin'))]
+    result = copy_files(pairs)
+
+    assert result.failed == [(str(src / 'missing.bin'), str(dst / 'missing.bin'))]
+    assert len(result.copied) == 3
+
+
+def test_sync_folders_mod_date(tmp_path):
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    now = time.time()
+    _write(a / 'old.txt', b'old source', mtime=now - 1000)
+    _write(b / 'old.txt', b'newer destination edit', mtime=now)
+    _write(a / 'new.txt', b'newer source edit', mtime=now)
+    _write(b / 'new.txt', b'old', mtime=now - 1000)
+    _write(a / 'only_a.txt', b'a')
+
+    sync_folders(str(a), str(b), mod_date=True)
+
+    # Newer destination is kept, even though sizes differ
+    assert (b / 'old.txt').read_bytes() == b'newer destination edit'
+    assert (b / 'new.txt').read_bytes() == b'newer source edit'
+    assert (b / 'only_a.txt').read_bytes() == b'a'
+
+
+def test_sync_folders_no_mod_date(tmp_path):
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    _write(a / 'f.txt', b'source', mtime=time.time())
+    _write(b / 'f.txt', b'dst', mtime=time.time() - 1000)
+
+    sync_folders(str(a), str(b), mod_date=False)
+
+    assert (b / 'f.txt').read_bytes() == b'dst'
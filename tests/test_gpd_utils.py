@@ -0,0 +1,32 @@
+import geopandas as gpd
+import pandas as pd
+import pytest
+
+pyogrio = pytest.importorskip('pyogrio')
+
+from misc_utils.gpd_utils import read_vector
+from shapely.geometry import box
+
+
+@pytest.fixture(params=['shp', 'gpkg'])
+def vector(tmp_path, request):
+    gdf = gpd.GeoDataFrame({'name': ['a', 'b', 'c']},
+                           geometry=[box(0, 0, 1, 1), box(2, 2, 3, 3), box(10, 10, 11, 11)],
+                           crs='epsg:3413')
+    path = tmp_path / 'objects.{}'.format(request.param)
+    pyogrio.write_dataframe(gdf, str(path))
+
+    return path
+
+
+def test_read_vector_bbox_without_geometry(vector):
+    df = read_vector(vector, bbox=(-1, -1, 4, 4), read_geometry=False)
+
+    assert isinstance(df, pd.DataFrame) and not isinstance(df, gpd.GeoDataFrame)
+    assert sorted(df['name']) == ['a', 'b']
+
+
+def test_read_vector_bbox(vector):
+    gdf = read_vector(vector, bbox=(-1, -1, 4, 4))
+
+    assert sorted(gdf['name']) == ['a', 'b']
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from misc_utils.gpd_utils import read_vector
+from misc_utils.polygonize import polygonize_tiles, stitch_by_label
+from shapely.geometry import box
+
+
+NODATA = 0
+
+
+def _label_raster(path, seed=0):
+    rng = np.random.RandomState(seed)
+    # Blocky labels so regions span tile edges, with a NoData gap, a label
+    # split into separate regions and a diagonal (8 connected) join
+    arr = rng.randint(1, 6, size=(12, 14)).repeat(3, axis=0).repeat(3, axis=1)
+    arr[10:14, :] = NODATA
+    arr[20:22, 8] = 9
+    arr[22, 9] = 9
+    arr[0, 0] = 9
+    ds = gdal.GetDriverByName('GTiff').Create(str(path), arr.shape[1], arr.shape[0],
+                                              1, gdal.GDT_Int32)
+    ds.SetGeoTransform((500000, 2, 0, 7000000, 0, -2))
+    ds.GetRasterBand(1).WriteArray(arr)
+    ds.GetRasterBand(1).SetNoDataValue(NODATA)
+    ds = None
+
+    return arr
+
+
+def _polygonize(tmp_path, name, **kwargs):
+    out = str(tmp_path / '{}.gpkg'.format(name))
+    polygonize_tiles(str(tmp_path / 'labels.tif'), out, n_jobs=2, area=True, **kwargs)
+    gdf = read_vector(out)
+    gdf = gdf.join(gdf.geometry.bounds)
+    return gdf.sort_values(['label', 'n_pixels', 'minx', 'miny']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('connectedness', [4, 8])
+@pytest.mark.parametrize('mask_nodata', [True, False])
+def test_tiled_matches_single_tile(tmp_path, connectedness, mask_nodata):
+    arr = _label_raster(tmp_path / 'labels.tif')
+    kwargs = dict(connectedness=connectedness, mask_nodata=mask_nodata)
+    single = _polygonize(tmp_path, 'single', tile_size=1000, **kwargs)
+    tiled = _polygonize(tmp_path, 'tiled', tile_size=7, **kwargs)
+
+    assert len(tiled) == len(single)
+    assert (tiled['label'].values == single['label'].values).all()
+    assert (tiled['n_pixels'].values == single['n_pixels'].values).all()
+    for t, s in zip(tiled.geometry, single.geometry):
+        assert t.symmetric_difference(s).area == 0
+    # Pixel counts cover the raster
+    n_valid = (arr != NODATA).sum() if mask_nodata else arr.size
+    assert tiled['n_pixels'].sum() == n_valid
+    assert (tiled['area'] == tiled['n_pixels'] * 4).all()
+    assert (NODATA in tiled['label'].values) != mask_nodata
+
+
+def test_stitch_corner_touching():
+    labels = np.array([1, 1])
+    geoms = [box(0, 0, 1, 1), box(1, 1, 2, 2)]
+    n_pixels = np.array([1, 1])
+    l4, g4, n4 = stitch_by_label(labels, geoms, n_pixels, connectedness=4)
+    l8, g8, n8 = stitch_by_label(labels, geoms, n_pixels, connectedness=8)
+
+    assert len(g4) == 2 and list(n4) == [1, 1]
+    assert len(g8) == 1 and list(n8) == [2]
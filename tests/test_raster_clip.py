@@ -0,0 +1,48 @@
+import json
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from misc_utils.raster_clip import clip_rasters, get_cutline
+from shapely.geometry import box, mapping
+
+
+def _raster(path):
+    ds = gdal.GetDriverByName('GTiff').Create(str(path), 20, 20, 1, gdal.GDT_Int32)
+    ds.SetGeoTransform((0, 1, 0, 20, 0, -1))
+    ds.GetRasterBand(1).WriteArray(np.arange(400, dtype=np.int32).reshape(20, 20))
+    ds = None
+
+
+def _write_aoi(path, geom):
+    # Rewrites the same path, as callers reusing a fixed AOI path do
+    with open(str(path), 'w') as dst:
+        json.dump({'type': 'FeatureCollection',
+                   'features': [{'type': 'Feature', 'properties': {},
+                                 'geometry': mapping(geom)}]}, dst)
+
+
+def test_rewritten_shape_not_served_from_cache(tmp_path):
+    raster = tmp_path / 'raster.tif'
+    _raster(raster)
+    aoi = tmp_path / 'aoi.geojson'
+
+    _write_aoi(aoi, box(2, 2, 6, 6))
+    first = get_cutline(str(aoi))
+    clipped1 = gdal.Open(clip_rasters(str(aoi), str(raster), out_path=str(tmp_path / 'c1.tif'),
+                                      skip_srs_check=True))
+    # Rewritten within the same second, with a different shape
+    _write_aoi(aoi, box(10, 4, 18, 16))
+    second = get_cutline(str(aoi))
+    clipped2 = gdal.Open(clip_rasters(str(aoi), str(raster), out_path=str(tmp_path / 'c2.tif'),
+                                      skip_srs_check=True))
+
+    assert first.geometry.equals(box(2, 2, 6, 6))
+    assert second.geometry.equals(box(10, 4, 18, 16))
+    assert (clipped1.RasterXSize, clipped1.RasterYSize) == (4, 4)
+    assert (clipped2.RasterXSize, clipped2.RasterYSize) == (8, 12)
+    assert clipped2.GetGeoTransform()[0] == 10
+    # Same shape again is served from the cache
+    assert get_cutline(str(aoi)) is second
@@ -0,0 +1,37 @@
+import geopandas as gpd
+from shapely.geometry import box
+
+from misc_utils.spatial_partition import TilePartitioner, map_partitions
+
+
+def count_overlaps(cells, fps):
+    cells = cells.copy()
+    cells['n'] = [int(fps.intersects(c).sum()) if len(fps) else 0
+                  for c in cells.geometry]
+    return cells
+
+
+def _counts(cells, fps, **kwargs):
+    cells = gpd.GeoDataFrame({'cell': range(len(cells))}, geometry=cells,
+                             crs='epsg:4326')
+    fps = gpd.GeoDataFrame(geometry=fps, crs='epsg:4326')
+    out = map_partitions(count_overlaps, cells, fps, n_jobs=1, **kwargs)
+    return out.sort_values('cell')['n'].tolist()
+
+
+def test_driver_crossing_tile_edge():
+    # Cell placed in the 0-10 lon tile, footprint only in the 10-20 tile
+    assert _counts([box(8, 0, 11, 1)], [box(10.3, 0.2, 10.6, 0.5)]) == [1]
+
+
+def test_driver_crossing_polar_lat():
+    # Cell placed in a polar tile, footprint only below polar_lat
+    assert _counts([box(0, 59.5, 1, 60.6)], [box(0.2, 59.6, 0.4, 59.8)]) == [1]
+
+
+def test_counts_match_brute_force():
+    cells = [box(x, y, x + 3, y + 3) for x in range(-20, 20, 2) for y in range(50, 70, 2)]
+    fps = [box(x + 0.5, y + 0.7, x + 1.9, y + 1.1) for x in range(-22, 22) for y in range(48, 72)]
+    partitioner = TilePartitioner(tile_size=5, polar_tile_size=200_000, max_items=20)
+    expected = [sum(c.intersects(f) for f in fps) for c in cells]
+    assert _counts(cells, fps, partitioner=partitioner) == expected